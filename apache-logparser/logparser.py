@@ -18,38 +18,2890 @@
 
 ################################################################
 
-# TODO: prev_host: instead of comparing to previous entry, check if such IP has been seen in XXX seconds
-# TODO: store IP values for temporary list for XXX seconds, and check list values
-# TODO: implement warning check for geoiplookup tool database files, i.e. "warning, some geo database files are very old. Please consider updating geo database information."
 # TODO: implement support for json output
 
-# TODO: implement following output: most visited URIs (<count> <uri (http_request)>)
-  # Store each http_request
-    # If contains, add http_request dict count: (counter + 1), continue
+import argparse
+import array
+import base64
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import heapq
+import math
+import mmap
+import io
+import ipaddress
+import itertools
+import json
+import lzma
+import os
+import pickle
+import queue
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from datetime import datetime, timedelta
+from apachelogs import LogParser, InvalidEntryError
+
+class text_processing(object):
+
+  """
+  Init
+  """
+  def __init__(self, verbose):
+    self.show_verbose = verbose
+
+  """
+  Verbose output format (we do not use logger library)
+  """
+
+  def print_verbose(self, prefix='output', *args):
+    if self.show_verbose:
+      print('VERBOSE [{:s}]: {:s}'.format(prefix, ', '.join([str(i) for i in args])))
+
+class threaded_reader(io.RawIOBase):
+
+  """
+  Init
+  Raw binary stream reading a decompressing file object in a background thread
+  zlib, bz2 and lzma release the GIL while decompressing, so decompression overlaps with parsing
+  """
+  def __init__(self, stream, raw, block_size, queue_size = 8):
+    self.stream   = stream
+    self.raw      = raw
+    self.block    = memoryview(b'')
+    self.eof      = False
+    self.queue    = queue.Queue(maxsize = queue_size)
+    self.stop     = threading.Event()
+    self.thread   = threading.Thread(target = self.fill, args = (block_size,), daemon = True)
+    self.thread.start()
+
+  """
+  Background thread: decompress blocks to the queue
+  """
+  def fill(self, block_size):
+    try:
+      while not self.stop.is_set():
+        block = self.stream.read(block_size)
+        self.put(block)
+        if not block:
+          break
+    except Exception as e:
+      self.put(e)
+
+  """
+  Put a block or an exception to the queue, unless the reader is closed while the queue is full
+  """
+  def put(self, item):
+    while not self.stop.is_set():
+      try:
+        self.queue.put(item, timeout = 0.1)
+        return
+      except queue.Full:
+        continue
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+
+    if len(self.block) == 0:
+      if self.eof:
+        return 0
+      block = self.queue.get()
+      if isinstance(block, Exception):
+        raise block
+      if not block:
+        self.eof = True
+        return 0
+      self.block = memoryview(block)
+
+    n = min(len(b), len(self.block))
+    b[:n] = self.block[:n]
+    self.block = self.block[n:]
+    return n
+
+  """
+  Position in the compressed input file
+  """
+  def get_position(self):
+    return self.raw.tell()
+
+  def close(self):
+    if not self.closed:
+      self.stop.set()
+      self.thread.join()
+      self.stream.close()
+      self.raw.close()
+    super().close()
+
+class file_processing(object):
+
+  """
+  Init
+  """
+  def __init__(self, block_size = 1048576):
+    self.block_size    = block_size
+    self.magic_numbers = [
+      ('gzip',  b'\x1f\x8b'),
+      ('bzip2', b'BZh'),
+      ('xz',    b'\xfd7zXZ\x00'),
+      ('zstd',  b'\x28\xb5\x2f\xfd')
+    ]
+
+  """
+  Detect file compression by magic bytes
+  """
+  def get_compression(self, sfile):
+
+    with open(sfile, 'rb') as f:
+      head = f.read(6)
+
+    for compression, magic in self.magic_numbers:
+      if head.startswith(magic):
+        return compression
+    return None
+
+  """
+  Open a log file for binary reading
+  Compressed files are decompressed as a stream, never to disk
+  """
+  def open_file(self, sfile, compression = None):
+
+    if compression is None:
+      return open(sfile, 'rb')
+
+    raw = open(sfile, 'rb')
+
+    if compression == 'gzip':
+      stream = gzip.GzipFile(fileobj = raw)
+    elif compression == 'bzip2':
+      stream = bz2.BZ2File(raw)
+    elif compression == 'xz':
+      stream = lzma.LZMAFile(raw)
+    elif compression == 'zstd':
+      stream = self.open_zstd(raw)
+    else:
+      raw.close()
+      raise Exception("Unsupported compression '{}' of file '{}'.".format(compression, sfile))
+
+    return io.BufferedReader(threaded_reader(stream, raw, self.block_size), self.block_size)
+
+  """
+  Open a Zstandard compressed stream
+  """
+  def open_zstd(self, raw):
+    try:
+      from compression import zstd
+      return zstd.ZstdFile(raw)
+    except ImportError:
+      pass
+    try:
+      import zstandard
+    except ImportError:
+      raw.close()
+      raise Exception("Python module 'zstandard' is required for Zstandard compressed log files.")
+    return zstandard.ZstdDecompressor().stream_reader(raw)
+
+  """
+  Move to a byte offset of an opened log file
+  Offsets of compressed files refer to decompressed data, which is read and discarded
+  """
+  def seek_file(self, f, offset):
+
+    if f.seekable():
+      f.seek(offset)
+      return
+
+    remaining = offset
+    while remaining > 0:
+      block = f.read(min(remaining, self.block_size))
+      if not block:
+        break
+      remaining -= len(block)
+
+  """
+  Get size of log file data, for ordering log files by size
+  Compressed files are not decompressed: gzip files report the decompressed size of their last member
+  in the ISIZE trailer (modulo 4 GiB), other compressed files are sized by their compressed size.
+  """
+  def get_data_size(self, sfile, compression = None):
+
+    file_size = os.path.getsize(sfile)
+
+    if compression != 'gzip' or file_size < 18:
+      return file_size
+
+    with open(sfile, 'rb') as f:
+      f.seek(-4, os.SEEK_END)
+      data_size = int.from_bytes(f.read(4), 'little')
+
+    # Data larger than 4 GiB wraps around: it's at least as large as the compressed file
+    while data_size < file_size:
+      data_size += 1 << 32
+    return data_size
+
+class line_index(object):
+
+  """
+  Init
+  Sparse line number -> byte offset index of log files
+  Indexes are stored as JSON sidecar files in index_dir. With index_dir set to None, indexes are kept in memory only.
+  """
+  def __init__(self, txt, fp, index_dir = None, interval = 10000):
+    self.version      = 2
+    self.txt          = txt
+    self.fp           = fp
+    self.index_dir    = index_dir
+    self.interval     = interval
+    self.indexes      = {}
+    self.time_pattern = re.compile(rb'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2})')
+
+  """
+  Sidecar file path of a log file index
+  """
+  def get_index_path(self, sfile):
+    name = hashlib.sha1(os.path.abspath(sfile).encode()).hexdigest()
+    return os.path.join(self.index_dir, name + '.json')
+
+  """
+  Get timestamp of a raw log line, ISO formatted
+  """
+  def get_line_time(self, line):
+    r = self.time_pattern.search(line)
+    if r is None:
+      return None
+    return datetime.strptime(r.groups()[0].decode(), '%d/%b/%Y:%H:%M:%S').isoformat()
+
+  """
+  Load index of a log file from its sidecar file
+  """
+  def load(self, sfile):
+
+    if self.index_dir is None:
+      return None
+
+    try:
+      with open(self.get_index_path(sfile), 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  """
+  Save index of a log file to its sidecar file
+  """
+  def save(self, file_index):
+
+    if self.index_dir is None:
+      return
+
+    index_path = self.get_index_path(file_index['file'])
+
+    try:
+      os.makedirs(self.index_dir, exist_ok = True)
+      with open(index_path + '.tmp', 'w') as f:
+        json.dump(file_index, f)
+      os.replace(index_path + '.tmp', index_path)
+    except OSError as e:
+      self.txt.print_verbose('Line index', 'could not save index file ' + index_path, str(e))
+
+  """
+  Get index of a log file
+  Stored index is used as is if the file is unchanged, extended if the file has grown
+  and rebuilt if the file has been replaced or truncated
+  """
+  def get(self, sfile):
+
+    st = os.stat(sfile)
+
+    file_index = self.indexes.get(sfile) or self.load(sfile)
+
+    if file_index is not None:
+      if file_index.get('version') != self.version or file_index['device'] != st.st_dev or file_index['inode'] != st.st_ino or \
+         file_index['interval'] != self.interval or file_index['size'] > st.st_size:
+        file_index = None
+
+    if file_index is not None and file_index['size'] == st.st_size and file_index['mtime'] == st.st_mtime:
+      self.indexes[sfile] = file_index
+      return file_index
+
+    if file_index is None:
+      self.txt.print_verbose('Line index', 'building index', sfile)
+      file_index = {
+        'version':     self.version,
+        'file':        sfile,
+        'compression': self.fp.get_compression(sfile),
+        'device':      st.st_dev,
+        'inode':       st.st_ino,
+        'size':        0,
+        'mtime':       None,
+        'interval':    self.interval,
+        'line_count':  0,
+        'offset_end':  0,
+        'partial':     False,
+        'checkpoints': [0],
+        'time_first':  None,
+        'time_last':   None
+      }
+    else:
+      self.txt.print_verbose('Line index', 'extending index', sfile)
+
+    self.extend(file_index)
+
+    file_index['size']  = st.st_size
+    file_index['mtime'] = st.st_mtime
+
+    self.indexes[sfile] = file_index
+    self.save(file_index)
+    return file_index
+
+  """
+  Extend index of a log file from the end of its last complete line
+  """
+  def extend(self, file_index):
+
+    interval    = self.interval
+    checkpoints = file_index['checkpoints']
+    line_count  = file_index['line_count']
+    offset      = file_index['offset_end']
+
+    partial     = False
+
+    with self.fp.open_file(file_index['file'], file_index['compression']) as f:
+      self.fp.seek_file(f, offset)
+
+      while True:
+        chunk = list(itertools.islice(f, len(checkpoints) * interval - line_count))
+        if not chunk:
+          break
+
+        # Partial last line is indexed once it has been completed
+        complete = chunk if chunk[-1].endswith(b'\n') else chunk[:-1]
+
+        if file_index['time_first'] is None:
+          for line in complete:
+            file_index['time_first'] = self.get_line_time(line)
+            if file_index['time_first'] is not None:
+              break
+
+        for line in reversed(complete):
+          line_time = self.get_line_time(line)
+          if line_time is not None:
+            file_index['time_last'] = line_time
+            break
+
+        line_count += len(complete)
+        offset     += sum(map(len, complete))
+
+        if len(complete) < len(chunk):
+          partial = True
+          break
+
+        if line_count == len(checkpoints) * interval:
+          checkpoints.append(offset)
+
+    file_index['line_count'] = line_count
+    file_index['offset_end'] = offset
+    file_index['partial']    = partial
+
+  """
+  Get line count of an indexed log file, including a partial last line
+  """
+  def get_line_count(self, file_index):
+    if file_index['partial']:
+      return file_index['line_count'] + 1
+    return file_index['line_count']
+
+  """
+  Get byte offset of a line (1-based) in an indexed log file
+  Seeks to the nearest preceding checkpoint and skips at most interval - 1 lines
+  """
+  def get_line_offset(self, file_index, line_num):
+
+    checkpoint = (line_num - 1) // self.interval
+    offset     = file_index['checkpoints'][checkpoint]
+
+    with self.fp.open_file(file_index['file'], file_index['compression']) as f:
+      self.fp.seek_file(f, offset)
+      for line in itertools.islice(f, (line_num - 1) - checkpoint * self.interval):
+        offset += len(line)
+
+    return offset
+
+  """
+  Get line number (1-based) of a line starting at a byte offset in an indexed log file
+  Seeks to the nearest preceding checkpoint and counts lines from there
+  """
+  def get_offset_line(self, file_index, offset):
+
+    checkpoint = bisect.bisect_right(file_index['checkpoints'], offset) - 1
+    line_num   = checkpoint * self.interval + 1
+    position   = file_index['checkpoints'][checkpoint]
+
+    with self.fp.open_file(file_index['file'], file_index['compression']) as f:
+      self.fp.seek_file(f, position)
+      for line in f:
+        if position >= offset:
+          break
+        position += len(line)
+        line_num += 1
+
+    return line_num
+
+class string_table(object):
+
+  """
+  Init
+  Table of distinct strings of a memory-mapped parse cache column
+  Strings are stored as UTF-8 data with an array of their end offsets. Index 0 is a missing value.
+  Strings are decoded when they are used, and decoded strings are cached until the cache is full.
+  """
+  def __init__(self, offsets, data, cache_size = 4096):
+    self.offsets    = offsets
+    self.data       = data
+    self.cache      = {0: None}
+    self.cache_size = cache_size
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, index):
+
+    value = self.cache.get(index, self)
+    if value is not self:
+      return value
+
+    if len(self.cache) >= self.cache_size:
+      self.cache = {0: None}
+
+    start = self.offsets[index - 1] if index > 0 else 0
+    value = self.cache[index] = str(self.data[start:self.offsets[index]], 'utf-8', 'surrogatepass')
+    return value
+
+  """
+  Iterate all strings, without caching them
+  """
+  def __iter__(self):
+    yield None
+    for index in range(1, len(self.offsets)):
+      yield str(self.data[self.offsets[index - 1]:self.offsets[index]], 'utf-8', 'surrogatepass')
+
+class parse_cache(object):
+
+  """
+  Init
+  Columnar cache of parsed log files, stored as one file per log file in cache_dir
+  Numeric fields are stored as typed columns, and string fields as indices to tables of distinct values.
+  String tables are stored as UTF-8 data and offsets, so that only the header of metadata is parsed
+  when a cache is validated. Cache files are memory-mapped when they are read, and rebuilt when the log
+  file, the log format or local networks change.
+  Only strings of given log entry fields are decoded when log entries are read, as with the fast parser.
+  """
+  def __init__(self, txt, cache_dir, parser, signature, fields = None):
+    self.version   = 2
+    self.magic     = b'ALPC'
+    self.txt       = txt
+    self.cache_dir = cache_dir
+    self.parser    = parser
+    self.signature = signature
+    self.fields    = fields
+
+    # Column: array type code. Missing numbers are stored as -1 (0 for status), missing strings as index 0.
+    self.columns = {
+      'line':         'I',
+      'timestamp':    'q',
+      'status':       'H',
+      'remote_host':  'I',
+      'user_agent':   'I',
+      'http_request': 'I',
+      'bytes_in':     'q',
+      'bytes_out':    'q',
+      'duration':     'q'
+    }
+    self.string_columns = ['remote_host', 'user_agent', 'http_request']
+
+    try:
+      import numpy
+      self.np = numpy
+    except ImportError:
+      self.np = None
+
+  """
+  Cache file path of a log file
+  """
+  def get_cache_path(self, sfile):
+    name = hashlib.sha1(os.path.abspath(sfile).encode()).hexdigest()
+    return os.path.join(self.cache_dir, name + '.cache')
+
+  """
+  Get identity of a log file: cache is valid only for the same file, size and modification time
+  """
+  def get_identity(self, sfile):
+    st = os.stat(sfile)
+    return {'device': st.st_dev, 'inode': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime}
+
+  """
+  Get header of a valid cache file of a log file, None if there is no valid cache
+  """
+  def get(self, sfile):
+
+    try:
+      with open(self.get_cache_path(sfile), 'rb') as f:
+        prefix = f.read(12)
+        if len(prefix) != 12 or prefix[:4] != self.magic or int.from_bytes(prefix[4:8], 'little') != self.version:
+          return None
+        header_length = int.from_bytes(prefix[8:12], 'little')
+        header        = json.loads(f.read(header_length))
+    except FileNotFoundError:
+      return None
+    except (OSError, ValueError) as e:
+      self.txt.print_verbose('Parse cache', 'could not read cache file of ' + sfile, str(e))
+      return None
+
+    if header['identity'] != self.get_identity(sfile) or header['signature'] != self.signature or \
+       header['byteorder'] != sys.byteorder:
+      self.txt.print_verbose('Parse cache', 'cache is out of date', sfile)
+      return None
+
+    header['data_start'] = (12 + header_length + 7) // 8 * 8
+    return header
+
+  """
+  Parse all lines of a log file and store them in a cache file
+  Returns header of the cache file, None if it could not be written
+  """
+  def build(self, sfile, lines):
+
+    self.txt.print_verbose('Parse cache', 'building cache', sfile)
+
+    identity = self.get_identity(sfile)
+    columns  = {key: array.array(code) for key, code in self.columns.items()}
+    strings  = {key: {None: 0} for key in self.string_columns}
+    invalid  = array.array('I')
+    count    = 0
+
+    for lfile, line_num, line in lines:
+      count += 1
+
+      try:
+        entry_data = self.parser.parse(line)
+      except InvalidEntryError:
+        invalid.append(line_num)
+        continue
+
+      columns['line'].append(line_num)
+      columns['timestamp'].append(entry_data['timestamp'])
+      columns['status'].append(entry_data['status'] or 0)
+
+      for key in self.string_columns:
+        table = strings[key]
+        value = entry_data[key]
+        index = table.get(value)
+        if index is None:
+          index = table[value] = len(table)
+        columns[key].append(index)
+
+      for key in ['bytes_in', 'bytes_out', 'duration']:
+        value = entry_data[key]
+        columns[key].append(value if value is not None else -1)
+
+    # String tables: end offsets of strings in UTF-8 data. Missing value at index 0 has no data.
+    for key, table in strings.items():
+      values  = [i.encode('utf-8', 'surrogatepass') for i in itertools.islice(table.keys(), 1, None)]
+      offsets = array.array('Q', [0])
+      offsets.extend(itertools.accumulate([len(i) for i in values]))
+      columns[key + '.offsets'] = offsets
+      columns[key + '.strings'] = array.array('B', b''.join(values))
+
+    columns['invalid'] = invalid
+
+    # Columns are aligned to 8 bytes from the start of data
+    layout = {}
+    offset = 0
+    for key, column in columns.items():
+      layout[key] = [column.typecode, offset, len(column)]
+      offset     += (len(column) * column.itemsize + 7) // 8 * 8
+
+    header = {
+      'identity':   identity,
+      'signature':  self.signature,
+      'byteorder':  sys.byteorder,
+      'rows':       len(columns['line']),
+      'line_count': count,
+      'columns':    layout
+    }
+
+    header_data = json.dumps(header).encode()
+    cache_path  = self.get_cache_path(sfile)
+
+    try:
+      os.makedirs(self.cache_dir, exist_ok = True)
+      with open(cache_path + '.tmp', 'wb') as f:
+        f.write(self.magic + self.version.to_bytes(4, 'little') + len(header_data).to_bytes(4, 'little') + header_data)
+        f.write(bytes(-f.tell() % 8))
+        for column in columns.values():
+          data = column.tobytes()
+          f.write(data + bytes(-len(data) % 8))
+      os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+      self.txt.print_verbose('Parse cache', 'could not save cache file ' + cache_path, str(e))
+      return None
+
+    header['data_start'] = (12 + len(header_data) + 7) // 8 * 8
+    return header
+
+  """
+  Get string table of a string column
+  """
+  def get_strings(self, views, key):
+    return string_table(views[key + '.offsets'], views[key + '.strings'])
+
+  """
+  Get line numbers of invalid lines of a cache file
+  """
+  def get_invalid(self, sfile, header):
+
+    code, offset, count = header['columns']['invalid']
+    invalid             = array.array(code)
+
+    with open(self.get_cache_path(sfile), 'rb') as f:
+      f.seek(header['data_start'] + offset)
+      invalid.frombytes(f.read(count * invalid.itemsize))
+
+    return invalid.tolist()
+
+  """
+  Memory-map columns of a cache file
+  Returns the file, its memory map and views of its columns, to be closed with close_columns()
+  """
+  def open_columns(self, sfile, header):
+
+    f     = open(self.get_cache_path(sfile), 'rb')
+    data  = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    view  = memoryview(data)
+    views = {}
+
+    for key, (code, offset, count) in header['columns'].items():
+      start      = header['data_start'] + offset
+      views[key] = view[start:start + count * array.array(code).itemsize].cast(code)
+
+    return f, data, view, views
+
+  def close_columns(self, f, data, view, views):
+    for i in views.values():
+      i.release()
+    view.release()
+    data.close()
+    f.close()
+
+  """
+  Evaluate a where expression on cached columns
+  Returns row numbers of matching log entries. String conditions are evaluated on string tables.
+  """
+  def get_where_rows(self, header, views, where):
+    return where.np.flatnonzero(self.get_where_mask(header, views, where)).tolist()
+
+  """
+  Evaluate a where expression on cached columns as a boolean mask of rows
+  """
+  def get_where_mask(self, header, views, where):
+
+    np      = where.np
+    columns = {}
+
+    for field in where.fields:
+      if field == 'time':
+        columns[field] = np.frombuffer(views['timestamp'], dtype = np.int64)
+      elif field == 'http_status':
+        column         = np.frombuffer(views['status'], dtype = np.uint16)
+        columns[field] = np.where(column > 0, column, np.nan)
+      elif field in self.string_columns:
+        columns[field] = (np.frombuffer(views[field], dtype = np.uint32), self.get_strings(views, field))
+      else:
+        column         = np.frombuffer(views[field], dtype = np.int64)
+        columns[field] = np.where(column >= 0, column, np.nan)
+
+    # Arrays on the memory-mapped columns are released on return, before the columns are closed
+    return np.asarray(where.get_mask(columns), dtype = bool)
+
+  """
+  Count values of columns in log entries of a cache file with NumPy, without building log entries
+  Log entries are selected as in read(). Returns the number of selected log entries, and (value, count)
+  pairs of each column in order of the first log entry of each value.
+  """
+  def count_values(self, sfile, header, keys, time_lower = None, time_upper = None, statuses = None, where = None):
+
+    columns = self.open_columns(sfile, header)
+
+    try:
+      return self.get_value_counts(header, columns[3], keys, time_lower, time_upper, statuses, where)
+    finally:
+      self.close_columns(*columns)
+
+  def get_value_counts(self, header, views, keys, time_lower, time_upper, statuses, where):
+
+    np   = self.np
+    mask = np.ones(header['rows'], dtype = bool)
+
+    if where is not None:
+      mask = self.get_where_mask(header, views, where)
+
+    timestamps = np.frombuffer(views['timestamp'], dtype = np.int64)
+    if time_lower is not None:
+      mask &= timestamps > time_lower
+    if time_upper is not None:
+      mask &= timestamps < time_upper
+
+    if statuses is not None:
+      mask &= np.isin(np.frombuffer(views['status'], dtype = np.uint16), list(statuses))
+
+    epoch  = datetime(1970, 1, 1)
+    counts = []
+
+    for key in keys:
+      column = np.frombuffer(views[key], dtype = views[key].format)[mask]
+
+      # Distinct values are sorted: they are put back in order of their first log entry
+      values, first, value_counts = np.unique(column, return_index = True, return_counts = True)
+      order        = np.argsort(first)
+      values       = values[order].tolist()
+      value_counts = value_counts[order].tolist()
+
+      if key in self.string_columns:
+        strings = self.get_strings(views, key)
+        values  = [strings[i] for i in values]
+      elif key == 'timestamp':
+        values  = [epoch + timedelta(seconds = i) for i in values]
+      elif key == 'status':
+        values  = [i or None for i in values]
+      else:
+        values  = [i if i >= 0 else None for i in values]
+
+      counts.append(list(zip(values, value_counts)))
+
+    # Arrays on the memory-mapped columns are released on return, before the columns are closed
+    return int(np.count_nonzero(mask)), counts
+
+  """
+  Read log entries of a cache file
+  Columns are memory-mapped, and only log entries within time bounds, of given status codes and
+  matching a where expression are built
+  """
+  def read(self, sfile, header, time_lower = None, time_upper = None, statuses = None, where = None):
+
+    columns = self.open_columns(sfile, header)
+    views   = columns[3]
+
+    try:
+      lines        = views['line']
+      timestamps   = views['timestamp']
+      status_codes = views['status']
+      hosts        = views['remote_host']
+      user_agents  = views['user_agent']
+      requests     = views['http_request']
+      bytes_in     = views['bytes_in']
+      bytes_out    = views['bytes_out']
+      durations    = views['duration']
+
+      # Strings of other than given fields are missing
+      strings = {}
+      for key in self.string_columns:
+        if self.fields is None or key in self.fields:
+          strings[key] = self.get_strings(views, key).__getitem__
+        else:
+          strings[key] = lambda index: None
+
+      get_host_name    = strings['remote_host']
+      get_user_agent   = strings['user_agent']
+      get_request_line = strings['http_request']
+
+      epoch          = datetime(1970, 1, 1)
+      prev_timestamp = None
+      time           = None
+
+      rows = range(header['rows'])
+      if where is not None:
+        rows = self.get_where_rows(header, views, where)
+
+      for i in rows:
+
+        timestamp = timestamps[i]
+        if time_lower is not None and timestamp <= time_lower:
+          continue
+        if time_upper is not None and timestamp >= time_upper:
+          continue
+
+        status = status_codes[i] or None
+        if statuses is not None and status not in statuses:
+          continue
+
+        # Consecutive log entries share timestamps
+        if timestamp != prev_timestamp:
+          time           = epoch + timedelta(seconds = timestamp)
+          prev_timestamp = timestamp
+
+        yield lines[i], {
+          'time':         time,
+          'timestamp':    timestamp,
+          'user_agent':   get_user_agent(user_agents[i]),
+          'http_request': get_request_line(requests[i]),
+          'remote_host':  get_host_name(hosts[i]),
+          'status':       status,
+          'bytes_in':     bytes_in[i] if bytes_in[i] >= 0 else None,
+          'bytes_out':    bytes_out[i] if bytes_out[i] >= 0 else None,
+          'duration':     durations[i] if durations[i] >= 0 else None
+        }
+
+    finally:
+      self.close_columns(*columns)
+
+class run_state(object):
+
+  """
+  Init
+  Checkpoint of processed log files, stored as a JSON file between runs
+  Files are identified by device, inode and hash of their first block, so that files renamed
+  or compressed by logrotate are still recognised
+  """
+  def __init__(self, txt, fp, state_file, sessions, block_size = 4096):
+    self.version    = 1
+    self.txt        = txt
+    self.fp         = fp
+    self.state_file = state_file
+    self.sessions   = sessions
+    self.block_size = block_size
+    self.files      = []
+
+  """
+  Load state file
+  """
+  def load(self):
+
+    try:
+      with open(self.state_file, 'r') as f:
+        state = json.load(f)
+    except FileNotFoundError:
+      return []
+    except (OSError, ValueError) as e:
+      self.txt.print_verbose('State', 'could not read state file ' + self.state_file, str(e))
+      return []
+
+    if state.get('version') != self.version:
+      return []
+
+    # Sessions continue from the previous run
+    self.sessions.load(state.get('sessions', []), state.get('next_session_id', 1))
+
+    return state['files']
+
+  """
+  Save state file
+  """
+  def save(self):
+
+    files = []
+
+    for lfile in self.files:
+
+      identity = lfile.get('identity') or self.get_identity(lfile['file'], lfile['compression'])
+      if identity is None:
+        continue
+
+      line_count = lfile['line_count'] or 0
+
+      files.append(dict(identity, **{
+        'file':     lfile['file'],
+        'offset':   lfile['offset_read'],
+        'line_end': lfile['line_start'] + line_count - 1,
+        'complete': lfile['compression'] is not None
+      }))
+
+    state = {
+      'version':         self.version,
+      'files':           files,
+      'sessions':        self.sessions.dump(),
+      'next_session_id': self.sessions.next_session_id
+    }
+
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok = True)
+      with open(self.state_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+      os.replace(self.state_file + '.tmp', self.state_file)
+    except OSError as e:
+      raise Exception("Couldn't write state file '{}': {}".format(self.state_file, str(e)))
+
+  """
+  Get identity of a log file: device, inode and hash of the first block of (decompressed) data
+  Returns None for empty files
+  """
+  def get_identity(self, sfile, compression, length = None):
+
+    if length is None:
+      length = self.block_size
+
+    st = os.stat(sfile)
+
+    with self.fp.open_file(sfile, compression) as f:
+      block = f.read(length)
+
+    if len(block) == 0:
+      return None
+
+    return {
+      'device':       st.st_dev,
+      'inode':        st.st_ino,
+      'block_length': len(block),
+      'block_hash':   hashlib.sha1(block).hexdigest()
+    }
+
+  """
+  Get size of an uncompressed log file up to the end of its last complete line
+  """
+  def get_complete_size(self, sfile, size, block_size = 65536):
+
+    with open(sfile, 'rb') as f:
+      position = size
+      while position > 0:
+        start = max(position - block_size, 0)
+        f.seek(start)
+        block = f.read(position - start)
+        i     = block.rfind(b'\n')
+        if i >= 0:
+          return start + i + 1
+        position = start
+
+    return 0
+
+  """
+  Find state of a log file
+  Files with the same first block are the same file, possibly renamed or compressed.
+  Same device and inode with a different first block is a new file reusing the inode.
+  """
+  def find_state(self, lfile, saved_files):
+
+    identities = {self.block_size: lfile['identity']}
+
+    for saved in saved_files:
+
+      if saved['block_length'] not in identities:
+        identities[saved['block_length']] = self.get_identity(lfile['file'], lfile['compression'], saved['block_length'])
+
+      identity = identities[saved['block_length']]
+      if identity is None or identity['block_hash'] != saved['block_hash']:
+        continue
+
+      if identity['device'] != saved['device'] or identity['inode'] != saved['inode']:
+        self.txt.print_verbose('State', 'renamed or compressed', saved['file'], lfile['file'])
+
+      return saved
+
+    return None
+
+  """
+  Set start offsets of input files to the offsets processed on the previous run
+  Returns input files with unprocessed data
+  """
+  def resume(self, files):
+
+    saved_files = self.load()
+    files_new   = []
+
+    for lfile in files:
+
+      lfile['identity'] = self.get_identity(lfile['file'], lfile['compression'])
+
+      # Incomplete last line of a file being written is left for the next run
+      if lfile['compression'] is None:
+        lfile['offset_end'] = self.get_complete_size(lfile['file'], lfile['size'])
+
+      saved = self.find_state(lfile, saved_files)
+
+      if saved is not None:
+        saved_files.remove(saved)
+
+        # Truncated file is processed from the start
+        if lfile['compression'] is None and saved['offset'] > lfile['offset_end']:
+          saved = None
+
+      if saved is not None:
+        lfile['offset_start'] = saved['offset']
+        lfile['line_start']   = saved['line_end'] + 1
+
+      lfile['offset_read'] = lfile['offset_start']
+      self.files.append(lfile)
+
+      # Compressed files don't change once they have been processed
+      if saved is not None and (saved['complete'] or lfile['offset_start'] == lfile['offset_end']):
+        self.txt.print_verbose('State', 'no new data', lfile['file'])
+        continue
+
+      files_new.append(lfile)
+
+    self.txt.print_verbose('State files', *['{:s} (offset: {:d})'.format(i['file'], i['offset_start']) for i in files_new])
+    return files_new
+
+class lazy_entry(dict):
+
+  """
+  Init
+  Log entry data converted from raw field values on first access
+  """
+  def __init__(self, converters, values):
+    super().__init__()
+    self.converters = converters
+    self.values     = values
+
+  def __missing__(self, key):
+
+    if key not in self.converters:
+      raise KeyError(key)
+
+    index, converter = self.converters[key]
+
+    value = None
+    if index is not None:
+      value = converter(self.values[index])
+
+    self[key] = value
+    return value
+
+class fast_parser(object):
+
+  """
+  Init
+  Parser compiling a LogFormat string into a single regular expression, capturing only projected fields.
+  Fields are converted lazily, when they are accessed.
+  Raises ValueError for log formats which are not supported.
+  """
+  def __init__(self, log_format, fields = None):
+
+    self.log_format = log_format
+    self.months     = {
+      'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,  'May': 5,  'Jun': 6,
+      'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+    }
+    self.escape_pattern = re.compile(r'\\(x[0-9A-Fa-f]{2}|.)')
+
+    self.time_cache      = {}
+    self.time_cache_size = 4096
+    self.epoch           = datetime(1970, 1, 1)
+    self.second          = timedelta(seconds = 1)
+
+    string_rgx = r'(?:[^"\\]|\\.)*'
+    word_rgx   = r'\S+'
+    int_rgx    = r'-?[0-9]+'
+    time_rgx   = r'\[[0-9]{2}/(?:' + '|'.join(self.months) + r')/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2} [+-][0-9]{4}\]'
+
+    # Directive: (regex, quoted string)
+    directives = {
+      'h': (word_rgx, False),
+      'a': (word_rgx, False),
+      'A': (word_rgx, False),
+      'l': (word_rgx, False),
+      'u': (word_rgx, False),
+      'v': (word_rgx, False),
+      'V': (word_rgx, False),
+      't': (time_rgx, False),
+      'r': (string_rgx, True),
+      's': (r'[0-9]{3}|-', False),
+      'b': (r'[0-9]+|-', False),
+      'B': (int_rgx, False),
+      'D': (int_rgx, False),
+      'T': (int_rgx, False),
+      'I': (int_rgx, False),
+      'O': (int_rgx, False),
+      'S': (int_rgx, False),
+      'p': (int_rgx, False),
+      'P': (int_rgx, False),
+      'k': (int_rgx, False),
+      'i': (string_rgx, True),
+      'o': (string_rgx, True)
+    }
+
+    # Entry data key: (directive candidates in order of preference, converter)
+    entry_fields = {
+      'time':         (['%t'], self.convert_time),
+      'timestamp':    (['%t'], self.convert_timestamp),
+      'user_agent':   (['%{user-agent}i'], self.convert_clf_string),
+      'http_request': (['%r'], self.convert_request_line),
+      'remote_host':  (['%h'], self.unescape),
+      'status':       (['%>s', '%s', '%<s'], self.convert_status),
+      'bytes_in':     (['%I'], self.convert_bytes),
+      'bytes_out':    (['%O', '%b', '%B'], self.convert_bytes),
+      'duration':     (['%D', '%{us}T', '%{ms}T', '%T', '%{s}T'], self.convert_duration)
+    }
+
+    # Request duration directive: microseconds per unit
+    self.duration_units = {'%D': 1, '%{us}T': 1, '%{ms}T': 1000, '%T': 1000000, '%{s}T': 1000000}
+    self.duration_unit  = None
+
+    if fields is None:
+      fields = list(entry_fields.keys())
+
+    tokens = []
+    pos    = 0
+    for m in re.finditer(r'%([<>]?)(?:\{([^}]*)\})?([a-zA-Z%])', log_format):
+      tokens.append(('literal', log_format[pos:m.start()]))
+      tokens.append(('directive', m))
+      pos = m.end()
+    tokens.append(('literal', log_format[pos:]))
+
+    names = []
+    for token_type, value in tokens:
+      if token_type == 'literal':
+        if '%' in value:
+          raise ValueError("Unsupported log format directive in '{}'".format(value))
+        names.append(None)
+        continue
+      modifier, param, directive = value.groups()
+      if directive == '%':
+        names.append(None)
+        continue
+      if directive not in directives or (param is not None and directive not in ['i', 'o', 'T']):
+        raise ValueError("Unsupported log format directive '{}'".format(value.group(0)))
+      if directive == 'T' and param is not None:
+        if param not in ['s', 'ms', 'us']:
+          raise ValueError("Unsupported log format directive '{}'".format(value.group(0)))
+        names.append('%{' + param + '}T')
+      elif directive in ['i', 'o']:
+        names.append('%{' + param.lower() + '}' + directive)
+      else:
+        names.append('%' + modifier + directive)
+
+    self.tokens       = tokens
+    self.names        = names
+    self.directives   = directives
+    self.entry_fields = entry_fields
+
+    if 'time' in fields and self.get_token_index('time') is None:
+      raise ValueError("Log format has no %t directive")
+
+    if self.get_token_index('duration') is not None:
+      self.duration_unit = self.duration_units[self.names[self.get_token_index('duration')]]
+
+    # Directive of each projected field
+    projected = {}
+    for key in fields:
+      i = self.get_token_index(key)
+      if i is not None and i not in projected:
+        projected[i] = key
+
+    self.rgx, self.groups = self.compile_layout(projected)
+
+    # Fields of the same directive share a group
+    self.converters = {}
+    for key, (candidates, converter) in entry_fields.items():
+      self.converters[key] = (self.groups.get(projected.get(self.get_token_index(key))), converter)
+
+  """
+  Get index of the log format token holding an entry data field, None if the log format has no such field
+  """
+  def get_token_index(self, key):
+
+    for candidate in self.entry_fields[key][0]:
+      if candidate in self.names:
+        return self.names.index(candidate)
+
+    return None
+
+  """
+  Compile log format tokens into a regular expression, capturing only given tokens
+  Tokens after the end token are left out: the expression then matches only the beginning of log lines
+  """
+  def compile_layout(self, captures, end = None):
+
+    rgx    = ''
+    group  = 0
+    groups = {}
+
+    for i, (token_type, value) in enumerate(self.tokens):
+
+      if end is not None and i > end:
+        break
+
+      if token_type == 'literal':
+        rgx += re.escape(value)
+        continue
+
+      if value.group(3) == '%':
+        rgx += '%'
+        continue
+
+      directive_rgx, quoted = self.directives[value.group(3)]
+
+      # Quoted strings may contain spaces, and must be delimited by quotes
+      if quoted and not (self.tokens[i - 1][1].endswith('"') and self.tokens[i + 1][1].startswith('"')):
+        raise ValueError("Unquoted log format directive '{}'".format(value.group(0)))
+
+      if i in captures:
+        rgx += '(' + directive_rgx + ')'
+        groups[captures[i]] = group
+        group += 1
+      else:
+        rgx += '(?:' + directive_rgx + ')'
+
+    return re.compile(rgx), groups
+
+  """
+  Compile a regular expression matching log lines only up to the given entry data fields
+  Returns None if the log format lacks any of the fields
+  """
+  def compile_prefix(self, keys):
+
+    captures = {}
+    for key in keys:
+      i = self.get_token_index(key)
+      if i is None:
+        return None
+      captures[i] = key
+
+    return self.compile_layout(captures, max(captures.keys()))
+
+  """
+  Parse a single log line into lazily converted log entry data
+  Raises InvalidEntryError for lines not matching the log format
+  """
+  def parse(self, line):
+
+    line = line.rstrip('\r\n')
+    m    = self.rgx.fullmatch(line)
+
+    if m is None:
+      raise InvalidEntryError(line, self.log_format)
+
+    return lazy_entry(self.converters, m.groups())
+
+  """
+  Unescape backslash escape sequences written by Apache HTTPD, including hexadecimal ones
+  """
+  def unescape(self, s):
+    if '\\' not in s:
+      return s
+    return self.escape_pattern.sub(self.unescape_sequence, s)
+
+  def unescape_sequence(self, m):
+    esc = m.group(1)
+    if esc[0] == 'x':
+      return chr(int(esc[1:], 16))
+    return {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'v': '\v', 'f': '\f'}.get(esc, esc)
+
+  """
+  Timestamp [10/Oct/2000:13:55:36 -0700] to a naive datetime in local time of the log entry,
+  and to seconds since epoch of the naive datetime.
+  Consecutive log entries share timestamps: converted timestamps are cached, and the cache is
+  cleared when it is full.
+  """
+  def get_time(self, s):
+
+    value = self.time_cache.get(s)
+
+    if value is None:
+      if len(self.time_cache) >= self.time_cache_size:
+        self.time_cache.clear()
+
+      time  = datetime(int(s[8:12]), self.months[s[4:7]], int(s[1:3]), int(s[13:15]), int(s[16:18]), int(s[19:21]))
+      value = (time, (time - self.epoch) // self.second)
+      self.time_cache[s] = value
+
+    return value
+
+  def convert_time(self, s):
+    return self.get_time(s)[0]
+
+  def convert_timestamp(self, s):
+    return self.get_time(s)[1]
+
+  def convert_clf_string(self, s):
+    if s == '-':
+      return None
+    return self.unescape(s)
+
+  def convert_request_line(self, s):
+    return str(self.convert_clf_string(s)).encode('unicode_escape').decode()
+
+  def convert_status(self, s):
+    if s == '-':
+      return None
+    return int(s)
+
+  def convert_bytes(self, s):
+    if s == '-':
+      return 0
+    return int(s)
+
+  def convert_duration(self, s):
+    return int(s) * self.duration_unit
+
+class network_classifier(object):
+
+  """
+  Init
+  Classifier of hosts belonging to local networks, given in CIDR notation
+  Networks are stored as sorted and merged integer address ranges, and results are cached by host
+  """
+  def __init__(self, networks, cache_size = 65536):
+
+    self.networks   = []
+    self.ranges     = {4: [], 6: []}
+    self.starts     = {}
+    self.cache      = {}
+    self.cache_size = cache_size
+
+    for network in networks:
+      try:
+        network = ipaddress.ip_network(network.strip(), strict = False)
+      except ValueError:
+        raise Exception("Invalid local network: {}".format(network))
+
+      self.networks.append(network)
+      self.ranges[network.version].append([int(network.network_address), int(network.broadcast_address)])
+
+    for version, ranges in self.ranges.items():
+      merged = []
+      for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+          merged[-1][1] = max(merged[-1][1], end)
+        else:
+          merged.append([start, end])
+
+      self.ranges[version] = merged
+      self.starts[version] = [i[0] for i in merged]
+
+  """
+  Check whether a host belongs to local networks
+  Host names are never local
+  """
+  def is_local(self, host):
+
+    local = self.cache.get(host)
+
+    if local is None:
+      if len(self.cache) >= self.cache_size:
+        self.cache.clear()
+
+      local = self.lookup(host)
+      self.cache[host] = local
+
+    return local
+
+  def lookup(self, host):
+
+    try:
+      address = ipaddress.ip_address(host)
+    except ValueError:
+      return False
+
+    if address.version == 6 and address.ipv4_mapped is not None:
+      address = address.ipv4_mapped
+
+    version = address.version
+    address = int(address)
+    i       = bisect.bisect_right(self.starts[version], address) - 1
+
+    return i >= 0 and address <= self.ranges[version][i][1]
+
+class entry_parser(object):
+
+  """
+  Log entry data keys
+  """
+  entry_keys = ['time', 'timestamp', 'user_agent', 'http_request', 'remote_host', 'status', 'bytes_in', 'bytes_out', 'duration']
+
+  """
+  Init
+  Parser of raw log lines into log entry data
+  Fast parser is used if it supports the log format, apachelogs LogParser otherwise
+  """
+  def __init__(self, log_format, local_networks, engine = 'fast', fields = None):
+
+    # Remove bytes in & out fields, with their separators, from local traffic pattern
+    log_format_local = re.sub(r'\s*%[IO]', '', log_format).strip()
+
+    self.log_format       = log_format
+    self.log_format_local = log_format_local
+    self.engine           = 'apachelogs'
+    self.local_networks   = local_networks
+
+    # Remote host of raw log lines, to choose parser for local traffic. First field by default.
+    self.host_rgx = None
+    try:
+      prefix = fast_parser(log_format, []).compile_prefix(['remote_host'])
+      if prefix is not None:
+        self.host_rgx = prefix[0]
+    except ValueError:
+      pass
+
+    if engine == 'fast':
+      try:
+        self.parser       = fast_parser(log_format, fields)
+        self.parser_local = fast_parser(log_format_local, fields)
+        self.engine       = 'fast'
+        return
+      except ValueError as e:
+        self.unsupported = str(e)
+
+    self.parser       = LogParser(log_format)
+    self.parser_local = LogParser(log_format_local)
+
+  """
+  Parse a single log line
+  Raises InvalidEntryError for lines not matching the log format
+  """
+  def parse(self, line):
+
+    # Local traffic may be logged with bytes in & out fields as well
+    if self.is_local_line(line):
+      try:
+        return self.parse_entry(self.parser_local, line)
+      except InvalidEntryError:
+        pass
+
+    return self.parse_entry(self.parser, line)
+
+  """
+  Parse a single log line with the given parser
+  """
+  def parse_entry(self, parser, line):
+
+    if self.engine == 'fast':
+      return parser.parse(line)
+
+    entry = parser.parse(line)
+    time  = entry.request_time.replace(tzinfo = None)
+
+    return {
+      'time':         time,
+      'timestamp':    (time - datetime(1970, 1, 1)) // timedelta(seconds = 1),
+      'user_agent':   getattr(entry, 'headers_in', {}).get("User-Agent"),
+      'http_request': str(entry.request_line).encode('unicode_escape').decode(),
+      'remote_host':  entry.remote_host,
+      'status':       entry.final_status,
+      'bytes_in':     getattr(entry, 'bytes_in', None),
+      'bytes_out':    self.get_bytes_out(entry),
+      'duration':     self.get_duration(entry)
+    }
+
+  """
+  Get bytes sent of an apachelogs log entry, including headers if logged
+  """
+  def get_bytes_out(self, entry):
+
+    if getattr(entry, 'bytes_out', None) is not None:
+      return entry.bytes_out
+
+    # Response size of "-" is logged for empty responses
+    if hasattr(entry, 'bytes_sent'):
+      return entry.bytes_sent or 0
+
+    return None
+
+  """
+  Get request duration of an apachelogs log entry in microseconds
+  """
+  def get_duration(self, entry):
+
+    for attr, unit in [('request_duration_microseconds', 1), ('request_duration_milliseconds', 1000), ('request_duration_seconds', 1000000)]:
+      value = getattr(entry, attr, None)
+      if value is not None:
+        return value * unit
+
+    return None
+
+  """
+  Check whether remote host of a raw log line belongs to local networks
+  """
+  def is_local_line(self, line):
+
+    m = None
+    if self.host_rgx is not None:
+      m = self.host_rgx.match(line)
+
+    if m is not None:
+      host = m.group(1)
+    else:
+      host = line.split(' ', 1)[0]
+
+    return self.local_networks.is_local(host)
+
+  """
+  Get filter of raw log lines for status code and date filters
+  Returns None if there is nothing to filter or the log format layout is not supported
+  """
+  def get_line_filter(self, codes, date_lower, date_upper):
+
+    keys = []
+    if len(codes) > 0:
+      keys.append('status')
+    if date_lower is not None or date_upper is not None:
+      keys.append('time')
+
+    if len(keys) == 0:
+      return None
+
+    try:
+      layout       = fast_parser(self.log_format, [])
+      layout_local = fast_parser(self.log_format_local, [])
+    except ValueError:
+      return None
+
+    # Status code may be missing from the log format, date is still checked
+    prefix       = layout.compile_prefix(keys)
+    prefix_local = layout_local.compile_prefix(keys)
+    if (prefix is None or prefix_local is None) and len(keys) == 2:
+      keys         = ['time']
+      codes        = []
+      prefix       = layout.compile_prefix(keys)
+      prefix_local = layout_local.compile_prefix(keys)
+
+    if prefix is None or prefix_local is None:
+      return None
+
+    return line_filter(prefix, prefix_local, self.is_local_line, codes, date_lower, date_upper)
+
+class line_filter(object):
+
+  """
+  Init
+  Status code and date checks on raw log lines, before lines are parsed.
+  Fields are located with a regular expression matching only the beginning of log lines,
+  up to the filtered fields. Dates are compared by day: entries on the boundary days are passed on.
+  Lines not matching the log format are passed on, to be reported as invalid by the parser.
+  """
+  def __init__(self, prefix, prefix_local, is_local_line, codes, date_lower, date_upper):
+
+    self.rgx, self.groups             = prefix
+    self.rgx_local, self.groups_local = prefix_local
+    self.is_local_line                = is_local_line
+    self.months                       = {
+      'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,  'May': 5,  'Jun': 6,
+      'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+    }
+
+    # Status code strings accepted by the status code filter
+    self.codes = None
+    if len(codes) > 0:
+      self.codes = set([str(int(num)) for num, num_ok in codes if num_ok])
+
+    # Days as yyyymmdd integers. Entries at the start of the upper day are already excluded.
+    self.day_lower = None
+    self.day_upper = None
+    if date_lower is not None:
+      self.day_lower = self.get_day(date_lower)
+    if date_upper is not None:
+      self.day_upper = self.get_day(date_upper)
+      if date_upper.time() == datetime.min.time():
+        self.day_upper -= 1
+
+  def get_day(self, date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+  """
+  Check a raw log line
+  Returns False if the line can't match the filters
+  """
+  def check(self, line):
+
+    if self.is_local_line(line):
+      m      = self.rgx_local.match(line)
+      groups = self.groups_local
+    else:
+      m      = self.rgx.match(line)
+      groups = self.groups
+
+    if m is None:
+      return True
+
+    if self.codes is not None and m.group(groups['status'] + 1) not in self.codes:
+      return False
+
+    if 'time' in groups:
+      s   = m.group(groups['time'] + 1)
+      day = int(s[8:12]) * 10000 + self.months[s[4:7]] * 100 + int(s[1:3])
+      if self.day_lower is not None and day < self.day_lower:
+        return False
+      if self.day_upper is not None and day > self.day_upper:
+        return False
+
+    return True
+
+class where_expression(object):
+
+  """
+  Init
+  Filter expression on log entry fields, e.g. 'status >= 500 and time > 2026-10-01 and country != "Local"'
+  Comparisons (==, !=, <, <=, >, >=, regular expression match ~ and !~) are combined with and, or, not
+  and parentheses. Times are given in ISO format, and strings in quotes.
+  With NumPy, expressions are evaluated on batches of log entries as boolean masks over field columns.
+  String conditions are evaluated once per distinct value. Without NumPy, entries are checked one by one.
+  """
+  def __init__(self, expression):
+
+    self.expression = expression
+    self.fields     = set()
+
+    # Field: type. Status is accepted as an alias of http_status.
+    self.field_types = {
+      'http_status':   'number',
+      'bytes_in':      'number',
+      'bytes_out':     'number',
+      'duration':      'number',
+      'time':          'time',
+      'remote_host':   'string',
+      'country':       'string',
+      'city':          'string',
+      'user_agent':    'string',
+      'http_request':  'string',
+      'log_file_name': 'string'
+    }
+    self.aliases = {'status': 'http_status'}
+
+    # Field: log entry key of parsed fields
+    self.entry_keys = {
+      'http_status':  'status',
+      'time':         'timestamp',
+      'remote_host':  'remote_host',
+      'user_agent':   'user_agent',
+      'http_request': 'http_request',
+      'bytes_in':     'bytes_in',
+      'bytes_out':    'bytes_out',
+      'duration':     'duration'
+    }
+
+    self.operators = {
+      '==': lambda a, b: a == b,
+      '!=': lambda a, b: a != b,
+      '<':  lambda a, b: a < b,
+      '<=': lambda a, b: a <= b,
+      '>':  lambda a, b: a > b,
+      '>=': lambda a, b: a >= b
+    }
+
+    self.token_rgx = re.compile(
+      r'\s*(?:("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|(==|!=|<=|>=|!~|<|>|=|~|\(|\))|([^\s()<>=!~"\']+))'
+    )
+
+    self.tokens = self.tokenize(expression)
+    self.pos    = 0
+    self.tree   = self.parse_or()
+
+    if self.pos < len(self.tokens):
+      raise Exception("Invalid where expression: unexpected '{}'.".format(self.tokens[self.pos][1]))
+
+    try:
+      import numpy
+      self.np = numpy
+    except ImportError:
+      self.np = None
+
+  """
+  Split an expression into (kind, text) tokens
+  """
+  def tokenize(self, expression):
+
+    tokens = []
+    pos    = 0
+    end    = len(expression.rstrip())
+
+    while pos < end:
+      m = self.token_rgx.match(expression, pos)
+      if m is None or m.end() == pos:
+        raise Exception("Invalid where expression: unexpected '{}'.".format(expression[pos:].strip()))
+      if m.group(1) is not None:
+        tokens.append(('string', re.sub(r'\\(.)', r'\1', m.group(1)[1:-1])))
+      elif m.group(2) is not None:
+        tokens.append(('op', '==' if m.group(2) == '=' else m.group(2)))
+      else:
+        word = m.group(3)
+        tokens.append(('keyword' if word.lower() in ['and', 'or', 'not'] else 'word', word))
+      pos = m.end()
+
+    return tokens
+
+  def peek(self):
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos]
+    return (None, None)
+
+  def next_token(self, description):
+    if self.pos >= len(self.tokens):
+      raise Exception("Invalid where expression: expected {} at the end.".format(description))
+    self.pos += 1
+    return self.tokens[self.pos - 1]
+
+  def is_keyword(self, keyword):
+    kind, text = self.peek()
+    return kind == 'keyword' and text.lower() == keyword
+
+  """
+  Parse expressions by precedence: or, and, not, comparisons and parentheses
+  """
+  def parse_or(self):
+    node = self.parse_and()
+    while self.is_keyword('or'):
+      self.pos += 1
+      node = ('or', node, self.parse_and())
+    return node
+
+  def parse_and(self):
+    node = self.parse_not()
+    while self.is_keyword('and'):
+      self.pos += 1
+      node = ('and', node, self.parse_not())
+    return node
+
+  def parse_not(self):
+
+    if self.is_keyword('not'):
+      self.pos += 1
+      return ('not', self.parse_not())
+
+    if self.peek() == ('op', '('):
+      self.pos += 1
+      node = self.parse_or()
+      if self.next_token("')'") != ('op', ')'):
+        raise Exception("Invalid where expression: expected ')'.")
+      return node
+
+    return self.parse_comparison()
+
+  def parse_comparison(self):
+
+    kind, field = self.next_token('a field name')
+    if kind != 'word':
+      raise Exception("Invalid where expression: expected a field name, got '{}'.".format(field))
+
+    field = self.aliases.get(field, field)
+    if field not in self.field_types:
+      raise Exception("Unknown where field: {}. Accepted values: {}".format(
+        field, ','.join(list(self.aliases.keys()) + list(self.field_types.keys())))
+      )
+
+    kind, op = self.next_token('an operator')
+    if kind != 'op' or op in ['(', ')']:
+      raise Exception("Invalid where expression: expected an operator after '{}', got '{}'.".format(field, op))
+
+    kind, value = self.next_token('a value')
+    if kind not in ['word', 'string']:
+      raise Exception("Invalid where expression: expected a value after '{} {}', got '{}'.".format(field, op, value))
+
+    self.fields.add(field)
+    return ('cmp', field, op, self.get_value(field, op, value))
+
+  """
+  Convert a value to the type of its field
+  Times are compared as seconds since epoch, as log entry timestamps
+  """
+  def get_value(self, field, op, value):
+
+    field_type = self.field_types[field]
+
+    if op in ['~', '!~']:
+      if field_type != 'string':
+        raise Exception("Regular expression match can only be used with string fields, not {}.".format(field))
+      try:
+        return re.compile(value)
+      except re.error as e:
+        raise Exception("Invalid regular expression '{}': {}".format(value, e))
+
+    try:
+      if field_type == 'number':
+        return float(value)
+      if field_type == 'time':
+        return (datetime.fromisoformat(value) - datetime(1970, 1, 1)) // timedelta(seconds = 1)
+    except (ValueError, TypeError):
+      raise Exception("Invalid {} value for {}: {}".format(field_type, field, value))
+
+    return value
+
+  """
+  Compare a single value
+  Missing values only match != and !~
+  """
+  def compare(self, a, op, b):
+
+    if a is None:
+      return op in ['!=', '!~']
+    if op == '~':
+      return b.search(a) is not None
+    if op == '!~':
+      return b.search(a) is None
+
+    return self.operators[op](a, b)
+
+  """
+  Whether the expression uses geo location fields
+  """
+  def uses_geo(self):
+    return 'country' in self.fields or 'city' in self.fields
+
+  """
+  Get a field value of a log entry
+  """
+  def get_entry_value(self, field, lfile, entry_data):
+
+    if field in self.entry_keys:
+      return entry_data[self.entry_keys[field]]
+    if field == 'log_file_name':
+      return lfile['file']
+
+    # Country and city
+    geo_data = entry_data.get('geo_data')
+    if geo_data is None:
+      return None
+    return geo_data['host_' + field]
+
+  """
+  Check a single log entry
+  """
+  def check(self, lfile, entry_data, node = None):
+
+    if node is None:
+      node = self.tree
+
+    if node[0] == 'and':
+      return self.check(lfile, entry_data, node[1]) and self.check(lfile, entry_data, node[2])
+    if node[0] == 'or':
+      return self.check(lfile, entry_data, node[1]) or self.check(lfile, entry_data, node[2])
+    if node[0] == 'not':
+      return not self.check(lfile, entry_data, node[1])
+
+    field, op, value = node[1:]
+    return self.compare(self.get_entry_value(field, lfile, entry_data), op, value)
+
+  """
+  Get field columns of a batch of log entries
+  Numbers are floats with missing values as NaN, and strings are (indices, distinct values) pairs.
+  """
+  def get_columns(self, batch):
+
+    np      = self.np
+    columns = {}
+
+    for field in self.fields:
+      if field in self.entry_keys:
+        key    = self.entry_keys[field]
+        values = [entry_data[key] for lfile, line_num, entry_data in batch]
+      else:
+        values = [self.get_entry_value(field, lfile, entry_data) for lfile, line_num, entry_data in batch]
+
+      field_type = self.field_types[field]
+
+      if field_type == 'number':
+        columns[field] = np.array(values, dtype = float)
+      elif field_type == 'time':
+        columns[field] = np.array(values, dtype = np.int64)
+      else:
+        table          = {}
+        indices        = np.fromiter((table.setdefault(i, len(table)) for i in values), np.int64, len(values))
+        columns[field] = (indices, list(table.keys()))
+
+    return columns
+
+  """
+  Evaluate the expression on field columns as a boolean mask
+  """
+  def get_mask(self, columns, node = None):
+
+    np = self.np
+
+    if node is None:
+      node = self.tree
+
+    if node[0] == 'and':
+      return self.get_mask(columns, node[1]) & self.get_mask(columns, node[2])
+    if node[0] == 'or':
+      return self.get_mask(columns, node[1]) | self.get_mask(columns, node[2])
+    if node[0] == 'not':
+      return ~self.get_mask(columns, node[1])
+
+    field, op, value = node[1:]
+    column           = columns[field]
+
+    if self.field_types[field] == 'string':
+      indices, table = column
+      table_mask     = np.fromiter((self.compare(i, op, value) for i in table), bool, len(table))
+      return table_mask[indices]
+
+    return np.asarray(self.operators[op](column, value), dtype = bool)
+
+class chunk_worker(object):
+
+  """
+  Worker process instance, set by the process pool initializer
+  """
+  instance = None
+
+  """
+  Init
+  Parser of newline-aligned byte ranges of log files in worker processes
+  """
+  def __init__(self, log_format, local_networks, engine, fields, codes, date_lower, date_upper):
+    self.entry_parser = entry_parser(log_format, local_networks, engine, fields)
+    self.line_filter  = self.entry_parser.get_line_filter(codes, date_lower, date_upper)
+    self.fp           = file_processing()
+
+  """
+  Process pool initializer: one parser per worker process
+  """
+  @classmethod
+  def init(cls, *args):
+    cls.instance = cls(*args)
+
+  """
+  Process pool task
+  """
+  @classmethod
+  def run(cls, chunk):
+    return cls.instance.parse_chunk(chunk)
+
+  """
+  Parse lines of a byte range
+  Returns parsed entries and invalid lines with line indexes local to the chunk, line count of the chunk
+  and offset of the end of the last line read
+  """
+  def parse_chunk(self, chunk):
+
+    sfile, compression, offset_start, offset_end = chunk
+
+    entries       = []
+    invalid_lines = []
+    line_index    = 0
+    position      = offset_start
+
+    with self.fp.open_file(sfile, compression) as f:
+      self.fp.seek_file(f, offset_start)
+
+      for line in f:
+
+        if offset_end is not None and position >= offset_end:
+          break
+        position += len(line)
+
+        line = line.decode('utf-8', 'replace')
+
+        if self.line_filter is not None and not self.line_filter.check(line):
+          line_index += 1
+          continue
+
+        # Lazily converted fields are converted here, in the worker process
+        try:
+          entry_data = self.entry_parser.parse(line)
+          entries.append((line_index, dict([(key, entry_data[key]) for key in entry_parser.entry_keys])))
+        except InvalidEntryError:
+          invalid_lines.append(line_index)
+
+        line_index += 1
+
+    return entries, invalid_lines, line_index, position
+
+class top_counter(object):
+
+  """
+  Init
+  Streaming counter of the most frequent keys
+  Keys are counted exactly up to capacity distinct keys. After that, the Space-Saving algorithm keeps
+  capacity counters: a new key replaces the least frequent key, and inherits its count as an error bound.
+  Counts are then overestimated by at most total count / capacity.
+  """
+  def __init__(self, capacity):
+    self.capacity = max(capacity, 1)
+    self.counts   = {}
+    self.errors   = {}
+    self.heap     = None
+    self.sequence = itertools.count()
+    self.total    = 0
+
+  """
+  Count a key
+  """
+  def add(self, key, count = 1):
+
+    self.total += count
+
+    if key in self.counts:
+      self.counts[key] += count
+      return
+
+    if len(self.counts) < self.capacity:
+      self.counts[key] = count
+      self.errors[key] = 0
+      return
+
+    # Least frequent keys are found with a lazily updated min-heap: stale entries are refreshed when popped.
+    # Heap entries are ordered by count and insertion order, as keys may not be comparable.
+    if self.heap is None:
+      self.heap = [(value, next(self.sequence), i) for i, value in self.counts.items()]
+      heapq.heapify(self.heap)
+
+    while True:
+      min_count, _, min_key = heapq.heappop(self.heap)
+      if self.counts[min_key] == min_count:
+        break
+      heapq.heappush(self.heap, (self.counts[min_key], next(self.sequence), min_key))
+
+    del self.counts[min_key]
+    del self.errors[min_key]
+
+    self.counts[key] = min_count + count
+    self.errors[key] = min_count
+    heapq.heappush(self.heap, (self.counts[key], next(self.sequence), key))
+
+  """
+  Whether counts are approximate
+  """
+  def is_approximate(self):
+    return self.heap is not None
+
+  """
+  Get N most frequent keys as (key, count, error) tuples
+  """
+  def top(self, n):
+    keys = heapq.nlargest(n, self.counts.keys(), key = lambda i: self.counts[i])
+    return [(i, self.counts[i], self.errors[i]) for i in keys]
+
+class hyperloglog(object):
+
+  """
+  Init
+  HyperLogLog sketch for approximate distinct counts, with standard error of 1.04 / sqrt(2 ^ precision)
+  Registers are kept sparse, as register index -> rank, until 1/32 of them are set. Sketches of
+  the same values are merged by taking maximum of their registers.
+  """
+  def __init__(self, precision = 14):
+    if precision < 4 or precision > 18:
+      raise Exception("HyperLogLog precision must be between 4 and 18.")
+    self.precision = precision
+    self.size      = 1 << precision
+    self.mask      = (1 << (64 - precision)) - 1
+    self.sparse    = {}
+    self.registers = None
+
+  """
+  Add a value
+  Register index is taken from the first bits of a 64-bit hash, and rank from leading zeros of the rest
+  """
+  def add(self, value):
+    h = int.from_bytes(hashlib.blake2b(value.encode('utf-8', 'surrogateescape'), digest_size = 8).digest(), 'big')
+    self.set_register(h >> (64 - self.precision), 64 - self.precision - (h & self.mask).bit_length() + 1)
+
+  """
+  Set register rank, if higher than the current one
+  """
+  def set_register(self, index, rank):
+
+    if self.registers is not None:
+      if rank > self.registers[index]:
+        self.registers[index] = rank
+      return
+
+    if rank > self.sparse.get(index, 0):
+      self.sparse[index] = rank
+      if len(self.sparse) > self.size >> 5:
+        self.registers = bytearray(self.size)
+        for i, r in self.sparse.items():
+          self.registers[i] = r
+        self.sparse = None
+
+  """
+  Get (index, rank) pairs of set registers
+  """
+  def items(self):
+    if self.registers is not None:
+      return ((i, r) for i, r in enumerate(self.registers) if r > 0)
+    return self.sparse.items()
+
+  """
+  Merge another sketch of the same precision
+  """
+  def merge(self, other):
+
+    if other.precision != self.precision:
+      raise Exception("Can't merge HyperLogLog sketches of different precision.")
+
+    if self.registers is not None and other.registers is not None:
+      self.registers = bytearray(map(max, self.registers, other.registers))
+      return
+
+    for index, rank in other.items():
+      self.set_register(index, rank)
+
+  """
+  Get an equivalent sketch of lower precision
+  Dropped index bits become leading bits of the rank part of the hash
+  """
+  def fold(self, precision):
+
+    shift  = self.precision - precision
+    sketch = hyperloglog(precision)
+
+    for index, rank in self.items():
+      low = index & ((1 << shift) - 1)
+      if low > 0:
+        rank = shift - low.bit_length() + 1
+      else:
+        rank += shift
+      sketch.set_register(index >> shift, rank)
+
+    return sketch
+
+  """
+  Get estimated distinct count
+  Small counts are estimated with linear counting of empty registers
+  """
+  def count(self):
+
+    if self.registers is not None:
+      zeros = self.registers.count(0)
+      total = sum(2.0 ** -r for r in self.registers)
+    else:
+      zeros = self.size - len(self.sparse)
+      total = zeros + sum(2.0 ** -r for r in self.sparse.values())
+
+    alpha    = {16: 0.673, 32: 0.697, 64: 0.709}.get(self.size, 0.7213 / (1 + 1.079 / self.size))
+    estimate = alpha * self.size * self.size / total
+
+    if estimate <= 2.5 * self.size and zeros > 0:
+      estimate = self.size * math.log(self.size / zeros)
+
+    return int(round(estimate))
+
+  """
+  Serialize registers as base64 encoded, zlib compressed bytes
+  """
+  def serialize(self):
+
+    registers = self.registers
+    if registers is None:
+      registers = bytearray(self.size)
+      for i, r in self.sparse.items():
+        registers[i] = r
+
+    return base64.b64encode(zlib.compress(bytes(registers))).decode('ascii')
+
+  """
+  Deserialize registers
+  """
+  @classmethod
+  def deserialize(cls, precision, data):
+
+    sketch    = cls(precision)
+    registers = zlib.decompress(base64.b64decode(data))
+
+    if len(registers) != sketch.size:
+      raise Exception("Invalid HyperLogLog sketch size: {:d}, expected {:d}.".format(len(registers), sketch.size))
+
+    for i, r in enumerate(registers):
+      if r > 0:
+        sketch.set_register(i, r)
+
+    return sketch
+
+class distinct_counter(object):
+
+  """
+  Init
+  Approximate distinct counts of an output field, grouped by day, country and/or status
+  Each group has its own HyperLogLog sketch. Sketches are stored in a JSON file, so that counts of
+  separate runs can be merged without reading the log files again.
+  """
+  def __init__(self, field, group_by, precision):
+    if precision < 4 or precision > 18:
+      raise Exception("HyperLogLog precision must be between 4 and 18.")
+    self.version   = 1
+    self.field     = field
+    self.group_by  = group_by
+    self.precision = precision
+    self.sketches  = {}
+
+  """
+  Add a value to a group
+  """
+  def add(self, group, value):
+    sketch = self.sketches.get(group)
+    if sketch is None:
+      sketch = self.sketches[group] = hyperloglog(self.precision)
+    sketch.add(value)
+
+  """
+  Merge a sketch to a group
+  Sketches of higher precision are folded to the precision of this counter
+  """
+  def merge_sketch(self, group, sketch):
+
+    if sketch.precision > self.precision:
+      sketch = sketch.fold(self.precision)
+
+    if group in self.sketches:
+      self.sketches[group].merge(sketch)
+    else:
+      self.sketches[group] = sketch
+
+  """
+  Load and merge a sketch file
+  Files grouped by more keys are rolled up to the groups of this counter, e.g. day and country to day.
+  Files of lower precision fold sketches of this counter to the lower precision.
+  """
+  def load(self, sketch_file, missing_ok = False):
+
+    try:
+      with open(sketch_file, 'r') as f:
+        data = json.load(f)
+    except FileNotFoundError:
+      if missing_ok:
+        return
+      raise Exception("Sketch file '{}' not found.".format(sketch_file))
+    except (OSError, ValueError) as e:
+      raise Exception("Couldn't read sketch file '{}': {}".format(sketch_file, str(e)))
+
+    if data.get('version') != self.version:
+      raise Exception("Unsupported sketch file version in '{}'.".format(sketch_file))
+
+    if data['field'] != self.field:
+      raise Exception("Sketch file '{}' counts field {}, not {}.".format(sketch_file, data['field'], self.field))
+
+    missing = [i for i in self.group_by if i not in data['group_by']]
+    if len(missing) > 0:
+      raise Exception("Sketch file '{}' is not grouped by {}.".format(sketch_file, ','.join(missing)))
+
+    group_indices = [data['group_by'].index(i) for i in self.group_by]
+
+    if data['precision'] < self.precision:
+      self.precision = data['precision']
+      self.sketches  = {group: sketch.fold(self.precision) for group, sketch in self.sketches.items()}
+
+    for i in data['sketches']:
+      group = tuple(i['group'][j] for j in group_indices)
+      self.merge_sketch(group, hyperloglog.deserialize(data['precision'], i['registers']))
+
+  """
+  Save sketch file
+  """
+  def save(self, sketch_file):
+
+    data = {
+      'version':   self.version,
+      'field':     self.field,
+      'group_by':  self.group_by,
+      'precision': self.precision,
+      'sketches':  [{'group': list(group), 'registers': sketch.serialize()} for group, sketch in sorted(self.sketches.items())]
+    }
+
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(sketch_file)), exist_ok = True)
+      with open(sketch_file + '.tmp', 'w') as f:
+        json.dump(data, f)
+      os.replace(sketch_file + '.tmp', sketch_file)
+    except OSError as e:
+      raise Exception("Couldn't write sketch file '{}': {}".format(sketch_file, str(e)))
+
+  """
+  Get estimated distinct counts as (group, count) tuples, ordered by group
+  """
+  def counts(self):
+    return [(group, sketch.count()) for group, sketch in sorted(self.sketches.items())]
+
+class quantile_sketch(object):
+
+  """
+  Init
+  DDSketch of a value distribution: quantiles are estimated within the given relative accuracy
+  Positive values are counted in logarithmic bins. If there are more than max_bins bins, the lowest
+  bins are collapsed, so that memory stays bounded and high quantiles stay accurate.
+  """
+  def __init__(self, relative_accuracy = 0.01, max_bins = 2048):
+    self.gamma      = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma  = math.log(self.gamma)
+    self.max_bins   = max_bins
+    self.bins       = {}
+    self.zero_count = 0
+    self.count      = 0
+
+  """
+  Add a value
+  """
+  def add(self, value):
+
+    self.count += 1
+
+    if value <= 0:
+      self.zero_count += 1
+      return
+
+    index = math.ceil(math.log(value) / self.log_gamma)
+    self.bins[index] = self.bins.get(index, 0) + 1
+
+    if len(self.bins) > self.max_bins:
+      count = self.bins.pop(min(self.bins))
+      self.bins[min(self.bins)] += count
+
+  """
+  Get estimated value of quantile q (0-1), None if there are no values
+  """
+  def quantile(self, q):
+
+    if self.count == 0:
+      return None
+
+    rank = q * (self.count - 1)
+    if rank < self.zero_count:
+      return 0
+
+    total = self.zero_count
+    for index in sorted(self.bins):
+      total += self.bins[index]
+      if total > rank:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+class time_rollup(object):
+
+  """
+  Init
+  Log entries counted in time buckets of a minute, an hour or a day: requests, status classes, bytes in & out
+  and request duration quantiles. Memory is bounded by the number of buckets.
+  """
+  def __init__(self, interval, relative_accuracy = 0.01):
+    self.interval          = interval
+    self.relative_accuracy = relative_accuracy
+    self.buckets           = {}
+    self.truncate          = {
+      'minute': {'second': 0, 'microsecond': 0},
+      'hour':   {'minute': 0, 'second': 0, 'microsecond': 0},
+      'day':    {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}
+    }[interval]
 
-import argparse
-import os
-import re
-import subprocess
+  """
+  Count a log entry
+  Missing bytes and durations are not counted
+  """
+  def add(self, time, status, bytes_in, bytes_out, duration):
+
+    start  = time.replace(**self.truncate)
+    bucket = self.buckets.get(start)
+
+    if bucket is None:
+      bucket = self.buckets[start] = {
+        'requests':  0,
+        'status':    [0, 0, 0, 0, 0],
+        'bytes_in':  None,
+        'bytes_out': None,
+        'duration':  quantile_sketch(self.relative_accuracy)
+      }
 
-from datetime import datetime
-from apachelogs import LogParser, InvalidEntryError
+    bucket['requests'] += 1
 
-class text_processing(object):
+    if status is not None and 100 <= status < 600:
+      bucket['status'][status // 100 - 1] += 1
+
+    if bytes_in is not None:
+      bucket['bytes_in'] = (bucket['bytes_in'] or 0) + bytes_in
+
+    if bytes_out is not None:
+      bucket['bytes_out'] = (bucket['bytes_out'] or 0) + bytes_out
+
+    if duration is not None:
+      bucket['duration'].add(duration)
+
+  """
+  Get (bucket start, bucket) tuples, ordered by time
+  """
+  def get_buckets(self):
+    return sorted(self.buckets.items(), key = lambda i: i[0])
+
+class session_table(object):
 
   """
   Init
+  Sessions of remote hosts: a host's session ends when the host has been idle longer than the timeout
+  Hosts are kept in an ordered dict in order of last access, and hosts idle longer than the timeout
+  are evicted from its start, so that the table holds only hosts of open sessions.
   """
-  def __init__(self, verbose):
-    self.show_verbose = verbose
+  def __init__(self, timeout):
+    self.timeout          = timeout
+    self.hosts            = collections.OrderedDict()
+    self.next_session_id  = 1
+    self.peak_size        = 0
+    self.evictions        = 0
+    self.session_count    = 0
+    self.session_requests = 0
+    self.total_duration   = 0
+    self.max_duration     = 0
 
   """
-  Verbose output format (we do not use logger library)
+  Update session of a host with a log entry time
+  Returns time difference to the previous log entry of the host in seconds (None for a new session),
+  and session ID. Log entries may be slightly out of order, so sessions span from the earliest to the
+  latest log entry time.
   """
+  def update(self, host, time):
 
-  def print_verbose(self, prefix='output', *args):
-    if self.show_verbose:
-      print('VERBOSE [{:s}]: {:s}'.format(prefix, ', '.join([str(i) for i in args])))
+    # Session: [session ID, start time, last seen time, log entries on this run, previous log entry time]
+    session   = self.hosts.get(host)
+    time_diff = None
+
+    if session is not None and abs((time - session[2]).total_seconds()) <= self.timeout:
+      time_diff  = (time - session[4]).total_seconds()
+      session[1] = min(session[1], time)
+      session[2] = max(session[2], time)
+      session[3] += 1
+      session[4] = time
+      self.hosts.move_to_end(host)
+
+    else:
+      if session is not None:
+        self.close(self.hosts.pop(host))
+
+      session = [self.next_session_id, time, time, 1, time]
+      self.next_session_id += 1
+      self.hosts[host] = session
+
+    self.evict(time)
+    self.peak_size = max(self.peak_size, len(self.hosts))
+
+    return time_diff, session[0]
+
+  """
+  Evict hosts idle longer than the timeout, in order of last access
+  """
+  def evict(self, time):
+
+    while len(self.hosts) > 0:
+      session = next(iter(self.hosts.values()))
+      if abs((time - session[2]).total_seconds()) <= self.timeout:
+        break
+
+      self.close(self.hosts.popitem(last = False)[1])
+      self.evictions += 1
+
+  """
+  Add statistics of an ended session
+  Sessions without log entries on this run are left out
+  """
+  def close(self, session):
+
+    if session[3] == 0:
+      return
+
+    duration = int((session[2] - session[1]).total_seconds())
+
+    self.session_count    += 1
+    self.session_requests += session[3]
+    self.total_duration   += duration
+    self.max_duration      = max(self.max_duration, duration)
+
+  """
+  Get session statistics, including open sessions: count, average duration, maximum duration
+  and average log entries per session
+  """
+  def get_stats(self):
+
+    stats = [self.session_count, self.session_requests, self.total_duration, self.max_duration]
+
+    for session in self.hosts.values():
+      if session[3] > 0:
+        duration  = int((session[2] - session[1]).total_seconds())
+        stats[0] += 1
+        stats[1] += session[3]
+        stats[2] += duration
+        stats[3]  = max(stats[3], duration)
+
+    count = stats[0]
+    if count == 0:
+      return 0, 0, 0, 0
+
+    return count, stats[2] / count, stats[3], stats[1] / count
+
+  """
+  Get open sessions in a JSON serializable form
+  """
+  def dump(self):
+    return [[host, i[0], i[1].isoformat(), i[2].isoformat(), i[4].isoformat()] for host, i in self.hosts.items()]
+
+  """
+  Load open sessions of a previous run
+  """
+  def load(self, sessions, next_session_id):
+
+    for host, session_id, start, last, previous in sessions:
+      self.hosts[host] = [session_id, datetime.fromisoformat(start), datetime.fromisoformat(last), 0, datetime.fromisoformat(previous)]
+
+    self.next_session_id = max(self.next_session_id, next_session_id)
+
+class external_sorter(object):
+
+  """
+  Init
+  Sort of output rows which may not fit in memory
+  Rows are sorted in memory up to the memory limit. Beyond that, sorted runs are spilled to temporary
+  files as pickled rows, and the runs are merged with a streaming k-way merge. Equal rows keep their
+  input order, as with sorted().
+  At most fan_in runs are merged at once: full groups of runs of the same level are merged into a single
+  run as they are written, so the number of open temporary files stays bounded.
+  """
+  def __init__(self, txt, key, reverse = False, memory_limit = 268435456, fan_in = 64):
+    self.txt          = txt
+    self.key          = key
+    self.reverse      = reverse
+    self.memory_limit = memory_limit
+    self.fan_in       = max(fan_in, 2)
+    self.runs         = []
+
+  """
+  Sort rows
+  """
+  def sort(self, rows):
+
+    buffer = []
+    size   = 0
+
+    try:
+      for row in rows:
+        buffer.append(row)
+        size += self.get_size(row)
+
+        if size >= self.memory_limit:
+          self.runs.append([0, self.write_run(buffer)])
+          buffer = []
+          size   = 0
+          self.compact_runs()
+
+      buffer.sort(key = self.key, reverse = self.reverse)
+
+      if len(self.runs) == 0:
+        yield from buffer
+        return
+
+      # Merge passes of consecutive runs, until the remaining runs and rows in memory can be merged at once
+      while len(self.runs) >= self.fan_in:
+        runs      = self.runs
+        self.runs = []
+        for i in range(0, len(runs), self.fan_in):
+          group = runs[i:i + self.fan_in]
+          self.runs.append([group[-1][0] + 1, self.merge_runs(group) if len(group) > 1 else group[0][1]])
+
+      # Rows still in memory are the last run
+      yield from heapq.merge(*[self.read_run(f) for level, f in self.runs], buffer, key = self.key, reverse = self.reverse)
+
+    finally:
+      for level, f in self.runs:
+        f.close()
+      self.runs = []
+
+  """
+  Merge the last runs while they form a full group of the same level
+  Merged runs are consecutive, so equal rows keep their input order.
+  """
+  def compact_runs(self):
+
+    while len(self.runs) >= self.fan_in:
+      group = self.runs[-self.fan_in:]
+      level = group[0][0]
+      if any([i[0] != level for i in group]):
+        break
+      del self.runs[-self.fan_in:]
+      self.runs.append([level + 1, self.merge_runs(group)])
+
+  """
+  Merge runs to a new run. Merged runs are closed.
+  """
+  def merge_runs(self, runs):
+
+    f = tempfile.TemporaryFile(prefix = 'apache-logparser-')
+
+    try:
+      for row in heapq.merge(*[self.read_run(i[1]) for i in runs], key = self.key, reverse = self.reverse):
+        f.write(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+    except BaseException:
+      f.close()
+      raise
+    finally:
+      for i in runs:
+        i[1].close()
+
+    self.txt.print_verbose('Sort', 'merged {:d} runs to a temporary file'.format(len(runs)))
+    return f
+
+  """
+  Get approximate memory size of a row
+  """
+  def get_size(self, row):
+    return sys.getsizeof(row) + sum([sys.getsizeof(i) for i in row])
+
+  """
+  Sort rows and write them to a temporary file
+  """
+  def write_run(self, rows):
+
+    rows.sort(key = self.key, reverse = self.reverse)
+
+    f = tempfile.TemporaryFile(prefix = 'apache-logparser-')
+    for row in rows:
+      f.write(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+
+    self.txt.print_verbose('Sort', 'spilled run {:d} of {:d} rows to a temporary file'.format(len(self.runs) + 1, len(rows)))
+    return f
+
+  """
+  Read rows of a run
+  """
+  def read_run(self, f):
+
+    f.seek(0)
+    unpickler = pickle.Unpickler(f)
+
+    while True:
+      try:
+        yield unpickler.load()
+      except EOFError:
+        return
+
+class lru_cache(object):
+
+  """
+  Init
+  Bounded least recently used cache with hit, miss and eviction counters
+  """
+  def __init__(self, maxsize):
+    self.maxsize   = maxsize
+    self.data      = collections.OrderedDict()
+    self.hits      = 0
+    self.misses    = 0
+    self.evictions = 0
+
+  """
+  Get cached value
+  Returns a tuple (found, value)
+  """
+  def lookup(self, key):
+
+    try:
+      value = self.data[key]
+    except KeyError:
+      self.misses += 1
+      return False, None
+
+    self.data.move_to_end(key)
+    self.hits += 1
+    return True, value
+
+  """
+  Store value, evicting the least recently used value if the cache is full
+  """
+  def put(self, key, value):
+
+    if self.maxsize <= 0:
+      return
+
+    self.data[key] = value
+    self.data.move_to_end(key)
+
+    if len(self.data) > self.maxsize:
+      self.data.popitem(last = False)
+      self.evictions += 1
+
+class geo_store(object):
+
+  """
+  Init
+  Persistent SQLite cache of geo lookup results, shared across runs
+  Stored results are dropped whenever the signature (geo database files, backend and settings) changes
+  """
+  def __init__(self, txt, store_file, signature, commit_interval = 1000):
+
+    self.txt             = txt
+    self.commit_interval = commit_interval
+    self.pending         = 0
+    self.hits            = 0
+    self.misses          = 0
+
+    store_dir = os.path.dirname(store_file)
+    if store_dir:
+      os.makedirs(store_dir, exist_ok = True)
+
+    self.db = sqlite3.connect(store_file)
+    self.db.execute('PRAGMA journal_mode = WAL')
+    self.db.execute('PRAGMA synchronous = NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS geo (cache_key TEXT PRIMARY KEY, country TEXT, city TEXT)')
+
+    row = self.db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+    if row is None or row[0] != signature:
+      self.txt.print_verbose('Geo cache file', 'geo databases changed, clearing stored results', store_file)
+      self.db.execute('DELETE FROM geo')
+      self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('signature', ?)", (signature,))
+    self.db.commit()
+
+  """
+  Get stored geo data
+  """
+  def get(self, cache_key):
+
+    row = self.db.execute('SELECT country, city FROM geo WHERE cache_key = ?', (cache_key,)).fetchone()
+
+    if row is None:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    return {
+      'host_country': row[0],
+      'host_city':    row[1]
+    }
+
+  """
+  Store geo data
+  """
+  def put(self, cache_key, geo_data):
+
+    self.db.execute(
+      'INSERT OR REPLACE INTO geo (cache_key, country, city) VALUES (?, ?, ?)',
+      (cache_key, geo_data['host_country'], geo_data['host_city'])
+    )
+    self.pending += 1
+
+    if self.pending >= self.commit_interval:
+      self.db.commit()
+      self.pending = 0
+
+  def close(self):
+    self.db.commit()
+    self.db.close()
+
+class geo_mmdb_reader(object):
+
+  """
+  Init
+  In-process geo lookups from a MaxMind DB (.mmdb) file, opened once
+  City databases are preferred over country databases
+  """
+  def __init__(self, database_dir):
+
+    import maxminddb
+
+    database_files = sorted([i for i in os.listdir(database_dir) if i.endswith('.mmdb')], key = lambda i: 'City' not in i)
+
+    if len(database_files) == 0:
+      raise Exception("No MaxMind DB files found in '{}'.".format(database_dir))
+
+    self.database_file = os.path.join(database_dir, database_files[0])
+    self.reader        = maxminddb.open_database(self.database_file)
+
+  """
+  Get country and city of a host
+  """
+  def lookup(self, remote_host):
+
+    host_country = "Unknown"
+    host_city    = None
+
+    try:
+      record = self.reader.get(remote_host)
+    except ValueError:
+      record = None
+
+    if record is None:
+      return {
+        'host_country': host_country,
+        'host_city':    host_city
+      }
+
+    country = record.get('country') or record.get('registered_country')
+    if country is not None:
+      host_country = country.get('names', {}).get('en', host_country)
+
+    if 'city' in record:
+      host_city = record['city'].get('names', {}).get('en')
+
+    # Location of a record may lack coordinates, e.g. with accuracy radius only
+    if host_city is None and 'location' in record:
+      latitude  = record['location'].get('latitude')
+      longitude = record['location'].get('longitude')
+      if latitude is not None and longitude is not None:
+        host_city = "Unknown: {:f}, {:f}".format(latitude, longitude)
+      else:
+        host_city = "Unknown"
+
+    return {
+      'host_country': host_country,
+      'host_city':    host_city
+    }
+
+class geo_legacy_reader(object):
+
+  """
+  Init
+  In-process geo lookups from legacy GeoIP (.dat) files with the GeoIP C library bindings,
+  i.e. the same library and databases which "geoiplookup" tool uses.
+  Databases are loaded into memory once.
+  """
+  def __init__(self, database_dir):
+
+    import GeoIP
+
+    database_names = {
+      'country':    ['GeoIP.dat'],
+      'country_v6': ['GeoIPv6.dat'],
+      'city':       ['GeoIPCity.dat', 'GeoLiteCity.dat'],
+      'city_v6':    ['GeoIPCityv6.dat', 'GeoLiteCityv6.dat']
+    }
+    self.databases = {}
+
+    for key, names in database_names.items():
+      for name in names:
+        database_file = os.path.join(database_dir, name)
+        if os.path.isfile(database_file):
+          self.databases[key] = GeoIP.open(database_file, GeoIP.GEOIP_MEMORY_CACHE)
+          break
+
+    if len(self.databases) == 0:
+      raise Exception("No GeoIP database files found in '{}'.".format(database_dir))
+
+  """
+  Get country and city of a host
+  """
+  def lookup(self, remote_host):
+
+    host_country = None
+    host_city    = None
+    ipv6         = ':' in remote_host
+
+    country_db = self.databases.get('country_v6' if ipv6 else 'country')
+    city_db    = self.databases.get('city_v6' if ipv6 else 'city')
+
+    if country_db is not None:
+      if ipv6:
+        host_country = country_db.country_name_by_addr_v6(remote_host)
+      else:
+        host_country = country_db.country_name_by_addr(remote_host)
+      if host_country is None:
+        host_country = "Unknown"
+
+    if city_db is not None:
+      if ipv6:
+        record = city_db.record_by_addr_v6(remote_host)
+      else:
+        record = city_db.record_by_addr(remote_host)
+
+      if record is not None:
+        host_city = record.get('city')
+        if not host_city:
+          host_city = "Unknown: {:f}, {:f}".format(record['latitude'], record['longitude'])
+        if host_country is None:
+          host_country = record.get('country_name')
+
+    return {
+      'host_country': host_country,
+      'host_city':    host_city
+    }
 
 class program(object):
 
@@ -59,12 +2911,16 @@ class program(object):
   def __init__(self):
     self.args = self.get_args()
 
-    # Exclude private IP address classes from geo lookup process
+    # Exclude local networks from geo lookup process
     # Strip out %I and %O flags from Apache log format
-    # 127.0.0.0/8, 172.16.0.0/12, 192.168.0.0/16
-    self.private_class_ip_networks = ['^127\.', '^172\.(1[6-9]{1}|2[0-9]{1}|3[0-1]{1})\.', '^192\.168\.']
+    self.local_networks = network_classifier(self.args.local_networks)
 
     self.txt = text_processing(verbose = self.args.verbose)
+    self.fp  = file_processing()
+
+    self.line_index = None
+    if self.args.use_line_index:
+      self.line_index = line_index(self.txt, self.fp, os.path.expanduser(self.args.index_dir))
 
   """
   Define & get output fields
@@ -79,7 +2935,11 @@ class program(object):
       'time':          {'data': None, 'format': '{:20s}', 'included': True,  'human_name': 'Date/Time',     'sort_index': 5},
       'time_diff':     {'data': None, 'format': '{:8s}',  'included': True,  'human_name': 'Time diff',     'sort_index': 6},
       'user_agent':    {'data': None, 'format': '{:s}',   'included': True,  'human_name': 'User agent',    'sort_index': 7},
-      'http_request':  {'data': None, 'format': '{:s}',   'included': True,  'human_name': 'Request',       'sort_index': 8}
+      'http_request':  {'data': None, 'format': '{:s}',   'included': True,  'human_name': 'Request',       'sort_index': 8},
+      'bytes_in':      {'data': None, 'format': '{:8s}',  'included': False, 'human_name': 'Bytes in',      'sort_index': 9},
+      'bytes_out':     {'data': None, 'format': '{:8s}',  'included': False, 'human_name': 'Bytes out',     'sort_index': 10},
+      'duration':      {'data': None, 'format': '{:8s}',  'included': False, 'human_name': 'Duration (us)', 'sort_index': 11},
+      'session':       {'data': None, 'format': '{:7s}',  'included': False, 'human_name': 'Session',       'sort_index': 12}
     }
     return out_fields
 
@@ -155,6 +3015,14 @@ class program(object):
       dest     = 'countries',
       required = False
     )
+    argparser.add_argument(
+      '--where',
+      help     = 'Include only log entries matching an expression, e.g. \'status >= 500 and time > 2026-10-01\'.\n' +
+                 'Operators: ==, !=, <, <=, >, >=, ~ (regex), !~, and, or, not. Evaluated with NumPy if available.',
+      nargs    = '?',
+      dest     = 'where',
+      required = False
+    )
     argparser.add_argument(
       '-tf', '--time-format',
       help     = 'Output time format.',
@@ -197,6 +3065,140 @@ class program(object):
       dest     = 'geo_database_location',
       default  = '/usr/share/GeoIP/'
     )
+    argparser.add_argument(
+      '-gb', '--geo-backend',
+      help     = 'Geo lookup backend: MaxMind DB files (mmdb), legacy GeoIP files with GeoIP library (geoip) or "geoiplookup" tool (exec).\nauto: first available one.',
+      dest     = 'geo_backend',
+      default  = 'auto',
+      choices  = ['auto', 'mmdb', 'geoip', 'exec']
+    )
+    argparser.add_argument(
+      '--geo-cache-size',
+      help     = 'Number of cached geo lookup results. 0 disables the cache.',
+      dest     = 'geo_cache_size',
+      default  = 10000,
+      type     = int
+    )
+    argparser.add_argument(
+      '--geo-cache-prefix',
+      help     = 'Cache geo lookup results by /24 (IPv4) and /48 (IPv6) networks instead of single addresses.',
+      dest     = 'geo_cache_prefix',
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--geo-cache-file',
+      help     = 'SQLite file for geo lookup results shared across runs. Stored results are dropped when geo database files change.',
+      dest     = 'geo_cache_file',
+      default  = None
+    )
+    argparser.add_argument(
+      '--geo-database-max-age',
+      help     = 'Warn if geo database files are older than this many days.',
+      dest     = 'geo_database_max_age',
+      default  = 90,
+      type     = int
+    )
+    argparser.add_argument(
+      '--geo-workers',
+      help     = 'Number of concurrent geo lookups.',
+      dest     = 'geo_workers',
+      default  = 4,
+      type     = int
+    )
+    argparser.add_argument(
+      '--local-networks',
+      help     = 'Comma separated local networks in CIDR notation. Hosts in these networks may be logged without %%I and %%O fields and are not geo located.',
+      dest     = 'local_networks',
+      required = False,
+      default  = '127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128,fc00::/7,fe80::/10',
+      type     = lambda x: x.split(',')
+    )
+    argparser.add_argument(
+      '-a', '--aggregate',
+      help     = 'Count log entries by these comma separated output fields, and print the most frequent values of each field instead of log entries.',
+      dest     = 'aggregate',
+      required = False,
+      default  = None,
+      type     = lambda x: [i.strip() for i in x.split(',')]
+    )
+    argparser.add_argument(
+      '--top',
+      help     = 'Number of most frequent values printed for each aggregated field.',
+      dest     = 'aggregate_top',
+      required = False,
+      default  = 10,
+      type     = int
+    )
+    argparser.add_argument(
+      '--aggregate-error',
+      help     = 'Maximum error of aggregated counts relative to the number of log entries. Values are counted exactly up to 1 / error distinct values per field, and approximately with bounded memory after that.',
+      dest     = 'aggregate_error',
+      required = False,
+      default  = 0.0001,
+      type     = float
+    )
+    argparser.add_argument(
+      '--distinct',
+      help     = 'Count approximate distinct values of this output field, e.g. remote_host, instead of printing log entries.',
+      dest     = 'distinct_field',
+      required = False,
+      default  = None
+    )
+    argparser.add_argument(
+      '--distinct-by',
+      help     = 'Comma separated groups of distinct counts: day, country, http_status. Empty value counts all log entries together.',
+      dest     = 'distinct_by',
+      required = False,
+      default  = 'day',
+      type     = lambda x: [i.strip() for i in x.split(',') if i.strip()]
+    )
+    argparser.add_argument(
+      '--distinct-precision',
+      help     = 'HyperLogLog precision of distinct counts (4-18). Each group uses up to 2^precision bytes, with standard error of 1.04 / sqrt(2^precision).',
+      dest     = 'distinct_precision',
+      required = False,
+      default  = 14,
+      type     = int
+    )
+    argparser.add_argument(
+      '--sketch-file',
+      help     = 'Merge distinct counts with sketches stored in this file, and store merged sketches back to it.',
+      dest     = 'sketch_file',
+      required = False,
+      default  = None
+    )
+    argparser.add_argument(
+      '--merge-sketches',
+      help     = 'Comma separated sketch files to merge with distinct counts. Without input log files, only these files are merged.',
+      dest     = 'merge_sketches',
+      required = False,
+      default  = None,
+      type     = lambda x: x.split(',')
+    )
+    argparser.add_argument(
+      '--rollup',
+      help     = 'Count log entries in time buckets, and print requests, status classes, bytes in & out and request duration percentiles of each bucket instead of log entries.',
+      dest     = 'rollup_interval',
+      required = False,
+      default  = None,
+      choices  = ['minute', 'hour', 'day']
+    )
+    argparser.add_argument(
+      '--rollup-accuracy',
+      help     = 'Relative accuracy of rollup request duration percentiles.',
+      dest     = 'rollup_accuracy',
+      required = False,
+      default  = 0.01,
+      type     = float
+    )
+    argparser.add_argument(
+      '--session-timeout',
+      help     = 'Idle time in seconds after which a remote host starts a new session. Time diff is counted from the previous log entry of the same host in its session.',
+      dest     = 'session_timeout',
+      required = False,
+      default  = 1800,
+      type     = int
+    )
     argparser.add_argument(
       '-dl', '--day-lower',
       help     = 'Do not check log entries older than this day.\nDay syntax: 31-12-2020',
@@ -221,6 +3223,22 @@ class program(object):
       dest     = 'sortby_reverse',
       action   = 'store_true'
     )
+    argparser.add_argument(
+      '--limit',
+      help     = 'Print at most N matching log entries. With --sort-by, only the first N sorted log entries are kept in memory. Without it, processing stops after N log entries.',
+      dest     = 'limit',
+      required = False,
+      default  = None,
+      type     = int
+    )
+    argparser.add_argument(
+      '--sort-memory',
+      help     = 'Memory for sorting output in megabytes. Sorted output beyond this is stored in temporary files.',
+      dest     = 'sort_memory',
+      required = False,
+      default  = 256,
+      type     = int
+    )
     argparser.add_argument(
       '-st', '--show-stats',
       help     = 'Show short statistics at the end.',
@@ -285,6 +3303,62 @@ class program(object):
       nargs    = '?',
       type     = int
     )
+    argparser.add_argument(
+      '--line-range',
+      help     = 'Read lines MIN-MAX from all log entries. Either value may be omitted, e.g. 1000-.',
+      dest     = 'read_lines_range',
+      required = False,
+      type     = lambda x: [int(i) if i else None for i in x.split('-', 1)]
+    )
+    argparser.add_argument(
+      '--line-index',
+      help     = 'Store line offset index files of log files for fast --head, --tail and --line-range access.',
+      dest     = 'use_line_index',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--state-file',
+      help     = 'Store processed log file offsets in this file, and process only new log entries on the next run. Rotated and compressed log files are recognised.',
+      dest     = 'state_file',
+      required = False,
+      default  = None
+    )
+    argparser.add_argument(
+      '--time-ordered',
+      help     = 'Log files are ordered by time: find --day-lower and --day-upper range in log files with binary search, and skip files outside of it.',
+      dest     = 'time_ordered',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--build-cache',
+      help     = 'Parse input files once into columnar cache files, and read log entries from cache files instead of parsing them. Caches are rebuilt when log files change.',
+      dest     = 'build_cache',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--use-cache',
+      help     = 'Read log entries from cache files built earlier with --build-cache. Input files without a valid cache file are parsed.',
+      dest     = 'use_cache',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--cache-dir',
+      help     = 'Directory for parsed log cache files.',
+      dest     = 'cache_dir',
+      required = False,
+      default  = '~/.cache/apache-logparser/cache'
+    )
+    argparser.add_argument(
+      '--index-dir',
+      help     = 'Directory for line offset index files.',
+      dest     = 'index_dir',
+      required = False,
+      default  = '~/.cache/apache-logparser/index'
+    )
     argparser.add_argument(
       '--sort-logs-by',
       help     = 'Sorting order for input log files.',
@@ -293,6 +3367,44 @@ class program(object):
       default  = 'name',
       choices  = ['date', 'size', 'name']
     )
+    argparser.add_argument(
+      '-F', '--follow',
+      help     = 'Keep following input files and print new matching log entries as they are written, like "tail -F". Rotated and truncated files are reopened. Stop with Ctrl+C.',
+      dest     = 'follow',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '--follow-interval',
+      help     = 'Interval in seconds for checking followed files. Files are checked immediately on changes if inotify is available.',
+      dest     = 'follow_interval',
+      required = False,
+      default  = 1.0,
+      type     = float
+    )
+    argparser.add_argument(
+      '--merge-by-time',
+      help     = 'Read input files concurrently and merge their log entries in time order, e.g. log files of several virtual hosts or servers. Log entries of each file must be in time order.',
+      dest     = 'merge_by_time',
+      required = False,
+      action   = 'store_true'
+    )
+    argparser.add_argument(
+      '-j', '--jobs',
+      help     = 'Number of parallel parser processes.',
+      dest     = 'jobs',
+      required = False,
+      default  = 1,
+      type     = int
+    )
+    argparser.add_argument(
+      '--parser',
+      help     = 'Log line parser. Fast parser captures only output and filter fields and falls back to apachelogs for unsupported log formats.',
+      dest     = 'parser_engine',
+      required = False,
+      choices  = ['fast', 'apachelogs'],
+      default  = 'fast'
+    )
     argparser.add_argument(
       '--verbose',
       help     = 'Verbose output.',
@@ -301,6 +3413,13 @@ class program(object):
       action   = 'store_true'
     )
     args = argparser.parse_args()
+
+    # Followed files are read in this process, one by one
+    if args.follow and args.jobs > 1:
+      raise Exception("Following files can't be used with parallel jobs.")
+    if args.follow and args.merge_by_time:
+      raise Exception("Following files can't be merged by time.")
+
     return args
 
   """
@@ -435,12 +3554,12 @@ class program(object):
   """
   Geotool processing
   """
-  def geotool_get_data(self, geotool_ok, geotool_exec, database_file, remote_host):
+  def geotool_get_data(self, geotool_ok, geotool_exec, database_file, remote_host, geo_reader = None):
 
     host_country = None
     host_city    = None
 
-    if re.match('|'.join(self.private_class_ip_networks), remote_host):
+    if self.local_networks.is_local(remote_host):
       host_country = "Local"
       host_city    = "Local"
       return {
@@ -448,6 +3567,9 @@ class program(object):
         'host_city':    host_city
       }
 
+    if geo_reader is not None:
+      return geo_reader.lookup(remote_host)
+
     if geotool_ok:
 
       host_country_main = subprocess.check_output([geotool_exec,'-d', database_file, remote_host]).rstrip().decode()
@@ -473,6 +3595,122 @@ class program(object):
       }
     return None
 
+  """
+  Get in-process geo lookup backend
+  Returns None if "geoiplookup" tool should be used instead
+  """
+  def get_geo_reader(self, geo_backend, database_dir):
+
+    readers = [('mmdb', geo_mmdb_reader), ('geoip', geo_legacy_reader)]
+
+    for backend, reader in readers:
+      if geo_backend not in ['auto', backend]:
+        continue
+      try:
+        geo_reader = reader(database_dir)
+        self.txt.print_verbose('Geo backend', backend)
+        return geo_reader
+      except Exception as e:
+        if geo_backend == backend:
+          raise Exception("Geo backend '{}' is not available: {}".format(backend, str(e)))
+        self.txt.print_verbose('Geo backend', backend + ' not available', str(e))
+
+    self.txt.print_verbose('Geo backend', 'exec')
+    return None
+
+  """
+  Get geo database files
+  """
+  def get_geo_database_files(self, database_dir):
+
+    if not os.path.isdir(database_dir):
+      return []
+
+    return sorted([
+      os.path.join(database_dir, i) for i in os.listdir(database_dir)
+      if i.endswith('.dat') or i.endswith('.mmdb')
+    ])
+
+  """
+  Warn about old geo database files
+  """
+  def check_geo_database_age(self, database_dir, max_age_days):
+
+    now = datetime.now().timestamp()
+    old_files = [
+      i for i in self.get_geo_database_files(database_dir)
+      if now - os.path.getmtime(i) > max_age_days * 86400
+    ]
+
+    if len(old_files) > 0:
+      print(
+        "Warning, some geo database files are older than {:d} days. Please consider updating geo database information: {:s}".format(
+          max_age_days,
+          ', '.join(old_files)
+        ),
+        file = sys.stderr
+      )
+
+  """
+  Get signature of geo lookup results: geo database files, lookup backend and cache settings
+  """
+  def get_geo_signature(self, database_dir, geo_reader, use_prefix):
+
+    signature = [
+      type(geo_reader).__name__,
+      str(use_prefix),
+      ','.join([str(i) for i in self.local_networks.networks])
+    ]
+
+    for database_file in self.get_geo_database_files(database_dir):
+      st = os.stat(database_file)
+      signature.append('{:s}:{:d}:{:d}'.format(database_file, st.st_size, st.st_mtime_ns))
+
+    return hashlib.sha1('\n'.join(signature).encode()).hexdigest()
+
+  """
+  Get geo cache key of a host: the address itself or its network prefix
+  """
+  def get_geo_cache_key(self, remote_host, use_prefix):
+
+    if not use_prefix:
+      return remote_host
+
+    try:
+      address = ipaddress.ip_address(remote_host)
+    except ValueError:
+      return remote_host
+
+    return str(ipaddress.ip_network('{}/{:d}'.format(address, 24 if address.version == 4 else 48), strict = False))
+
+  """
+  Get geo data from the geo cache or the geo cache file
+  Returns a tuple (found, geo_data)
+  """
+  def geo_get_cached(self, filters, cache_key):
+
+    found, geo_data = filters['geo_cache'].lookup(cache_key)
+    if found:
+      return True, geo_data
+
+    if filters['geo_store'] is not None:
+      geo_data = filters['geo_store'].get(cache_key)
+      if geo_data is not None:
+        filters['geo_cache'].put(cache_key, geo_data)
+        return True, geo_data
+
+    return False, None
+
+  """
+  Store geo data to the geo cache and the geo cache file
+  """
+  def geo_put_cached(self, filters, cache_key, geo_data):
+
+    filters['geo_cache'].put(cache_key, geo_data)
+
+    if filters['geo_store'] is not None and geo_data is not None:
+      filters['geo_store'].put(cache_key, geo_data)
+
   """
   Status code filter
   """
@@ -520,190 +3758,530 @@ class program(object):
     return skip_line
 
   """
-  Get lines to be processed from input files and min/max input
-  min and max work much like Unix tools 'head' and 'tail'
-  Only a single value (min or max) is allowed
+  Get input files in requested processing order
   """
+  def get_files_ordered(self, sfiles, files_order = None):
 
-  def get_file_lines_head_tail(self, sfiles, line_range_min = None, line_range_max = None, files_order = None):
-
-    files_and_lines = {'files': [], 'lines_total': 0, 'range_min': 0, 'range_max': 0}
     files_tmp = []
 
-    lines_count = 0
-    line_start  = 0
-    line_end    = 0
-
-    if line_range_min and line_range_max:
-      raise Exception("Either first or last line limit can be used, not both.")
-
     if files_order is None:
       raise Exception("Sorting order for input files missing.")
 
-    if line_range_min is not None:
-      if line_range_min < 0:
-        line_range_min = None
-
-    if line_range_max is not None:
-      if line_range_max < 0:
-        line_range_max = None
-
     for sfile in sfiles:
 
       if not self.check_file(sfile, "os.R_OK"):
         raise Exception("Couldn't read input file '{}'.".format(sfile))
 
-      with open(sfile, 'r') as f:
-        line_count = len(list(f))
-        f.close()
+      files_tmp.append({
+        'file':          str(sfile),
+        'modified_date': os.path.getmtime(sfile),
+        'size':          os.path.getsize(sfile),
+        'compression':   self.fp.get_compression(sfile),
+        'line_count':    None,
+        'offset_start':  0,
+        'line_start':    1,
+        'line_end':      None,
+        'offset_end':    None
+      })
 
-        files_tmp.append({
-          'file':          str(sfile),
-          'modified_date': os.path.getmtime(sfile),
-          'size':          os.path.getsize(sfile),
-          'line_count':    line_count
-        })
+    if files_order == 'date':
+      files_tmp.sort(key = lambda d: d['modified_date'])
+    elif files_order == 'size':
+      # Compressed files are compared by their decompressed size
+      files_tmp.sort(key = lambda d: self.fp.get_data_size(d['file'], d['compression']))
+    elif files_order == 'name':
+      files_tmp.sort(key = lambda d: d['file'])
 
-      if files_order == 'date':
-        files_tmp.sort(key = lambda d: d['modified_date'])
-      elif files_order == 'size':
-        files_tmp.sort(key = lambda d: d['size'])
-      elif files_order == 'name':
-        files_tmp.sort(key = lambda d: d['file'])
+    return files_tmp
 
-    i = 0
-    for sfile in files_tmp:
+  """
+  Stream lines from input files in processing order, starting from each file's start offset
+  Lines are counted as a side effect, files are never read into memory
+  """
+  def read_lines(self, files, stats):
+
+    show_progress = self.args.show_progress or self.args.verbose
+
+    for lfile in files:
+
+      if show_progress:
+        print("Processing file: {:s}".format(lfile['file']), file = sys.stderr)
+
+      if not self.check_file(lfile['file'], "os.R_OK"):
+        raise Exception("Couldn't read input file '{}'.".format(lfile['file']))
+
+      stats['files'].append(lfile)
+      line_num   = lfile['line_start'] - 1
+      bytes_read = 0
+      bytes_size = max((lfile['offset_end'] or lfile['size']) - lfile['offset_start'], 1)
+
+      with self.fp.open_file(lfile['file'], lfile['compression']) as f:
+        self.fp.seek_file(f, lfile['offset_start'])
+        for line in f:
+
+          if line_num == lfile['line_end']:
+            break
+
+          if lfile['offset_end'] is not None and lfile['offset_start'] + bytes_read >= lfile['offset_end']:
+            break
+
+          line_num   += 1
+          bytes_read += len(line)
+
+          if show_progress and line_num % 1000 == 0:
+            # Progress of compressed files is shown by compressed input read
+            if lfile['compression'] is not None:
+              bytes_done = f.raw.get_position() / max(lfile['size'], 1)
+            else:
+              bytes_done = bytes_read / bytes_size
+            print("Processing log entry: {:d} ({}%)".format(
+              line_num,
+              round(100 * bytes_done, 2)
+            ), end = "\r", file = sys.stderr)
+
+          yield lfile, line_num, line.decode('utf-8', 'replace')
+
+      lfile['line_count']  = line_num - lfile['line_start'] + 1
+      lfile['offset_read'] = lfile['offset_start'] + bytes_read
+
+      if show_progress:
+        print("Processing log entry: {:d} (100%)".format(lfile['line_count']), file = sys.stderr)
+
+  """
+  Get watcher of input file directories for file changes
+  Returns None if inotify is not available: files are then polled
+  """
+  def get_file_watcher(self, files):
+
+    try:
+      import inotify_simple
+    except ImportError:
+      self.txt.print_verbose('Follow', 'python-inotify-simple not available, polling files')
+      return None
 
-      line_end = (line_start + sfile['line_count']) - 1
+    flags   = inotify_simple.flags
+    watcher = inotify_simple.INotify()
 
-      files_and_lines['files'].append({
-        'file':              sfile['file'],
-        'line_start_global': line_start,
-        'line_end_global':   line_end,
-        'line_start_local':  0,
-        'line_end_local':    sfile['line_count'] - 1,
+    # Directories are watched to notice rotated and recreated files
+    for directory in set([os.path.dirname(os.path.abspath(i['file'])) for i in files]):
+      watcher.add_watch(directory, flags.MODIFY | flags.CREATE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+
+    return watcher
+
+  """
+  Read complete lines appended to a followed file
+  Incomplete last line is kept in a buffer until it has been completed, or it exceeds max line length
+  """
+  def read_appended_lines(self, followed, stats, max_line_length = 1048576):
+
+    lfile = followed['lfile']
+
+    for line in followed['f']:
+
+      if not line.endswith(b'\n') and len(followed['buffer']) + len(line) < max_line_length:
+        followed['buffer'] += line
+        break
+
+      line               = followed['buffer'] + line
+      followed['buffer'] = b''
+
+      followed['line_num'] += 1
+      lfile['line_count']  += 1
+
+      yield lfile, followed['line_num'], line.decode('utf-8', 'replace')
+
+  """
+  Read input files and keep following lines appended to them, like 'tail -F'
+  Files are reopened when they are rotated (replaced by a new file) or truncated.
+  Compressed files are read once.
+  """
+  def follow_lines(self, files, stats, poll_interval = 1.0):
+
+    followed_files = []
+
+    for lfile in files:
+
+      if lfile['compression'] is not None:
+        yield from self.read_lines([lfile], stats)
+        continue
+
+      if not self.check_file(lfile['file'], "os.R_OK"):
+        raise Exception("Couldn't read input file '{}'.".format(lfile['file']))
+
+      f = open(lfile['file'], 'rb')
+      f.seek(lfile['offset_start'])
+
+      st = os.fstat(f.fileno())
+
+      lfile['line_count'] = 0
+      stats['files'].append(lfile)
+
+      followed_files.append({
+        'lfile':    lfile,
+        'f':        f,
+        'device':   st.st_dev,
+        'inode':    st.st_ino,
+        'line_num': lfile['line_start'] - 1,
+        'buffer':   b''
       })
 
-      lines_count += line_count
-      line_start = files_and_lines['files'][i]['line_end_global'] + 1
-      i += 1
+    watcher = self.get_file_watcher([i['lfile'] for i in followed_files])
 
-    range_line_start = files_and_lines['files'][0]['line_start_global']
-    full_range                     = files_and_lines['files'][-1]['line_end_global']
-    files_and_lines['range_min']   = range_line_start
-    files_and_lines['range_max']   = full_range
-    files_and_lines['lines_total'] = full_range - range_line_start
-    i = 0
+    try:
+      while True:
+
+        for followed in followed_files:
+
+          yield from self.read_appended_lines(followed, stats)
+
+          try:
+            st = os.stat(followed['lfile']['file'])
+          except FileNotFoundError:
+            # Rotated file has not been recreated yet
+            continue
+
+          rotated   = st.st_dev != followed['device'] or st.st_ino != followed['inode']
+          truncated = not rotated and st.st_size < followed['f'].tell()
+
+          if not rotated and not truncated:
+            continue
+
+          self.txt.print_verbose('Follow', 'rotated' if rotated else 'truncated', followed['lfile']['file'])
+
+          if rotated:
+            # Lines written to the rotated file just before rotation
+            yield from self.read_appended_lines(followed, stats)
+            followed['f'].close()
+            followed['f']      = open(followed['lfile']['file'], 'rb')
+            st                 = os.fstat(followed['f'].fileno())
+            followed['device'] = st.st_dev
+            followed['inode']  = st.st_ino
+          else:
+            followed['f'].seek(0)
+
+          followed['buffer']   = b''
+          followed['line_num'] = 0
+
+          followed['lfile']['identity']   = None
+          followed['lfile']['line_start'] = 1
+          followed['lfile']['line_count'] = 0
+
+        if watcher is not None:
+          list(watcher.read(timeout = int(poll_interval * 1000)))
+        else:
+          time.sleep(poll_interval)
+
+    finally:
+      for followed in followed_files:
+        followed['lfile']['offset_read'] = followed['f'].tell() - len(followed['buffer'])
+        followed['f'].close()
+      if watcher is not None:
+        watcher.close()
+
+  """
+  Find the byte offset where the last N lines of a file start
+  The file is read backwards in fixed-size blocks starting from the end of the file
+  Returns the offset and the number of lines found (less than N if the file is shorter)
+  """
+  def get_file_tail_offset(self, sfile, line_count, block_size = 65536):
+
+    with open(sfile, 'rb') as f:
+      f.seek(0, os.SEEK_END)
+      block_end = f.tell()
+
+      if block_end == 0 or line_count <= 0:
+        return block_end, 0
+
+      # Trailing newline of the last line does not start a new line
+      f.seek(block_end - 1)
+      if f.read(1) == b'\n':
+        block_end -= 1
+
+      remaining = line_count
+
+      while block_end > 0:
+        block_start = max(0, block_end - block_size)
+        f.seek(block_start)
+        block    = f.read(block_end - block_start)
+        newlines = block.count(b'\n')
+
+        if newlines >= remaining:
+          pos = len(block)
+          for i in range(remaining):
+            pos = block.rindex(b'\n', 0, pos)
+          return block_start + pos + 1, line_count
+
+        remaining -= newlines
+        block_end  = block_start
+
+    # Whole file is included, the first line has no preceding newline
+    return 0, line_count - remaining + 1
+
+  """
+  Find the start line and byte offset of the last N lines of a compressed file
+  Compressed files can't be read backwards: the file is decompressed as a stream
+  and only start offsets of the last N lines are kept
+  Returns the start line, offset and the number of lines found
+  """
+  def get_stream_tail_offset(self, lfile, line_count):
+
+    offsets  = collections.deque(maxlen = line_count)
+    offset   = 0
+    line_num = 0
+
+    with self.fp.open_file(lfile['file'], lfile['compression']) as f:
+      for line in f:
+        offsets.append(offset)
+        offset   += len(line)
+        line_num += 1
+
+    if len(offsets) > 0:
+      offset = offsets[0]
+
+    return line_num - len(offsets) + 1, offset, len(offsets)
+
+  """
+  Get input files and start offsets for the last N lines of all log entries
+  Files are checked from the last one to the first one, and only their ends are parsed
+  Without a line index, line numbers of selected lines are found by counting newlines before them
+  """
+  def get_files_tail(self, files, line_count):
+
+    files_tail = []
+    remaining  = line_count
+
+    for lfile in reversed(files):
+
+      if remaining <= 0:
+        break
+
+      if self.line_index is not None:
+        file_index  = self.line_index.get(lfile['file'])
+        line_count  = self.line_index.get_line_count(file_index)
+        lines_found = min(remaining, line_count)
+
+        lfile['line_start']   = line_count - lines_found + 1
+        lfile['offset_start'] = self.line_index.get_line_offset(file_index, lfile['line_start'])
+      elif lfile['compression'] is not None:
+        lfile['line_start'], lfile['offset_start'], lines_found = self.get_stream_tail_offset(lfile, remaining)
+      else:
+        offset, lines_found = self.get_file_tail_offset(lfile['file'], remaining)
 
-    # Read last N lines
-    if line_range_max is not None:
-      range_start = full_range - line_range_max
-      if range_start <= 0:
-        range_start = 0
+        lfile['offset_start'] = offset
+        lfile['line_start']   = self.count_lines(lfile['file'], offset) + 1
 
-      for l in files_and_lines['files']:
-        if range_start >= l['line_start_global'] and range_start <= l['line_end_global']:
-          l['line_start_global'] = range_start
-          l['line_start_local']  = l['line_end_local'] - (l['line_end_global'] - range_start)
-          del files_and_lines['files'][:i]
-        i += 1
+      files_tail.insert(0, lfile)
 
-    # Read first N lines
-    if line_range_min is not None:
-      range_end = line_range_min
-      if range_end >= full_range:
-        range_end = full_range
+      remaining -= lines_found
 
-      for l in files_and_lines['files']:
-        if range_end >= l['line_start_global'] and range_end <= l['line_end_global']:
-          l['line_end_local']  = l['line_end_local'] - l['line_start_local'] - (l['line_end_global'] - range_end)
-          l['line_end_global'] = range_end
-          del files_and_lines['files'][i + 1:]
-        i += 1
+    self.txt.print_verbose('Tail files', *['{:s} (offset: {:d})'.format(i['file'], i['offset_start']) for i in files_tail])
+    return files_tail
 
-    return files_and_lines
+  """
+  Get lines to be processed from the line stream and min input
+  min works much like Unix tool 'head'
+  """
+  def select_lines(self, lines, line_range_min = None):
+
+    # Read first N lines: stop reading input once N lines have been seen
+    if line_range_min is not None and line_range_min >= 0:
+      return itertools.islice(lines, line_range_min)
+
+    return lines
 
   """
   Get lines to be processed from input files and range input
-  Range: <min> - <max>
+  Range: <min> - <max>, 1-based and inclusive, counted over all input files in processing order
   """
+  def get_file_lines_range(self, files, line_range_min = None, line_range_max = None):
 
-  def get_file_lines_range(self, sfiles, line_range_min=None, line_range_max=None):
+    files_range       = []
+    line_start_global = 1
 
-    files_and_lines = {'files': [], 'lines_total': 0, 'range_min': 0, 'range_max': 0}
+    # Without a stored index, line offsets are indexed in memory for this run only
+    index = self.line_index
+    if index is None:
+      index = line_index(self.txt, self.fp)
 
-    lines_count            = 0
-    line_start             = 0
-    line_end               = 0
-    range_line_start       = 0
-    range_line_end         = 0
-    range_line_start_found = False
+    if line_range_min is None or line_range_min < 1:
+      line_range_min = 1
 
-    if line_range_min is not None:
-      if line_range_min < 0:
-        line_range_min = None
+    if line_range_max is not None and line_range_max < line_range_min:
+      raise Exception("Line range minimum can't be greater than maximum.")
 
-    if line_range_max is not None:
-      if line_range_max < 0:
-        line_range_max = None
+    for lfile in files:
 
-    for sfile in sfiles:
-      append = False
+      if line_range_max is not None and line_start_global > line_range_max:
+        break
+
+      file_index      = index.get(lfile['file'])
+      line_count      = index.get_line_count(file_index)
+      line_end_global = line_start_global + line_count - 1
+
+      if line_count > 0 and line_end_global >= line_range_min:
+        lfile['line_start']   = max(line_range_min - line_start_global + 1, 1)
+        lfile['offset_start'] = index.get_line_offset(file_index, lfile['line_start'])
+
+        if line_range_max is not None and line_range_max < line_end_global:
+          lfile['line_end']   = line_range_max - line_start_global + 1
+          lfile['offset_end'] = index.get_line_offset(file_index, lfile['line_end'] + 1)
+
+        files_range.append(lfile)
+
+      line_start_global = line_end_global + 1
+
+    self.txt.print_verbose('Range files', *['{:s} (lines: {:d}-{})'.format(i['file'], i['line_start'], i['line_end'] or 'end') for i in files_range])
+    return files_range
+
+  """
+  Get offset and timestamp of the first timestamped line starting after a byte offset
+  A line starting exactly at the offset is included only at the start of the file
+  Returns None, None if there are no such lines
+  """
+  def get_offset_time(self, f, offset, index):
+
+    f.seek(offset)
+    if offset > 0:
+      offset += len(f.readline())
+
+    for line in f:
+      line_time = index.get_line_time(line)
+      if line_time is not None:
+        return offset, line_time
+      offset += len(line)
+
+    return None, None
+
+  """
+  Find the byte offset of the first line timestamped at or after a given time in a time-ordered log file
+  Byte offsets are bisected until the range is smaller than block size, and the rest is read line by line
+  Returns file size if all lines are older
+  """
+  def get_file_time_offset(self, f, size, target, index, block_size = 65536):
+
+    lo = 0
+    hi = size
+
+    while hi - lo > block_size:
+      mid = (lo + hi) // 2
+      line_offset, line_time = self.get_offset_time(f, mid, index)
+      if line_time is not None and line_time < target:
+        lo = line_offset
+      else:
+        hi = mid
+
+    # Line at lo, if not at the start of the file, is older than target
+    f.seek(lo)
+    offset = lo
+    if lo > 0:
+      offset += len(f.readline())
+
+    for line in f:
+      line_time = index.get_line_time(line)
+      if line_time is not None and line_time >= target:
+        return offset
+      offset += len(line)
+
+    return size
+
+  """
+  Count lines before a byte offset of a log file
+  """
+  def count_lines(self, sfile, offset, block_size = 1048576):
+
+    count = 0
+    with open(sfile, 'rb') as f:
+      while offset > 0:
+        block = f.read(min(block_size, offset))
+        if not block:
+          break
+        count  += block.count(b'\n')
+        offset -= len(block)
+
+    return count
+
+  """
+  Get lines to be processed from time-ordered input files and day range input
+  Files outside of the day range are skipped, and reading is limited to the day range, found with binary search.
+  Uncompressed files only: compressed files are skipped by their line index timestamps, if available.
+  Entries are not strictly ordered by time, as they are written after requests have been served:
+  day range is widened by slack seconds, and entries are still checked against the day range.
+  """
+  def get_files_time_range(self, files, date_lower, date_upper, slack = 300):
+
+    files_range = []
+
+    index = self.line_index
+    if index is None:
+      index = line_index(self.txt, self.fp)
+
+    time_lower = None
+    time_upper = None
+    if date_lower is not None:
+      time_lower = (date_lower - timedelta(seconds = slack)).isoformat()
+    if date_upper is not None:
+      time_upper = (date_upper + timedelta(seconds = slack)).isoformat()
+
+    for lfile in files:
+
+      if self.line_index is not None:
+        file_index = self.line_index.get(lfile['file'])
+        if file_index['time_first'] is not None and \
+           ((time_upper is not None and file_index['time_first'] >= time_upper) or \
+            (time_lower is not None and file_index['time_last'] < time_lower)):
+          self.txt.print_verbose('Time range', 'skipping file', lfile['file'])
+          continue
+
+      if lfile['compression'] is not None:
+        files_range.append(lfile)
+        continue
+
+      size = lfile['size']
+
+      with open(lfile['file'], 'rb') as f:
+        offset_start = 0
+        offset_end   = size
+        if time_lower is not None:
+          offset_start = self.get_file_time_offset(f, size, time_lower, index)
+        if time_upper is not None:
+          offset_end   = self.get_file_time_offset(f, size, time_upper, index)
+
+      if offset_start >= offset_end:
+        self.txt.print_verbose('Time range', 'skipping file', lfile['file'])
+        continue
+
+      if offset_start > 0:
+        if self.line_index is not None:
+          lfile['line_start'] = self.line_index.get_offset_line(self.line_index.get(lfile['file']), offset_start)
+        else:
+          lfile['line_start'] = self.count_lines(lfile['file'], offset_start) + 1
+        lfile['offset_start'] = offset_start
+
+      if offset_end < size:
+        lfile['offset_end'] = offset_end
+
+      files_range.append(lfile)
+
+    self.txt.print_verbose('Time range files', *['{:s} (offsets: {:d}-{})'.format(i['file'], i['offset_start'], i['offset_end'] or 'end') for i in files_range])
+    return files_range
+
+  """
+  Date checker
+  """
+  def date_checker(self, time_lower, time_upper, timestamp):
 
-      if not self.check_file(sfile, "os.R_OK"):
-        raise Exception("Couldn't read input file '{}'.".format(sfile))
+    if time_lower is not None:
+      if timestamp <= time_lower: return False
 
-      with open(sfile, 'r') as f:
-        line_count = len(list(f))
-        f.close()
+    if time_upper is not None:
+      if timestamp >= time_upper: return False
 
-        line_end = line_start + line_count
-
-        if line_range_min is not None:
-          if line_range_min >= line_start and line_range_min <= line_end:
-            append = True
-            line_start = line_range_min
-        if line_range_min is None and line_end < line_range_max:
-          append = True
-
-        if line_range_max is not None:
-          if line_range_max >= line_start and line_range_max <= line_end:
-            append = True
-            line_end = line_range_max
-          if line_range_min < line_end and line_range_max > line_end:
-            append = True
-        if line_range_max is None and line_start > line_range_min:
-          append = True
-
-        if append:
-          files_and_lines['files'].append({
-            'file':              str(sfile),
-            'line_start_global': line_start,
-            'line_end_global':   line_end,
-            'modified_date':     os.path.getmtime(sfile),
-            'size':              os.path.getsize(sfile)
-          })
-
-          # Use only the first matching line_start value
-          if not range_line_start_found:
-            range_line_start_found = True
-            range_line_start = line_start
-          # Use the last matching line_end value
-          range_line_end = line_end
-
-        lines_count += line_count
-        line_start  = lines_count + 1
-
-    files_and_lines['lines_total'] = range_line_end - range_line_start
-    files_and_lines['range_min']   = range_line_start
-    files_and_lines['range_max']   = range_line_end
-
-    return files_and_lines
+    return True
 
   """
-  Date checker
+  Validate date filter range
   """
-  def date_checker(self, date_lower, date_upper, entry_time):
+  def check_date_range(self, date_lower, date_upper):
 
     # TODO Handle situations where date_upper & date_lower are equal
 
@@ -719,14 +4297,6 @@ class program(object):
       if date_lower > datetime.now():
         raise Exception("Day can't be in the future")
 
-    if date_lower is not None:
-      if entry_time <= date_lower: return False
-
-    if date_upper is not None:
-      if entry_time >= date_upper: return False
-
-    return True
-
   """
   Get output field definitions (sortby)
   """
@@ -739,6 +4309,17 @@ class program(object):
       i += 1
     return [False, i]
 
+  """
+  Get typed sort key of an output field
+  Missing values sort first. Time diff of a new connection sorts before numeric time diffs.
+  """
+  def get_sort_key(self, field, index):
+
+    if field == 'time_diff':
+      return lambda r: (r[index] != 'NEW_CONN', int(r[index]) if r[index] != 'NEW_CONN' else 0)
+
+    return lambda r: (r[index] is not None, r[index])
+
   """
   Get included fields
   """
@@ -791,13 +4372,380 @@ class program(object):
 
     return fields_out
 
+  """
+  Parse selected lines into log entries
+  """
+  def parse_lines(self, lines, parser, line_filter, invalid_lines, stats):
+
+    for lfile, line_num, line in lines:
+
+      stats['lines_processed'] += 1
+
+      if line_filter is not None and not line_filter.check(line):
+        continue
+
+      try:
+        entry_data = parser.parse(line)
+      except InvalidEntryError:
+        invalid_lines.append((lfile['file'], line_num))
+        continue
+
+      yield lfile, line_num, entry_data
+
+  """
+  Merge log entries of input files by log entry time
+  Files are read concurrently, and only one look-ahead log entry of each file is held for the merge.
+  Log entries of each file are expected to be in time order.
+  """
+  def merge_entries_by_time(self, files, read_file):
+
+    streams = [read_file(lfile) for lfile in files]
+
+    # Log entries of the same time are taken in input file order
+    return heapq.merge(*streams, key = lambda i: i[2]['time'])
+
+  """
+  Read log entries of a single input file from its parse cache
+  Files without a valid cache are parsed, and cached first if caches are built. Partially read files
+  are always parsed. A where expression is evaluated on cached columns, or on parsed entries.
+  """
+  def read_cached_file(self, lfile, cache, build, parser, line_filter, filters, invalid_lines, stats, where = None):
+
+    header = self.get_cache_header(lfile, cache, build)
+
+    if header is None:
+      entries = self.parse_lines(self.read_lines([lfile], stats), parser, line_filter, invalid_lines, stats)
+      if where is not None:
+        entries = self.where_entries(entries, where)
+      yield from entries
+      return
+
+    statuses = self.use_cached_file(lfile, cache, header, filters, invalid_lines, stats)
+
+    for line_num, entry_data in cache.read(lfile['file'], header, filters['time_lower'], filters['time_upper'], statuses, where):
+      yield lfile, line_num, entry_data
+
+  """
+  Get parse cache header of an input file, and build its cache first if caches are built
+  Returns None for files without a valid cache, and for partially read files
+  """
+  def get_cache_header(self, lfile, cache, build):
+
+    header = None
+    if lfile['offset_start'] == 0 and lfile['offset_end'] is None and lfile['line_end'] is None:
+      header = cache.get(lfile['file'])
+      if header is None and build:
+        header = cache.build(lfile['file'], self.read_lines([dict(lfile)], {'files': []}))
+
+    return header
+
+  """
+  Add lines and invalid lines of a cached input file to statistics
+  Returns status codes to be checked on cached columns
+  """
+  def use_cached_file(self, lfile, cache, header, filters, invalid_lines, stats):
+
+    if self.args.show_progress or self.args.verbose:
+      print("Processing file: {:s} (cached)".format(lfile['file']), file = sys.stderr)
+
+    stats['files'].append(lfile)
+    lfile['line_count']       = header['line_count']
+    stats['lines_processed'] += header['line_count']
+
+    for line_num in cache.get_invalid(lfile['file'], header):
+      invalid_lines.append((lfile['file'], line_num))
+
+    # Status codes are checked on cached columns, as with the line filter
+    statuses = None
+    if len(filters['codes']) > 0:
+      statuses = set([int(i[0]) for i in filters['codes'] if len(i) == 2 and i[1]])
+
+    return statuses
+
+  """
+  Count aggregated field values of input files with parse caches, file by file
+  Values of cached files are counted on cached columns, without building log entries. Other files are
+  parsed, and their rows are counted in batches. Yields lists of (value, count) pairs of each field.
+  """
+  def count_cached_files(self, files, cache, build, parser, line_filter, field_keys, filters, invalid_lines, stats, where = None):
+
+    # Output field: cache column
+    columns = {'http_status': 'status', 'time': 'timestamp'}
+    keys    = [columns.get(i, i) for i in field_keys]
+
+    for lfile in files:
+
+      header = self.get_cache_header(lfile, cache, build)
+
+      if header is None:
+        entries = self.parse_lines(self.read_lines([lfile], stats), parser, line_filter, invalid_lines, stats)
+        if where is not None:
+          entries = self.where_entries(entries, where)
+        rows    = self.filter_entries(self.check_entries(entries, filters), field_keys, filters)
+
+        while True:
+          batch = list(itertools.islice(rows, 4096))
+          if len(batch) == 0:
+            break
+          stats['lines_matched'] += len(batch)
+          yield [list(collections.Counter(column).items()) for column in zip(*batch)]
+        continue
+
+      statuses     = self.use_cached_file(lfile, cache, header, filters, invalid_lines, stats)
+      rows, counts = cache.count_values(lfile['file'], header, keys, filters['time_lower'], filters['time_upper'], statuses, where)
+
+      stats['lines_matched'] += rows
+      yield counts
+
+  """
+  Split input files into newline-aligned byte ranges
+  Compressed files can't be split and are processed as a single range
+  """
+  def get_file_chunks(self, files, chunk_size = 8388608):
+
+    for lfile in files:
+
+      if lfile['compression'] is not None:
+        yield lfile, (lfile['file'], lfile['compression'], lfile['offset_start'], lfile['offset_end'])
+        continue
+
+      offset_end = lfile['offset_end']
+      if offset_end is None:
+        offset_end = lfile['size']
+
+      chunk_start = lfile['offset_start']
+
+      with open(lfile['file'], 'rb') as f:
+        while chunk_start < offset_end:
+          chunk_end = chunk_start + chunk_size
+          if chunk_end < offset_end:
+            f.seek(chunk_end)
+            f.readline()
+            chunk_end = f.tell()
+          chunk_end = min(chunk_end, offset_end)
+
+          yield lfile, (lfile['file'], None, chunk_start, chunk_end)
+          chunk_start = chunk_end
+
+  """
+  Parse input files in a process pool
+  Byte ranges are parsed in worker processes and merged back in file and line order.
+  Only a limited number of ranges is in progress at once.
+  """
+  def parse_files_parallel(self, files, log_format, entry_fields, filters, jobs, invalid_lines, stats):
+
+    show_progress = self.args.show_progress or self.args.verbose
+    pending       = collections.deque()
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+      max_workers = jobs,
+      initializer = chunk_worker.init,
+      initargs    = (
+        log_format, self.local_networks, self.args.parser_engine, entry_fields,
+        filters['codes'], filters['date_lower'], filters['date_upper']
+      )
+    )
+
+    try:
+      chunks = self.get_file_chunks(files)
+
+      while True:
+        for lfile, chunk in chunks:
+          pending.append((lfile, executor.submit(chunk_worker.run, chunk)))
+          if len(pending) >= jobs * 2:
+            break
+
+        if len(pending) == 0:
+          break
+
+        lfile, future = pending.popleft()
+        entries, chunk_invalid_lines, line_count, position = future.result()
+
+        if lfile['line_count'] is None:
+          lfile['line_count'] = 0
+          stats['files'].append(lfile)
+          if show_progress:
+            print("Processing file: {:s}".format(lfile['file']), file = sys.stderr)
+
+        line_start = lfile['line_start'] + lfile['line_count']
+
+        lfile['line_count']      += line_count
+        lfile['offset_read']      = position
+        stats['lines_processed'] += line_count
+
+        for line_index in chunk_invalid_lines:
+          invalid_lines.append((lfile['file'], line_start + line_index))
+
+        for line_index, entry_data in entries:
+          yield lfile, line_start + line_index, entry_data
+
+    finally:
+      executor.shutdown(wait = True, cancel_futures = True)
+
+  """
+  Count output rows as they are produced
+  """
+  def count_entries(self, entries, stats):
+    for entry in entries:
+      stats['lines_matched'] += 1
+      yield entry
+
+  """
+  Check log entries against date and status code filters
+  """
+  def check_entries(self, entries, filters):
+
+    for lfile, line_num, entry_data in entries:
+
+      if not self.date_checker(filters['time_lower'], filters['time_upper'], entry_data['timestamp']):
+        continue
+
+      if len(filters['codes']) > 0:
+        if self.filter_status_code(filters['codes'], entry_data['status']):
+          continue
+
+      yield lfile, line_num, entry_data
+
+  """
+  Filter log entries by a where expression
+  With NumPy, entries are checked in batches as boolean masks over field columns. Single entries, e.g. of
+  followed files, and entries without NumPy are checked one by one.
+  """
+  def where_entries(self, entries, where, batch_size = 4096):
+
+    if where.np is None or batch_size == 1:
+      for lfile, line_num, entry_data in entries:
+        if where.check(lfile, entry_data):
+          yield lfile, line_num, entry_data
+      return
+
+    while True:
+      batch = list(itertools.islice(entries, batch_size))
+      if len(batch) == 0:
+        break
+
+      for i in where.np.flatnonzero(where.get_mask(where.get_columns(batch))):
+        yield batch[i]
+
+  """
+  Add geo data to log entries
+  Entries are processed in batches: each distinct host (or network) of a batch missing from the geo caches
+  is looked up once, concurrently in a thread pool. A batch is emitted only after the next batch has been
+  read, so lookups overlap with parsing. Without lookahead, a batch is emitted as soon as it has been resolved.
+  """
+  def enrich_entries(self, entries, filters, batch_size = 1000, lookahead = True):
+
+    pending  = collections.deque()
+    resolved = {}
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(filters['geo_workers'], 1))
+
+    try:
+      while True:
+        batch = list(itertools.islice(entries, batch_size))
+
+        for lfile, line_num, entry_data in batch:
+          cache_key = self.get_geo_cache_key(entry_data['remote_host'], filters['geo_cache_prefix'])
+          entry_data['geo_key'] = cache_key
+
+          # Hosts already resolved or being looked up for a batch are served from memory, as geo cache hits
+          if cache_key in resolved:
+            filters['geo_cache'].hits += 1
+            continue
+
+          found, geo_data = self.geo_get_cached(filters, cache_key)
+          if found:
+            resolved[cache_key] = geo_data
+          else:
+            resolved[cache_key] = executor.submit(
+              self.geotool_get_data,
+              filters['geotool_ok'],
+              filters['geotool_exec'],
+              filters['geo_database_location'],
+              entry_data['remote_host'],
+              filters['geo_reader']
+            )
+
+        if len(batch) > 0:
+          pending.append(batch)
+
+        if len(pending) == 0:
+          break
+
+        # Emit the oldest batch once the next one has been read, or at the end of input
+        if len(pending) > 1 or len(batch) == 0 or not lookahead:
+          for lfile, line_num, entry_data in pending.popleft():
+            geo_data = resolved[entry_data['geo_key']]
+
+            if isinstance(geo_data, concurrent.futures.Future):
+              geo_data = geo_data.result()
+              resolved[entry_data['geo_key']] = geo_data
+              self.geo_put_cached(filters, entry_data['geo_key'], geo_data)
+
+            entry_data['geo_data'] = geo_data
+            yield lfile, line_num, entry_data
+
+          # Keep only results which are still needed by the pending batch
+          if len(pending) > 0:
+            needed   = set([i[2]['geo_key'] for i in pending[0]])
+            resolved = {key: value for key, value in resolved.items() if key in needed}
+          else:
+            resolved = {}
+
+    finally:
+      executor.shutdown(wait = True, cancel_futures = True)
+
+  """
+  Filter log entries and emit output rows
+  """
+  def filter_entries(self, entries, field_keys, filters):
+
+    geo_data = None
+    sessions = filters['sessions']
+
+    for lfile, line_num, entry_data in entries:
+
+      if filters['use_geolocation']:
+        geo_data = entry_data['geo_data']
+
+        if len(filters['countries']) > 0 and geo_data is not None:
+          if self.filter_country(filters['countries'], geo_data['host_country']):
+            continue
+
+      # Time diff to the previous log entry of the same host in its session
+      time_diff, session_id = sessions.update(entry_data['remote_host'], entry_data['time'])
+
+      if time_diff is None:
+        time_diff = str('NEW_CONN')
+      else:
+        time_diff = int(time_diff)
+        if time_diff > 0:
+          time_diff = "+" + str(time_diff)
+
+      row_data = {
+        'log_file_name': lfile['file'],
+        'http_status':   entry_data['status'],
+        'remote_host':   entry_data['remote_host'],
+        'country':       geo_data['host_country'] if geo_data is not None else None,
+        'city':          geo_data['host_city'] if geo_data is not None else None,
+        'time':          entry_data['time'],
+        'time_diff':     time_diff,
+        'user_agent':    entry_data['user_agent'],
+        'http_request':  entry_data['http_request'],
+        'bytes_in':      entry_data['bytes_in'],
+        'bytes_out':     entry_data['bytes_out'],
+        'duration':      entry_data['duration'],
+        'session':       session_id
+      }
+
+      yield [row_data[key] for key in field_keys]
+
   """
   Process input files
+  Input is processed as a stream: read -> select -> parse -> filter -> emit
   """
   def process_files(self):
 
-    prev_host    = ""
-    log_entries  = []
     codes        = []
     countries    = []
 
@@ -807,12 +4755,6 @@ class program(object):
     else:
       log_format = self.get_httpd_logformat_directive(self.args.httpd_conf_file, self.args.httpd_log_nickname)
 
-    # Remove bytes in & out fields from local traffic pattern
-    log_format_local = log_format.replace('%I','').replace('%O','').strip()
-
-    parser = LogParser(log_format)
-    parser_local = LogParser(log_format_local)
-
     if self.args.codes:
       codes = self.get_input_status_codes(self.populate_status_codes(), self.args.codes)
 
@@ -828,6 +4770,16 @@ class program(object):
     if date_upper is not None:
       date_upper = datetime.strptime(date_upper, day_format)
 
+    self.check_date_range(date_lower, date_upper)
+
+    # Entry timestamps are compared as seconds since epoch
+    time_lower = None
+    time_upper = None
+    if date_lower is not None:
+      time_lower = (date_lower - datetime(1970, 1, 1)) // timedelta(seconds = 1)
+    if date_upper is not None:
+      time_upper = (date_upper - datetime(1970, 1, 1)) // timedelta(seconds = 1)
+
     geotool_exec          = self.args.geotool_exec
     geo_database_location = self.args.geo_database_location
 
@@ -835,14 +4787,22 @@ class program(object):
     if isinstance(self.args.incl_fields, str):
       incl_fields = self.args.incl_fields.split(',')
 
+    where = None
+    if self.args.where:
+      where = where_expression(self.args.where)
+
     use_geolocation = self.args.use_geolocation
-    if 'country' in incl_fields or 'city' in incl_fields:
+    if 'country' in incl_fields or 'city' in incl_fields or (where is not None and where.uses_geo()):
       use_geolocation = True
     geotool_ok      = False
+    geo_reader      = None
 
     if use_geolocation:
-      if self.check_file(geotool_exec, "os.X_OK", "PATH") and self.check_file(geo_database_location, "os.R_OK"):
-        geotool_ok = True
+      if self.check_file(geo_database_location, "os.R_OK"):
+        geo_reader = self.get_geo_reader(self.args.geo_backend, geo_database_location)
+      if geo_reader is None:
+        if self.check_file(geotool_exec, "os.X_OK", "PATH") and self.check_file(geo_database_location, "os.R_OK"):
+          geotool_ok = True
 
     fields = self.get_included_fields(
       self.get_out_fields(),
@@ -850,167 +4810,345 @@ class program(object):
       self.args.excl_fields
     )
 
-    invalid_lines        = []
-    field_names          = []
-    country_seen         = False
-    geo_data             = None
-    skip_line_by_status  = False
-    skip_line_by_country = False
-    file_num             = 0
-    stri                 = ""
-
-    files_input        = self.get_files(self.args.files_regex, self.args.files_list)
-    files_process_data = self.get_file_lines_head_tail(
-      files_input,
-      self.args.read_first_lines_num,
-      self.args.read_last_lines_num,
-      self.args.sort_logs_by_info
-    )
+    invalid_lines = []
+    field_names   = []
 
-    lines_total        = files_process_data['lines_total']
-    files_total        = len(files_process_data['files'])
+    # Followed files are processed indefinitely: keep only the latest invalid lines
+    if self.args.follow:
+      invalid_lines = collections.deque(maxlen = 1000)
+
+    stri          = ""
+    stats         = {'files': [], 'lines_processed': 0, 'lines_matched': 0, 'geo_cache': None, 'geo_store': None, 'state': None,
+                     'sessions': session_table(self.args.session_timeout), 'aggregate_counts': None}
+
+    if use_geolocation:
+      stats['geo_cache'] = lru_cache(self.args.geo_cache_size)
+
+      self.check_geo_database_age(geo_database_location, self.args.geo_database_max_age)
+
+      if self.args.geo_cache_file:
+        stats['geo_store'] = geo_store(
+          self.txt,
+          os.path.expanduser(self.args.geo_cache_file),
+          self.get_geo_signature(geo_database_location, geo_reader, self.args.geo_cache_prefix)
+        )
+
+    for key, value in fields.items():
+      if not use_geolocation and (key == 'country' or key == 'city'):
+        continue
+      if value['included']:
+        stri += "\t" + value['format']
+        field_names.append((key, value['human_name']))
+
+    # Aggregated fields replace output fields: only aggregated fields are parsed
+    if self.args.aggregate:
+      out_fields  = self.get_out_fields()
+      field_names = []
+      for key in self.args.aggregate:
+        if key not in out_fields:
+          raise Exception("Unknown aggregate field: {}. Accepted values: {}".format(key, ','.join(out_fields.keys())))
+        if not use_geolocation and (key == 'country' or key == 'city'):
+          raise Exception("Aggregating by country or city requires geo location.")
+        field_names.append((key, out_fields[key]['human_name']))
+
+    # Distinct counts: the counted field is followed by group fields
+    if self.args.distinct_field:
+      out_fields  = self.get_out_fields()
+      field_names = [(self.args.distinct_field, out_fields[self.args.distinct_field]['human_name'])]
+      for key in self.args.distinct_by:
+        if key == 'day':
+          key = 'time'
+        field_names.append((key, out_fields[key]['human_name']))
+        if not use_geolocation and key == 'country':
+          raise Exception("Distinct counts by country require geo location.")
+      if not use_geolocation and self.args.distinct_field in ['country', 'city']:
+        raise Exception("Distinct counts of country or city require geo location.")
+
+    # Rollups: time buckets are counted from these fields
+    if self.args.rollup_interval:
+      out_fields  = self.get_out_fields()
+      field_names = [(i, out_fields[i]['human_name']) for i in ['time', 'http_status', 'bytes_in', 'bytes_out', 'duration']]
+
+    # Log entry fields to parse: time and remote host are always needed for date filter and time diff
+    field_keys   = [i[0] for i in field_names]
+    entry_fields = ['time', 'remote_host']
+    if time_lower is not None or time_upper is not None:
+      entry_fields.append('timestamp')
+    if 'http_status' in field_keys or len(codes) > 0:
+      entry_fields.append('status')
+    if 'user_agent' in field_keys:
+      entry_fields.append('user_agent')
+    if 'http_request' in field_keys:
+      entry_fields.append('http_request')
+    for key in ['bytes_in', 'bytes_out', 'duration']:
+      if key in field_keys:
+        entry_fields.append(key)
+
+    # Fields of the where expression
+    if where is not None:
+      for key in where.fields:
+        key = where.entry_keys.get(key)
+        if key is not None and key not in entry_fields:
+          entry_fields.append(key)
+
+    parser      = entry_parser(log_format, self.local_networks, self.args.parser_engine, entry_fields)
+    line_filter = parser.get_line_filter(codes, date_lower, date_upper)
+
+    if parser.engine != self.args.parser_engine:
+      self.txt.print_verbose('Parser', 'fast parser not supported ({}), using apachelogs'.format(parser.unsupported))
+
+    filters = {
+      'codes':                 codes,
+      'countries':             countries,
+      'date_lower':            date_lower,
+      'date_upper':            date_upper,
+      'time_lower':            time_lower,
+      'time_upper':            time_upper,
+      'use_geolocation':       use_geolocation,
+      'geotool_ok':            geotool_ok,
+      'geotool_exec':          geotool_exec,
+      'geo_database_location': geo_database_location,
+      'geo_reader':            geo_reader,
+      'geo_cache':             stats['geo_cache'],
+      'geo_store':             stats['geo_store'],
+      'geo_cache_prefix':      self.args.geo_cache_prefix,
+      'geo_workers':           self.args.geo_workers,
+      'sessions':              stats['sessions'],
+      'state':                 None
+    }
 
-    self.txt.print_verbose(
-      'Log entry range',
-      str(files_process_data['files'][0]['line_start_global'])
-      + ' - ' +
-      str(files_process_data['files'][-1]['line_end_global'])
+    files_input = self.get_files_ordered(
+      self.get_files(self.args.files_regex, self.args.files_list),
+      self.args.sort_logs_by_info
     )
 
     if self.args.show_progress or self.args.verbose:
-      print(
-        "File count: {}\nLines in total: {}".format(
-          str(files_total),
-          str(lines_total)
-        ))
+      print("File count: {}".format(str(len(files_input))), file = sys.stderr)
+
+    if len([i for i in [self.args.read_first_lines_num, self.args.read_last_lines_num, self.args.read_lines_range] if i]) > 1:
+      raise Exception("Only one of first, last or range line limits can be used.")
+
+    if self.args.read_lines_range:
+      files_input = self.get_file_lines_range(files_input, *self.args.read_lines_range)
+
+    # Incremental runs: continue from offsets processed on the previous run
+    if self.args.state_file:
+      if self.args.read_first_lines_num is not None or self.args.read_last_lines_num is not None or \
+         self.args.read_lines_range or self.args.time_ordered:
+        raise Exception("State file can't be used with first, last or range line limits or time-ordered files.")
+      stats['state']   = run_state(self.txt, self.fp, os.path.expanduser(self.args.state_file), stats['sessions'])
+      filters['state'] = stats['state']
+      files_input      = stats['state'].resume(files_input)
+
+    # Time-ordered files: seek to the day range instead of checking every line
+    if self.args.time_ordered and (date_lower is not None or date_upper is not None):
+      if self.args.read_first_lines_num is not None or self.args.read_last_lines_num is not None or self.args.read_lines_range:
+        raise Exception("Time-ordered day range can't be used with first, last or range line limits.")
+      files_input = self.get_files_time_range(files_input, date_lower, date_upper)
+
+    # Read last N lines: seek to the start of the last lines instead of reading whole files
+    if self.args.read_last_lines_num is not None and self.args.read_last_lines_num >= 0:
+      files_input = self.get_files_tail(files_input, self.args.read_last_lines_num)
+
+    # Log entries of a single input file, read from its parse cache or parsed
+    cache = None
+    if self.args.build_cache or self.args.use_cache:
+      if self.args.read_first_lines_num is not None or self.args.follow or self.args.state_file or self.args.jobs > 1:
+        raise Exception("Parse cache can't be used with first line limit, following files, state file or parallel jobs.")
+      cache = parse_cache(
+        self.txt,
+        os.path.expanduser(self.args.cache_dir),
+        entry_parser(log_format, self.local_networks, self.args.parser_engine),
+        {'log_format': log_format, 'local_networks': [str(i) for i in self.local_networks.networks]},
+        entry_fields
+      )
+      # Where expressions without geo location fields are evaluated on cached columns with NumPy
+      if where is not None and where.np is not None and not where.uses_geo() and 'log_file_name' not in where.fields:
+        cache_where = where
+        where       = None
+      else:
+        cache_where = None
+      read_file = lambda lfile: self.read_cached_file(
+        lfile, cache, self.args.build_cache, parser, line_filter, filters, invalid_lines, stats, cache_where
+      )
+    else:
+      read_file = lambda lfile: self.parse_lines(self.read_lines([lfile], stats), parser, line_filter, invalid_lines, stats)
+
+    # Aggregates are counted on cached columns with NumPy, without building rows of cached files.
+    # Session statistics, geo locations, where expressions on log entries and limits need rows.
+    aggregate_columns = ['http_status', 'remote_host', 'time', 'user_agent', 'http_request', 'bytes_in', 'bytes_out', 'duration']
+    if cache is not None and cache.np is not None and self.args.aggregate and set(field_keys) <= set(aggregate_columns) and \
+       where is None and not use_geolocation and not self.args.merge_by_time and not self.args.show_stats and self.args.limit is None:
+      stats['aggregate_counts'] = self.count_cached_files(
+        files_input, cache, self.args.build_cache, parser, line_filter, field_keys, filters, invalid_lines, stats, cache_where
+      )
+      return [(row for row in []), stats, stri, field_names, invalid_lines]
+
+    # Follow mode: files are followed in this process after they have been read
+    if self.args.follow:
+      if self.args.read_first_lines_num is not None or self.args.read_lines_range:
+        raise Exception("Following files can't be used with first or range line limits.")
+      lines   = self.follow_lines(files_input, stats, self.args.follow_interval)
+      entries = self.parse_lines(lines, parser, line_filter, invalid_lines, stats)
+
+    # Several log files, e.g. of virtual hosts or load balanced servers, are merged in time order
+    elif self.args.merge_by_time:
+      if self.args.read_first_lines_num is not None or self.args.jobs > 1:
+        raise Exception("Merging files by time can't be used with first line limit or parallel jobs.")
+      entries = self.merge_entries_by_time(files_input, read_file)
+
+    # Parsed log caches are read file by file
+    elif cache is not None:
+      entries = itertools.chain.from_iterable([read_file(i) for i in files_input])
+
+    # Reading first N lines is sequential by nature and is always done in this process
+    elif self.args.jobs > 1 and self.args.read_first_lines_num is None:
+      entries = self.parse_files_parallel(files_input, log_format, entry_fields, filters, self.args.jobs, invalid_lines, stats)
+    else:
+      lines   = self.read_lines(files_input, stats)
+      lines   = self.select_lines(lines, self.args.read_first_lines_num)
+      entries = self.parse_lines(lines, parser, line_filter, invalid_lines, stats)
+    entries = self.check_entries(entries, filters)
 
-    for lfile in files_process_data['files']:
+    # Where expressions are evaluated before geo lookups, unless they use geo location fields
+    where_batch = 1 if self.args.follow else 4096
+    if where is not None and not where.uses_geo():
+      entries = self.where_entries(entries, where, where_batch)
 
-      if self.args.show_progress or self.args.verbose:
-        print("Processing file: {:s} (lines: {:d}-{:d})".format(
-          lfile['file'],
-          lfile['line_start_global'], lfile['line_end_global']
-        ))
+    # Followed entries are emitted as they arrive, without waiting for a batch
+    if use_geolocation:
+      entries = self.enrich_entries(entries, filters, 1 if self.args.follow else 1000, not self.args.follow)
 
-      if not self.check_file(lfile['file'], "os.R_OK"):
-        raise Exception("Couldn't read input file '{}'.".format(lfile['file']))
+    if where is not None and where.uses_geo():
+      entries = self.where_entries(entries, where, where_batch)
 
-      with open(lfile['file'], 'r') as f:
-        f = list(f)
-        range_start = files_process_data['files'][file_num]['line_start_local']
-        range_end   = files_process_data['files'][file_num]['line_end_local']
+    rows    = self.filter_entries(entries, field_keys, filters)
 
-        lines = range(range_start, range_end)
-        line_num = 1
+    return [rows, stats, stri, field_names, invalid_lines]
+
+  """
+  Print a single output row
+  """
+  def print_entry(self, entry, stri, output_format):
 
-        for line in lines:
+    entry_items = [str(i) for i in entry]
 
-          if self.args.show_progress or self.args.verbose:
-            print("Processing log entry: {:d}/{:d} ({}%)".format(
-              line_num,
-              len(lines),
-              round(100 * (line_num/len(lines)), 2)
-            ), end = "\r")
+    if output_format == 'table':
+      print(stri.format(*entry_items).lstrip())
 
-          if line_num != 1 and not (skip_line_by_status or skip_line_by_country) and entry_data:
-            prev_host      = entry_data['remote_host']
-            prev_host_time = entry_data['time']
+    if output_format == 'csv':
+      print(','.join(entry_items))
 
-          try:
-            if re.match('|'.join(self.private_class_ip_networks), f[line]):
-              entry = parser_local.parse(f[line])
-            else:
-              entry = parser.parse(f[line])
-          except InvalidEntryError:
-            invalid_lines.append((lfile['file'], line_num))
-            line_num += 1
-            continue
+  """
+  Count a batch of output rows by each aggregated field
+  Values of a field column are counted at once, and each distinct value is added to its counter once per batch.
+  """
+  def count_aggregates(self, counters, rows):
 
-          entry_data = {
-            'time':         entry.request_time.replace(tzinfo = None),
-            'user_agent':   entry.headers_in["User-Agent"],
-            'http_request': str(entry.request_line).encode('unicode_escape').decode(),
-            'remote_host':  entry.remote_host,
-            'status':       entry.final_status
-          }
+    for i, counter in enumerate(counters):
+      for key, count in collections.Counter([row[i] for row in rows]).items():
+        counter.add(key, count)
 
-          if not self.date_checker(date_lower, date_upper, entry_data['time']):
-            line_num += 1
-            continue
+  """
+  Print most frequent values of aggregated fields
+  Approximate counts are printed with their maximum error
+  """
+  def print_aggregates(self, counters, out_fields, out_fields_human_names, top_count, output_format, print_headers):
 
-          if len(codes) > 0:
-             skip_line_by_status = self.filter_status_code(codes, entry_data['status'])
+    if output_format == 'csv' and print_headers:
+      print(','.join(['Field', 'Value', 'Count', 'Max error']))
 
-          if use_geolocation:
-            if prev_host == entry_data['remote_host']:
-                country_seen = True
-            else:
-              country_seen = False
+    for key, human_name, counter in zip(out_fields, out_fields_human_names, counters):
 
-            if not country_seen:
-              geo_data = self.geotool_get_data(geotool_ok, geotool_exec, geo_database_location, entry_data['remote_host'])
+      approximate = counter.is_approximate()
 
-            if len(countries) > 0 and geo_data is not None:
-              skip_line_by_country = self.filter_country(countries, geo_data['host_country'])
+      if output_format == 'table':
+        print("Top {:d}: {:s}{:s}".format(top_count, human_name, " (approximate)" if approximate else ""))
+        for value, count, error in counter.top(top_count):
+          print("{:>10d}  {:s}{:s}".format(count, str(value), "  (error <= {:d})".format(error) if approximate else ""))
+        print("")
 
-          else:
-            skip_line_by_country = False
+      if output_format == 'csv':
+        for value, count, error in counter.top(top_count):
+          print(','.join([key, str(value), str(count), str(error)]))
 
-          if skip_line_by_status or skip_line_by_country:
-            line_num += 1
-            continue
+  """
+  Get distinct counter, with sketches of sketch files merged
+  """
+  def get_distinct_counter(self):
+
+    out_fields = self.get_out_fields()
+    group_keys = ['day', 'country', 'http_status']
+
+    if self.args.distinct_field not in out_fields:
+      raise Exception("Unknown distinct field: {}. Accepted values: {}".format(self.args.distinct_field, ','.join(out_fields.keys())))
+
+    for key in self.args.distinct_by:
+      if key not in group_keys:
+        raise Exception("Unknown distinct group: {}. Accepted values: {}".format(key, ','.join(group_keys)))
+
+    distinct = distinct_counter(self.args.distinct_field, self.args.distinct_by, self.args.distinct_precision)
+
+    if self.args.sketch_file:
+      distinct.load(os.path.expanduser(self.args.sketch_file), missing_ok = True)
+
+    for sketch_file in self.args.merge_sketches or []:
+      distinct.load(os.path.expanduser(sketch_file))
+
+    return distinct
+
+  """
+  Print distinct counts by group
+  """
+  def print_distinct(self, distinct, output_format, print_headers):
+
+    group_formats = {
+      'day':         ('Day',     '{:10s}'),
+      'country':     ('Country', '{:20s}'),
+      'http_status': ('Status',  '{:6s}')
+    }
+
+    headers = [group_formats[i][0] for i in distinct.group_by]
+    headers.append("Distinct " + self.get_out_fields()[distinct.field]['human_name'])
+    stri    = ''.join(["\t" + group_formats[i][1] for i in distinct.group_by]) + "\t{:s}"
+
+    if print_headers:
+      if output_format == 'table':
+        print(stri.format(*headers).lstrip())
+      if output_format == 'csv':
+        print(','.join(headers))
+
+    for group, count in distinct.counts():
+      self.print_entry(list(group) + [count], stri, output_format)
 
-          time_diff = str('NEW_CONN')
-          if prev_host == entry_data['remote_host']:
-            time_diff = (entry_data['time'] - prev_host_time).total_seconds()
-            if isinstance(time_diff, float):
-              time_diff = int(time_diff)
-            if time_diff > 0:
-              time_diff = "+" + str(time_diff)
-          if line_num == 1 and file_num == 0:
-            time_diff = int(0)
-
-          if 'log_file_name' in fields:
-            fields['log_file_name']['data'] = lfile
-          if 'http_status' in fields:
-            fields['http_status']['data'] = entry_data['status']
-          if 'remote_host' in fields:
-            fields['remote_host']['data'] = entry_data['remote_host']
-
-          if geo_data is not None:
-            if 'country' in fields:
-              fields['country']['data'] = geo_data['host_country']
-            if 'city' in fields:
-              fields['city']['data'] = geo_data['host_city']
-
-          if 'time' in fields:
-            fields['time']['data'] = entry_data['time']
-          if 'time_diff' in fields:
-            fields['time_diff']['data'] = time_diff
-          if 'user_agent' in fields:
-            fields['user_agent']['data'] = entry_data['user_agent']
-          if 'http_request' in fields:
-            fields['http_request']['data'] = entry_data['http_request']
-
-          stri = ""
-          printargs = []
-
-          for key, value in fields.items():
-            if not use_geolocation and (key == 'country' or key == 'city'):
-              continue
-            if value['included']:
-              stri += "\t" + value['format']
-              printargs.append(value['data'])
-
-              if not any(key in i for i in field_names):
-                field_names.append((key, value['human_name']))
-
-          log_entries.append(printargs)
-          line_num += 1
-        print()
-      file_num += 1
-
-    return [log_entries, files_process_data['files'], lines_total, stri, field_names, invalid_lines]
+  """
+  Print time bucket rollups
+  Request duration percentiles are printed in milliseconds
+  """
+  def print_rollups(self, rollup, output_format, print_headers):
+
+    headers   = ['Time', 'Requests', '1xx', '2xx', '3xx', '4xx', '5xx', 'Bytes in', 'Bytes out', 'p50 ms', 'p95 ms', 'p99 ms']
+    stri      = "\t{:19s}\t{:>8s}" + "\t{:>6s}" * 5 + "\t{:>12s}" * 2 + "\t{:>8s}" * 3
+    quantiles = [0.5, 0.95, 0.99]
+
+    if print_headers:
+      if output_format == 'table':
+        print(stri.format(*headers).lstrip())
+      if output_format == 'csv':
+        print(','.join(headers))
+
+    for start, bucket in rollup.get_buckets():
+
+      row = [start, bucket['requests']] + bucket['status'] + [
+        bucket['bytes_in']  if bucket['bytes_in']  is not None else '-',
+        bucket['bytes_out'] if bucket['bytes_out'] is not None else '-'
+      ]
+
+      for q in quantiles:
+        value = bucket['duration'].quantile(q)
+        row.append("{:.1f}".format(value / 1000) if value is not None else '-')
+
+      self.print_entry(row, stri, output_format)
 
   """
   Execute
@@ -1018,7 +5156,6 @@ class program(object):
   def execute(self):
 
     print_headers  = self.args.column_headers
-    show_progress  = self.args.show_progress
     show_stats     = self.args.show_stats
     output_format  = self.args.output_format
 
@@ -1030,52 +5167,156 @@ class program(object):
         if sortby_field and sortby_field not in self.args.incl_fields:
           raise Exception("Sort-by field must be included in output fields.")
 
+    if sortby_field is None and reverse_order:
+      raise Exception("You must define a field for reverse sorting.")
+
+    if self.args.limit is not None and self.args.limit < 0:
+      raise Exception("Limit must be zero or greater.")
+
+    if self.args.sort_memory < 1:
+      raise Exception("Sort memory must be at least 1 MB.")
+
+    if self.args.limit is not None and self.args.state_file:
+      raise Exception("Limit can't be used with a state file.")
+
+    if sortby_field is not None and self.args.follow:
+      raise Exception("Sorting can't be used with following files.")
+
+    if sortby_field is not None and self.args.aggregate:
+      raise Exception("Sorting can't be used with aggregation.")
+
+    if sortby_field is not None and self.args.distinct_field:
+      raise Exception("Sorting can't be used with distinct counts.")
+
+    if sortby_field is not None and self.args.rollup_interval:
+      raise Exception("Sorting can't be used with rollups.")
+
+    if len([i for i in [self.args.aggregate, self.args.distinct_field, self.args.rollup_interval] if i]) > 1:
+      raise Exception("Only one of aggregation, distinct counts or rollups can be used.")
+
+    # Distinct counts continue from sketch files. Without input log files, only sketch files are merged.
+    distinct = None
+    if self.args.distinct_field:
+      distinct = self.get_distinct_counter()
+
+      if self.args.files_regex is None and self.args.files_list is None and \
+         (self.args.sketch_file or self.args.merge_sketches):
+        if self.args.sketch_file:
+          distinct.save(os.path.expanduser(self.args.sketch_file))
+        self.print_distinct(distinct, output_format, print_headers)
+        return
+
     results = self.process_files()
     result_entries = results[0]
-    result_files   = results[1]
-    result_lines   = results[2]
-    stri           = results[3]
-    out_fields     = [i[0] for i in results[4]]
-    out_fields_human_names = [i[1] for i in results[4]]
-    invalid_lines  = results[5]
+    result_stats   = results[1]
+    stri           = results[2]
+    out_fields     = [i[0] for i in results[3]]
+    out_fields_human_names = [i[1] for i in results[3]]
+    invalid_lines  = results[4]
 
-    if sortby_field is None and reverse_order:
-      raise Exception("You must define a field for reverse sorting.")
+    # Rows are counted before sorting and limits, so that limited output has the same matched count
+    result_entries = self.count_entries(result_entries, result_stats)
 
+    # Only sorting requires buffering of output rows; otherwise rows are printed as they are produced
+    # Rows exceeding the sort memory are spilled to temporary files
     if sortby_field is not None:
       out_field_validation = self.get_out_field(out_fields, sortby_field)
       if out_field_validation[0]:
-        result_entries.sort(
-          key = lambda r : r[out_field_validation[1]] or '',
-          reverse = reverse_order
-        )
+        sort_key = self.get_sort_key(sortby_field, out_field_validation[1])
 
-    if output_format == 'table':
+        # Limited output: only the first N rows are kept in a bounded heap
+        if self.args.limit is not None:
+          if reverse_order:
+            result_entries = heapq.nlargest(self.args.limit, result_entries, key = sort_key)
+          else:
+            result_entries = heapq.nsmallest(self.args.limit, result_entries, key = sort_key)
+        else:
+          sorter = external_sorter(self.txt, sort_key, reverse_order, self.args.sort_memory * 1048576)
+          result_entries = sorter.sort(result_entries)
+
+    # Limited output without sorting: processing stops after N rows
+    elif self.args.limit is not None:
+      result_entries = itertools.islice(result_entries, self.args.limit)
 
-      if print_headers:
+    if print_headers and not self.args.aggregate and distinct is None and not self.args.rollup_interval:
+      if output_format == 'table':
         print("\n")
         print(stri.format(*out_fields_human_names).lstrip())
 
-      for entry in result_entries:
-        c = 0
-        entry_items = []
-        while c < len(entry):
-          entry_items.append(str(entry[c]))
-          c += 1
-        print(stri.format(*entry_items).lstrip())
+      if output_format == 'csv':
+        print(','.join(out_fields_human_names))
 
-    if output_format == 'csv':
+    # Aggregation: rows are counted by each aggregated field instead of printing them
+    counters = None
+    if self.args.aggregate:
+      capacity = math.ceil(1 / self.args.aggregate_error)
+      counters = [top_counter(capacity) for i in out_fields]
 
-      if print_headers:
-        print(','.join(out_fields_human_names))
+    rollup = None
+    if self.args.rollup_interval:
+      rollup = time_rollup(self.args.rollup_interval, self.args.rollup_accuracy)
 
+    # Following files is stopped with Ctrl+C
+    batch = []
+    try:
       for entry in result_entries:
-        c = 0
-        entry_items = []
-        while c < len(entry):
-          entry_items.append(str(entry[c]))
-          c += 1
-        print(','.join(entry_items))
+
+        if counters is not None:
+          batch.append(entry)
+          if len(batch) >= 4096:
+            self.count_aggregates(counters, batch)
+            batch = []
+          continue
+
+        if rollup is not None:
+          rollup.add(*entry)
+          continue
+
+        # Distinct values are grouped by day of log entry time. Missing values are not counted.
+        if distinct is not None:
+          if entry[0] is not None:
+            group = [i.strftime('%Y-%m-%d') if isinstance(i, datetime) else str(i) for i in entry[1:]]
+            distinct.add(tuple(group), str(entry[0]))
+          continue
+
+        self.print_entry(entry, stri, output_format)
+
+        if self.args.follow:
+          sys.stdout.flush()
+
+    except KeyboardInterrupt:
+      if not self.args.follow:
+        raise
+
+    # Input files and geo lookups are closed also when processing stopped early
+    results[0].close()
+
+    if counters is not None:
+      self.count_aggregates(counters, batch)
+
+      # Values counted on cached columns
+      if result_stats['aggregate_counts'] is not None:
+        for value_counts in result_stats['aggregate_counts']:
+          for counter, counts in zip(counters, value_counts):
+            for key, count in counts:
+              counter.add(key, count)
+
+      self.print_aggregates(counters, out_fields, out_fields_human_names, self.args.aggregate_top, output_format, print_headers)
+
+    if rollup is not None:
+      self.print_rollups(rollup, output_format, print_headers)
+
+    # Sketches are stored before the state file: values counted again on a failed run don't change distinct counts
+    if distinct is not None:
+      if self.args.sketch_file:
+        distinct.save(os.path.expanduser(self.args.sketch_file))
+      self.print_distinct(distinct, output_format, print_headers)
+
+    if result_stats['geo_store'] is not None:
+      result_stats['geo_store'].close()
+
+    if result_stats['state'] is not None:
+      result_stats['state'].save()
 
     if show_stats:
       print(("\n" +
@@ -1083,11 +5324,29 @@ class program(object):
         "Processed log entries: {:d}\n" +
         "Matched log entries:   {:d}\n"
              ).format(
-          ', '.join([i['file'] for i in result_files]),
-          result_lines,
-          len(result_entries)
+          ', '.join([i['file'] for i in result_stats['files']]),
+          result_stats['lines_processed'],
+          result_stats['lines_matched']
         )
       )
+      session_stats = result_stats['sessions'].get_stats()
+      print("Sessions:              count: {:d}, average duration: {:.0f}s, longest: {:d}s, average log entries: {:.1f}\n".format(*session_stats))
+      print("Session table:         hosts: {:d}, peak: {:d}, evictions: {:d}\n".format(
+        len(result_stats['sessions'].hosts),
+        result_stats['sessions'].peak_size,
+        result_stats['sessions'].evictions
+      ))
+      if result_stats['geo_cache'] is not None:
+        print("Geo cache:             hits: {:d}, misses: {:d}, evictions: {:d}\n".format(
+          result_stats['geo_cache'].hits,
+          result_stats['geo_cache'].misses,
+          result_stats['geo_cache'].evictions
+        ))
+      if result_stats['geo_store'] is not None:
+        print("Geo cache file:        hits: {:d}, misses: {:d}\n".format(
+          result_stats['geo_store'].hits,
+          result_stats['geo_store'].misses
+        ))
       if len(invalid_lines) > 0:
         print("Invalid lines:")
         for i in invalid_lines:
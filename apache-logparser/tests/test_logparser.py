@@ -0,0 +1,859 @@
+import bz2
+import collections
+import gzip
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logparser
+
+
+"""
+Space-Saving top-k counts
+"""
+def skewed_stream(keys = 1000, seed = 1):
+  stream = []
+  for k in range(1, keys + 1):
+    stream += ['key{}'.format(k)] * (20000 // k)
+  random.Random(seed).shuffle(stream)
+  return stream
+
+def test_top_counter_exact_below_capacity():
+  counter = logparser.top_counter(100)
+  stream  = skewed_stream(50)
+  for i in stream:
+    counter.add(i)
+
+  assert not counter.is_approximate()
+  assert counter.top(5) == [(key, count, 0) for key, count in collections.Counter(stream).most_common(5)]
+
+def test_top_counter_skewed_stream():
+  capacity = 100
+  counter  = logparser.top_counter(capacity)
+  stream   = skewed_stream()
+  for i in stream:
+    counter.add(i)
+
+  exact = collections.Counter(stream)
+  top   = counter.top(10)
+
+  assert counter.is_approximate()
+  assert [i[0] for i in top] == [i[0] for i in exact.most_common(10)]
+
+  # Counts are overestimated at most by the error bound, which is at most total / capacity
+  for key, count, error in top:
+    assert exact[key] <= count <= exact[key] + error
+    assert error <= len(stream) / capacity
+
+def test_top_counter_weighted_adds():
+  counter = logparser.top_counter(10)
+  stream  = skewed_stream(100)
+  for key, count in collections.Counter(stream).items():
+    counter.add(key, count)
+
+  assert counter.total == len(stream)
+  assert counter.top(1)[0][0] == 'key1'
+
+
+"""
+HyperLogLog distinct counts
+"""
+def hll_of(values, precision = 14):
+  sketch = logparser.hyperloglog(precision)
+  for i in values:
+    sketch.add(i)
+  return sketch
+
+def test_hyperloglog_error_bound():
+  for precision in [10, 14]:
+    count  = 50000
+    sketch = hll_of(['10.0.{}.{}'.format(i // 256, i % 256) for i in range(count)], precision)
+
+    # Three standard errors
+    assert abs(sketch.count() - count) <= 3 * 1.04 / (2 ** precision) ** 0.5 * count
+
+def test_hyperloglog_small_counts():
+  assert hll_of([]).count() == 0
+  assert abs(hll_of([str(i) for i in range(100)]).count() - 100) <= 2
+  assert hll_of(['a'] * 1000).count() == 1
+
+def test_hyperloglog_merge():
+  values_a = [str(i) for i in range(0, 30000)]
+  values_b = [str(i) for i in range(20000, 60000)]
+
+  # Sparse and dense sketches
+  for count in [100, 30000]:
+    merged = hll_of(values_a[:count])
+    merged.merge(hll_of(values_b[:count]))
+    assert merged.serialize() == hll_of(values_a[:count] + values_b[:count]).serialize()
+
+  with pytest.raises(Exception, match = 'different precision'):
+    hll_of(values_a, 14).merge(hll_of(values_b, 12))
+
+def test_hyperloglog_fold():
+  values = [str(i) for i in range(20000)]
+  assert hll_of(values, 14).fold(10).serialize() == hll_of(values, 10).serialize()
+
+def test_hyperloglog_serialize():
+  for count in [10, 20000]:
+    sketch = hll_of([str(i) for i in range(count)])
+    loaded = logparser.hyperloglog.deserialize(14, sketch.serialize())
+    assert loaded.count() == sketch.count()
+    assert loaded.serialize() == sketch.serialize()
+
+def test_distinct_counter_sketch_files(tmp_path):
+  sketch_file = str(tmp_path / 'sketch.json')
+
+  counter = logparser.distinct_counter('remote_host', ['time', 'http_status'], 14)
+  for i in range(2000):
+    counter.add(('2022-06-01', str(200 + i % 2)), 'host{}'.format(i))
+  counter.save(sketch_file)
+
+  # Rolled up by day and folded to a lower precision
+  merged = logparser.distinct_counter('remote_host', ['time'], 12)
+  for i in range(1000, 3000):
+    merged.add(('2022-06-01',), 'host{}'.format(i))
+  merged.load(sketch_file)
+
+  [(group, count)] = merged.counts()
+  assert group == ('2022-06-01',)
+  assert abs(count - 3000) <= 3 * 1.04 / 64 * 3000
+
+  # Loading the same file again doesn't change counts
+  merged.load(sketch_file)
+  assert merged.counts() == [(group, count)]
+
+
+"""
+DDSketch quantiles
+"""
+def test_quantile_sketch_error_bound():
+  values = [random.Random(2).lognormvariate(10, 2) for i in range(20000)] + [0] * 100
+  exact  = sorted(values)
+
+  for accuracy, max_bins in [(0.01, 2048), (0.02, 2048), (0.01, 200)]:
+    sketch = logparser.quantile_sketch(accuracy, max_bins)
+    for i in values:
+      sketch.add(i)
+
+    assert len(sketch.bins) <= max_bins
+
+    # Collapsed lowest bins only affect low quantiles
+    for q in [0.5, 0.95, 0.99, 0.999, 1]:
+      value = exact[int(q * (len(values) - 1))]
+      assert abs(sketch.quantile(q) - value) <= accuracy * value
+
+  assert sketch.quantile(0) == 0
+  assert logparser.quantile_sketch().quantile(0.5) is None
+
+
+"""
+Fast parser and apachelogs
+"""
+def test_parsers_equal_output():
+  log_format     = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %I %O %D'
+  local_networks = logparser.network_classifier(['127.0.0.0/8', '::1/128'])
+  lines          = [
+    '93.184.216.34 - - [07/Jun/2022:00:02:55 +0000] "GET /index.html HTTP/1.1" 404 1982 "-" "curl/7.1" 691 2100 1503',
+    '8.8.8.8 - bob [07/Jun/2022:13:20:46 +0300] "GET /a\\"b?q=\\x1b[31m HTTP/1.1" 200 - "-" "Mozilla \\"quoted\\" \\\\ \\t\\xe2\\x82\\xac" 700 257 41',
+    '2001:db8::1 - - [31/Dec/2022:23:59:59 -0500] "-" 408 - "-" "-" 0 0 12',
+    '127.0.0.1 - - [01/Jan/2023:00:00:00 +0000] "POST /login HTTP/1.0" 302 5 "-" "Go-http-client/1.1" 15'
+  ]
+
+  fast       = logparser.entry_parser(log_format, local_networks, 'fast', logparser.entry_parser.entry_keys)
+  apachelogs = logparser.entry_parser(log_format, local_networks, 'apachelogs')
+
+  assert fast.engine == 'fast' and apachelogs.engine == 'apachelogs'
+
+  for line in lines:
+    entry_fast       = fast.parse(line)
+    entry_apachelogs = apachelogs.parse(line)
+    for key in logparser.entry_parser.entry_keys:
+      assert entry_fast[key] == entry_apachelogs[key], (key, line)
+
+def test_parsers_without_user_agent():
+  local_networks = logparser.network_classifier([])
+  lines          = [
+    ('%h %l %u %t "%r" %>s %b %D',                '93.184.216.34 - - [01/Jun/2022:00:00:00 +0000] "GET / HTTP/1.1" 200 4058 16796'),
+    ('%h %l %u [%{%d/%b/%Y %T}t] "%r" %>s %b %D', '93.184.216.34 - - [01/Jun/2022 00:00:00] "GET / HTTP/1.1" 200 4058 16796')
+  ]
+
+  for log_format, line in lines:
+    entry = logparser.entry_parser(log_format, local_networks, 'apachelogs').parse(line)
+    assert entry['user_agent'] is None
+    assert entry['http_request'] == 'GET / HTTP/1.1'
+    assert entry['duration'] == 16796
+
+
+"""
+External merge sort
+"""
+def test_external_sorter_spilled_runs():
+  txt  = logparser.text_processing(False)
+  rows = [[random.Random(3).randint(0, 50), i] for i in range(5000)]
+
+  for reverse in [False, True]:
+    for fan_in in [2, 3, 64]:
+      sorter = logparser.external_sorter(txt, lambda i: i[0], reverse, 4096, fan_in)
+      result = sorter.sort(iter(rows))
+
+      # Equal keys keep their input order
+      assert list(result) == sorted(rows, key = lambda i: i[0], reverse = reverse)
+      assert sorter.runs == []
+
+def test_external_sorter_in_memory():
+  txt    = logparser.text_processing(False)
+  rows   = [[i % 7, str(i)] for i in range(100)]
+  sorter = logparser.external_sorter(txt, lambda i: i[0])
+
+  assert list(sorter.sort(iter(rows))) == sorted(rows, key = lambda i: i[0])
+  assert list(sorter.sort(iter([]))) == []
+
+
+"""
+Parsed log cache
+"""
+LOG_FORMAT = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %I %O %D'
+
+def write_log(path, count = 3000):
+  rng        = random.Random(4)
+  hosts      = ['93.184.216.34', '8.8.8.8', '2001:db8::1', '127.0.0.1', '10.0.0.3']
+  requests   = ['GET / HTTP/1.1', 'GET /a\\"b HTTP/1.1', 'POST /login HTTP/1.1', '-']
+  agents     = ['curl/7.1', 'Mozilla \\"x\\" 5.0', '-', 'Googlebot/2.1']
+  lines      = []
+
+  for i in range(count):
+    host = rng.choice(hosts)
+    line = '{} - - [{:02d}/Jun/2022:{:02d}:{:02d}:{:02d} +0000] "{}" {} {} "-" "{}"'.format(
+      host, 1 + i // 1000, i // 60 % 24, i % 60, rng.randint(0, 59),
+      rng.choice(requests), rng.choice([200, 304, 404, 500, 503]), rng.choice(['-', rng.randint(0, 9999)]),
+      rng.choice(agents)
+    )
+    # Local hosts are logged without bytes in & out
+    if host not in ['127.0.0.1', '10.0.0.3']:
+      line += ' {} {}'.format(rng.randint(0, 999), rng.randint(0, 99999))
+    lines.append(line + ' {}'.format(rng.randint(0, 2000000)))
+
+  lines.insert(count // 2, 'not a log line')
+
+  with open(path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+
+def run_logparser(*args):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'logparser.py')
+  result = subprocess.run([sys.executable, script] + list(args), capture_output = True, text = True, check = True)
+  return result.stdout
+
+def test_parse_cache_round_trip(tmp_path):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+
+  txt            = logparser.text_processing(False)
+  local_networks = logparser.network_classifier(['127.0.0.0/8', '10.0.0.0/8'])
+  parser         = logparser.entry_parser(LOG_FORMAT, local_networks)
+  cache          = logparser.parse_cache(txt, str(tmp_path / 'cache'), parser, {'log_format': LOG_FORMAT})
+
+  with open(log_file) as f:
+    lines = [(None, i + 1, line.rstrip('\n')) for i, line in enumerate(f)]
+
+  header = cache.build(log_file, iter(lines))
+  assert header['line_count'] == len(lines)
+  assert cache.get_invalid(log_file, header) == [1501]
+  assert cache.get(log_file) is not None
+
+  entries = list(cache.read(log_file, cache.get(log_file)))
+  assert [i[0] for i in entries] == [i[1] for i in lines if i[1] != 1501]
+
+  for line_num, entry_data in entries:
+    expected = parser.parse(lines[line_num - 1][2])
+    for key in logparser.entry_parser.entry_keys:
+      assert entry_data[key] == expected[key], (key, line_num)
+
+  # Header has only metadata: string tables are columns
+  assert set(cache.get(log_file).keys()) == set(['identity', 'signature', 'byteorder', 'rows', 'line_count', 'columns', 'data_start'])
+
+  # Strings of other fields are not decoded
+  projected = logparser.parse_cache(txt, str(tmp_path / 'cache'), parser, {'log_format': LOG_FORMAT}, ['time', 'remote_host'])
+  for (line_num, entry_data), (_, expected) in zip(projected.read(log_file, cache.get(log_file)), entries):
+    assert entry_data['remote_host'] == expected['remote_host']
+    assert entry_data['user_agent'] is None and entry_data['http_request'] is None
+
+  # Changed log files and log formats invalidate the cache
+  other = logparser.parse_cache(txt, str(tmp_path / 'cache'), parser, {'log_format': '%h'})
+  assert other.get(log_file) is None
+
+  with open(log_file, 'a') as f:
+    f.write(lines[0][2] + '\n')
+  assert cache.get(log_file) is None
+
+def test_parse_cache_output(tmp_path):
+  log_file  = str(tmp_path / 'access_log')
+  cache_dir = str(tmp_path / 'cache')
+  write_log(log_file)
+
+  fields = 'http_status,remote_host,time,time_diff,user_agent,http_request,bytes_in,bytes_out,duration,session'
+  for args in [[], ['-c', '5..'], ['-dl', '02-06-2022'], ['--where', 'status == 404 or duration > 1500000']]:
+    args     = ['-f', log_file, '-lf', LOG_FORMAT, '-if', fields, '-st'] + args
+    expected = run_logparser(*args)
+
+    assert run_logparser(*(args + ['--build-cache', '--cache-dir', cache_dir])) == expected
+    assert run_logparser(*(args + ['--use-cache', '--cache-dir', cache_dir])) == expected
+
+def test_parse_cache_count_values(tmp_path):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+
+  txt    = logparser.text_processing(False)
+  parser = logparser.entry_parser(LOG_FORMAT, logparser.network_classifier(['127.0.0.0/8', '10.0.0.0/8']))
+  cache  = logparser.parse_cache(txt, str(tmp_path / 'cache'), parser, {'log_format': LOG_FORMAT})
+
+  with open(log_file) as f:
+    header = cache.build(log_file, ((None, i + 1, line.rstrip('\n')) for i, line in enumerate(f)))
+
+  keys   = ['remote_host', 'status', 'timestamp', 'user_agent', 'bytes_in', 'duration']
+  fields = ['remote_host', 'status', 'time', 'user_agent', 'bytes_in', 'duration']
+  where  = logparser.where_expression('status >= 404 and user_agent !~ "^curl"')
+
+  # Values are counted as from log entries, in order of their first log entry
+  for args in [(), (1654128000, 1654214400, set([200, 404])), (None, None, None, where)]:
+    rows, counts = cache.count_values(log_file, header, keys, *args)
+    entries      = [i[1] for i in cache.read(log_file, header, *args)]
+
+    assert rows == len(entries)
+    for field, value_counts in zip(fields, counts):
+      assert value_counts == list(collections.Counter([i[field] for i in entries]).items())
+
+def test_parse_cache_aggregates(tmp_path):
+  log_files = [str(tmp_path / 'access_log'), str(tmp_path / 'access_log.1')]
+  cache_dir = str(tmp_path / 'cache')
+  write_log(log_files[0])
+  write_log(log_files[1], count = 1000)
+
+  for args in [['-a', 'remote_host,http_status,user_agent,http_request'], ['-a', 'time,bytes_in,bytes_out,duration'],
+               ['-a', 'remote_host', '-c', '5..', '-dl', '02-06-2022'], ['-a', 'http_request', '--where', 'status >= 404'],
+               ['-a', 'remote_host', '--tail', '100'], ['-a', 'remote_host,time_diff'], ['-a', 'user_agent', '-st']]:
+    args     = ['-f', ','.join(log_files), '-lf', LOG_FORMAT] + args
+    expected = run_logparser(*args)
+
+    assert run_logparser(*(args + ['--build-cache', '--cache-dir', cache_dir])) == expected
+    assert run_logparser(*(args + ['--use-cache', '--cache-dir', cache_dir])) == expected
+
+
+"""
+Where expressions
+"""
+def where_entries(count = 2000):
+  rng     = random.Random(5)
+  entries = []
+  for i in range(count):
+    country = rng.choice(['Finland', 'Local', None])
+    entries.append(({'file': rng.choice(['access_log', 'access_log.1'])}, i + 1, {
+      'timestamp':    1654041600 + i * 60,
+      'status':       rng.choice([200, 304, 404, 500, 503, None]),
+      'remote_host':  rng.choice(['8.8.8.8', '10.0.0.3', '2001:db8::1']),
+      'user_agent':   rng.choice(['curl/7.1', 'Googlebot/2.1', 'Mozilla "x"', None]),
+      'http_request': rng.choice(['GET / HTTP/1.1', 'POST /login HTTP/1.1']),
+      'bytes_in':     rng.choice([None, rng.randint(0, 1000)]),
+      'bytes_out':    rng.randint(0, 10000),
+      'duration':     rng.randint(0, 2000000),
+      'geo_data':     None if country is None else {'host_country': country, 'host_city': 'Unknown'}
+    }))
+  return entries
+
+# Expression: reference predicate on (lfile, entry_data)
+WHERE_CASES = [
+  ('status >= 500',                  lambda f, e: e['status'] is not None and e['status'] >= 500),
+  ('status = 404',                   lambda f, e: e['status'] == 404),
+  ('status != 404',                  lambda f, e: e['status'] != 404),
+  ('status == 200 or status == 304 and bytes_out > 5000',
+                                     lambda f, e: e['status'] == 200 or (e['status'] == 304 and e['bytes_out'] > 5000)),
+  ('(status == 200 or status == 304) and bytes_out > 5000',
+                                     lambda f, e: e['status'] in [200, 304] and e['bytes_out'] > 5000),
+  ('not status == 200 and not bytes_in < 500',
+                                     lambda f, e: e['status'] != 200 and not (e['bytes_in'] is not None and e['bytes_in'] < 500)),
+  ('NOT (status < 400 OR duration <= 1000000)',
+                                     lambda f, e: not ((e['status'] is not None and e['status'] < 400) or e['duration'] <= 1000000)),
+  ('time > 2022-06-01T12:00:00 and time <= "2022-06-02 00:00:00"',
+                                     lambda f, e: 1654084800 < e['timestamp'] <= 1654128000),
+  ('user_agent ~ "(?i)bot|curl"',    lambda f, e: e['user_agent'] is not None and ('bot' in e['user_agent'] or 'curl' in e['user_agent'])),
+  ('user_agent !~ \'^curl\'',        lambda f, e: e['user_agent'] is None or not e['user_agent'].startswith('curl')),
+  ('user_agent == "Mozilla \\"x\\""', lambda f, e: e['user_agent'] == 'Mozilla "x"'),
+  ('http_request ~ "^POST" and remote_host == \'10.0.0.3\'',
+                                     lambda f, e: e['http_request'].startswith('POST') and e['remote_host'] == '10.0.0.3'),
+  ('country != "Local" and city == Unknown',
+                                     lambda f, e: e['geo_data'] is not None and e['geo_data']['host_country'] != 'Local'),
+  ('log_file_name ~ "\\.1$" or bytes_in >= 999',
+                                     lambda f, e: f['file'].endswith('.1') or (e['bytes_in'] is not None and e['bytes_in'] >= 999))
+]
+
+def test_where_expression_rows():
+  entries = where_entries()
+
+  for expression, reference in WHERE_CASES:
+    where = logparser.where_expression(expression)
+    where.np = None
+    assert [where.check(i[0], i[2]) for i in entries] == [reference(i[0], i[2]) for i in entries], expression
+
+def test_where_expression_numpy():
+  np      = pytest.importorskip('numpy')
+  entries = where_entries()
+
+  for expression, reference in WHERE_CASES:
+    where = logparser.where_expression(expression)
+    assert where.np is np
+
+    mask = where.get_mask(where.get_columns(entries))
+    assert mask.dtype == bool
+    assert mask.tolist() == [reference(i[0], i[2]) for i in entries], expression
+
+def test_where_expression_fields():
+  where = logparser.where_expression('status >= 500 and (country != "Local" or user_agent ~ "bot")')
+  assert where.fields == set(['http_status', 'country', 'user_agent'])
+  assert where.uses_geo()
+  assert not logparser.where_expression('time > 2022-06-01').uses_geo()
+
+def test_where_expression_errors():
+  for expression, message in [
+    ('',                    'expected a field name'),
+    ('status >>= 5',        'expected a value'),
+    ('foo == 1',            'Unknown where field'),
+    ('status == abc',       'Invalid number value'),
+    ('(status == 1',        "expected '\\)'"),
+    ('status == 1 and',     'expected a field name'),
+    ('status == 1 status',  'unexpected'),
+    ('time > 2022-13-01',   'Invalid time value'),
+    ('status ~ "5.."',      'Regular expression match'),
+    ('user_agent ~ "("',    'Invalid regular expression'),
+    ('user_agent == "abc',  'unexpected')
+  ]:
+    with pytest.raises(Exception, match = message):
+      logparser.where_expression(expression)
+
+
+"""
+Compressed log files
+"""
+def test_compressed_data_size(tmp_path):
+  fp   = logparser.file_processing()
+  data = b''.join([b'127.0.0.1 - - [01/Jun/2022:00:00:00 +0000] "GET / HTTP/1.1" 200 5\n' for i in range(10000)])
+
+  for name, compress, compression in [('log.gz', gzip.compress, 'gzip'), ('log.bz2', bz2.compress, 'bzip2')]:
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+      f.write(compress(data))
+
+    assert fp.get_compression(path) == compression
+    with fp.open_file(path, compression) as f:
+      assert f.read() == data
+
+  # Sizes are read from the gzip trailer, or are compressed sizes
+  assert fp.get_data_size(str(tmp_path / 'log.gz'), 'gzip') == len(data)
+  assert fp.get_data_size(str(tmp_path / 'log.bz2'), 'bzip2') == os.path.getsize(str(tmp_path / 'log.bz2'))
+
+
+"""
+Tail of log files
+"""
+def get_program(monkeypatch, *args):
+  monkeypatch.setattr(sys, 'argv', ['logparser.py', '-lf', LOG_FORMAT] + list(args))
+  return logparser.program()
+
+def test_file_tail_offset(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+  app = get_program(monkeypatch, '-f', log_file)
+
+  with open(log_file, 'rb') as f:
+    data = f.read()
+  lines = data.splitlines(True)
+
+  # Small blocks: line starts are found across block boundaries
+  for count in [1, 7, 1500, len(lines)]:
+    offset, lines_found = app.get_file_tail_offset(log_file, count, block_size = 100)
+    assert lines_found == count
+    assert data[offset:] == b''.join(lines[-count:])
+
+  assert app.get_file_tail_offset(log_file, len(lines) + 10) == (0, len(lines))
+
+  # Last line without a trailing newline
+  with open(log_file, 'wb') as f:
+    f.write(data.rstrip(b'\n'))
+  offset, lines_found = app.get_file_tail_offset(log_file, 3, block_size = 100)
+  assert data[offset:] == b''.join(lines[-3:])
+
+def test_stream_tail_offset(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+  app = get_program(monkeypatch, '-f', log_file)
+
+  with open(log_file, 'rb') as f:
+    data = f.read()
+  lines = data.splitlines(True)
+
+  with gzip.open(log_file + '.gz', 'wb') as f:
+    f.write(data)
+
+  lfile = {'file': log_file + '.gz', 'compression': 'gzip'}
+  for count in [1, 1500, len(lines) + 10]:
+    line_start, offset, lines_found = app.get_stream_tail_offset(lfile, count)
+    assert lines_found == min(count, len(lines))
+    assert line_start == len(lines) - lines_found + 1
+    assert data[offset:] == b''.join(lines[-lines_found:])
+
+def test_files_tail_line_numbers(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+  app = get_program(monkeypatch, '-f', log_file)
+
+  lfile = {'file': log_file, 'compression': None}
+  app.get_files_tail([lfile], 2000)
+  assert lfile['line_start'] == 1002
+
+  # Line numbers of invalid lines are counted from the start of the file
+  for args in [['--tail', '2000'], ['--tail', '2000', '--line-index', '--index-dir', str(tmp_path / 'index')]]:
+    output = run_logparser('-f', log_file, '-lf', LOG_FORMAT, '-st', *args)
+    assert 'line: 1501' in output
+
+
+"""
+Line offset index
+"""
+def test_line_index_offsets(tmp_path):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+  index    = logparser.line_index(logparser.text_processing(False), logparser.file_processing(), str(tmp_path / 'index'), interval = 100)
+
+  with open(log_file, 'rb') as f:
+    data = f.read()
+  lines = data.splitlines(True)
+
+  file_index = index.get(log_file)
+  assert index.get_line_count(file_index) == len(lines)
+  assert len(file_index['checkpoints']) == len(lines) // 100 + 1
+
+  for line_num in [1, 100, 101, 1501, len(lines)]:
+    offset = index.get_line_offset(file_index, line_num)
+    assert data[offset:].startswith(lines[line_num - 1])
+    assert index.get_offset_line(file_index, offset) == line_num
+
+def test_line_index_stale(tmp_path, capsys):
+  log_file  = str(tmp_path / 'access_log')
+  index_dir = str(tmp_path / 'index')
+  write_log(log_file)
+
+  def get_index():
+    index      = logparser.line_index(logparser.text_processing(True), logparser.file_processing(), index_dir, interval = 100)
+    file_index = index.get(log_file)
+    return index.get_line_count(file_index), capsys.readouterr().out
+
+  assert get_index() == (3001, 'VERBOSE [Line index]: building index, {}\n'.format(log_file))
+
+  # Unchanged files use the stored index
+  assert get_index() == (3001, '')
+
+  # Grown files are extended, and a partial last line is counted once
+  with open(log_file, 'a') as f:
+    f.write('not a log line\npartial')
+  assert get_index() == (3003, 'VERBOSE [Line index]: extending index, {}\n'.format(log_file))
+
+  # Truncated and replaced files are indexed again
+  with open(log_file, 'w') as f:
+    f.write('not a log line\n' * 10)
+  assert get_index() == (10, 'VERBOSE [Line index]: building index, {}\n'.format(log_file))
+
+  write_log(log_file + '.new', count = 200)
+  os.replace(log_file + '.new', log_file)
+  assert get_index() == (201, 'VERBOSE [Line index]: building index, {}\n'.format(log_file))
+
+
+"""
+Time-ordered log files
+"""
+def write_ordered_log(path):
+  lines = []
+  start = logparser.datetime(2022, 6, 1)
+
+  # Several lines share each timestamp, including midnight of each day
+  for i in range(3 * 24 * 12):
+    line_time = (start + logparser.timedelta(minutes = 5 * i)).strftime('%d/%b/%Y:%H:%M:%S')
+    for j in range(3):
+      lines.append('8.8.8.8 - - [{} +0000] "GET /{} HTTP/1.1" 200 5 "-" "curl/7.1" 10 20 30'.format(line_time, j))
+    if i % 100 == 50:
+      lines.append('not a log line')
+
+  with open(path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+
+def test_file_time_offset_day_boundaries(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_ordered_log(log_file)
+  app   = get_program(monkeypatch, '-f', log_file)
+  index = logparser.line_index(app.txt, app.fp)
+
+  with open(log_file, 'rb') as f:
+    data = f.read()
+  size = len(data)
+
+  targets = ['2022-05-31T23:59:59', '2022-06-01T00:00:00', '2022-06-02T00:00:00', '2022-06-02T23:59:59',
+             '2022-06-03T00:00:00', '2022-06-03T00:02:30', '2022-06-03T23:55:00', '2022-06-04T00:00:00']
+
+  for target in targets:
+    expected = 0
+    for line in data.splitlines(True):
+      line_time = index.get_line_time(line)
+      if line_time is not None and line_time >= target:
+        break
+      expected += len(line)
+
+    # Small blocks: bisection ends next to the boundary
+    with open(log_file, 'rb') as f:
+      for block_size in [64, 1000, 65536]:
+        assert app.get_file_time_offset(f, size, target, index, block_size = block_size) == expected, (target, block_size)
+
+  # Day range entries are equal with and without binary search
+  for args in [['-dl', '02-06-2022'], ['-du', '03-06-2022'], ['-dl', '02-06-2022', '-du', '03-06-2022']]:
+    args = ['-f', log_file, '-lf', LOG_FORMAT] + args
+    assert run_logparser(*(args + ['--time-ordered'])) == run_logparser(*args)
+
+
+"""
+Parallel parsing
+"""
+def test_file_chunks(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+  app = get_program(monkeypatch, '-f', log_file)
+
+  with open(log_file, 'rb') as f:
+    data = f.read()
+
+  lfile  = {'file': log_file, 'compression': None, 'offset_start': 100, 'offset_end': None, 'size': len(data)}
+  chunks = [i[1] for i in app.get_file_chunks([lfile], chunk_size = 1000)]
+
+  # Chunks follow each other and end at line ends
+  assert len(chunks) > 100
+  assert chunks[0][2] == 100 and chunks[-1][3] == len(data)
+  for chunk, next_chunk in zip(chunks, chunks[1:]):
+    assert chunk[3] == next_chunk[2]
+    assert data[chunk[3] - 1:chunk[3]] == b'\n'
+
+def test_parallel_output(tmp_path):
+  log_files = [str(tmp_path / 'access_log'), str(tmp_path / 'access_log.1')]
+  write_log(log_files[0])
+  write_log(log_files[1], count = 1000)
+
+  with open(log_files[1], 'rb') as f_in, gzip.open(log_files[1] + '.gz', 'wb') as f_out:
+    f_out.write(f_in.read())
+  os.remove(log_files[1])
+
+  fields = 'http_status,remote_host,time,time_diff,user_agent,http_request,bytes_in,bytes_out,duration,session'
+  for args in [[], ['-c', '5..'], ['-dl', '02-06-2022'], ['--tail', '2000'], ['--line-range', '500-3500']]:
+    args = ['-f', log_files[0] + ',' + log_files[1] + '.gz', '-lf', LOG_FORMAT, '-if', fields, '-st'] + args
+    assert run_logparser(*(args + ['--jobs', '3'])) == run_logparser(*args)
+
+
+"""
+State file
+"""
+def append_numbered(path, start, count, mode = 'a'):
+  with open(path, mode) as f:
+    for i in range(start, start + count):
+      f.write('8.8.8.8 - - [01/Jun/2022:00:00:00 +0000] "GET /n{} HTTP/1.1" 200 5 "-" "curl/7.1" 10 20 30\n'.format(i))
+
+def run_numbered(*args):
+  output = run_logparser('-lf', LOG_FORMAT, '-if', 'http_request', *args)
+  return sorted([int(i.split(' ')[1][2:]) for i in output.splitlines() if i.startswith('GET /n')])
+
+def test_state_file_rotation(tmp_path):
+  log_file   = str(tmp_path / 'access_log')
+  state_file = str(tmp_path / 'state.json')
+  files      = log_file + '.1,' + log_file
+  append_numbered(log_file, 0, 1000)
+
+  assert run_numbered('-f', log_file, '--state-file', state_file) == list(range(0, 1000))
+  assert run_numbered('-f', log_file, '--state-file', state_file) == []
+
+  # Renamed file continues from its offset
+  append_numbered(log_file, 1000, 500)
+  os.rename(log_file, log_file + '.1')
+  append_numbered(log_file, 1500, 300)
+  assert run_numbered('-f', files, '--state-file', state_file) == list(range(1000, 1800))
+
+  # Compressed file is recognised by its decompressed first block
+  with open(log_file + '.1', 'rb') as f_in, gzip.open(log_file + '.2.gz', 'wb') as f_out:
+    f_out.write(f_in.read())
+  os.remove(log_file + '.1')
+  append_numbered(log_file, 1800, 200)
+  assert run_numbered('-f', log_file + '.2.gz,' + log_file, '--state-file', state_file) == list(range(1800, 2000))
+
+  # Truncated file with the same first lines is processed from the start
+  append_numbered(log_file, 1500, 100, 'w')
+  assert run_numbered('-f', log_file, '--state-file', state_file) == list(range(1500, 1600))
+
+  # Incomplete last line is left for the next run
+  append_numbered(log_file, 1600, 10)
+  with open(log_file, 'a') as f:
+    f.write('8.8.8.8 - - [01/Jun/2022:00:00:00 +0000] "GET /n1610 HTTP/1.1" 200 5')
+  assert run_numbered('-f', log_file, '--state-file', state_file) == list(range(1600, 1610))
+  with open(log_file, 'a') as f:
+    f.write(' "-" "curl/7.1" 10 20 30\n')
+  assert run_numbered('-f', log_file, '--state-file', state_file) == [1610]
+
+
+"""
+Sessions
+"""
+def test_session_table_timeout():
+  start    = logparser.datetime(2022, 6, 1)
+  at       = lambda seconds: start + logparser.timedelta(seconds = seconds)
+  sessions = logparser.session_table(1800)
+
+  assert sessions.update('a', at(0)) == (None, 1)
+  assert sessions.update('b', at(0)) == (None, 2)
+  assert sessions.update('a', at(600)) == (600, 1)
+
+  # Idle time equal to the timeout continues the session, and out of order entries extend it
+  assert sessions.update('a', at(2400)) == (1800, 1)
+  assert sessions.update('a', at(2300)) == (-100, 1)
+
+  # Idle hosts are evicted, and idle time longer than the timeout starts a new session
+  assert list(sessions.hosts.keys()) == ['a']
+  assert sessions.evictions == 1 and sessions.peak_size == 2
+  assert sessions.update('a', at(4201)) == (None, 3)
+  assert sessions.update('b', at(4201)) == (None, 4)
+
+  # Sessions: a 0-2400 (4 entries), b 0-0, a 4201, b 4201
+  assert sessions.get_stats() == (4, 600, 2400, 1.75)
+
+def test_session_table_resume():
+  start    = logparser.datetime(2022, 6, 1)
+  at       = lambda seconds: start + logparser.timedelta(seconds = seconds)
+  sessions = logparser.session_table(1800)
+
+  sessions.update('a', at(0))
+  sessions.update('a', at(100))
+
+  # Open sessions continue on the next run, and are counted only if they have new log entries
+  resumed = logparser.session_table(1800)
+  resumed.load(sessions.dump(), sessions.next_session_id)
+  assert resumed.get_stats() == (0, 0, 0, 0)
+  assert resumed.update('a', at(1000)) == (900, 1)
+  assert resumed.update('b', at(1000)) == (None, 2)
+  assert resumed.get_stats() == (2, 500, 1000, 1)
+
+  resumed = logparser.session_table(1800)
+  resumed.load(sessions.dump(), sessions.next_session_id)
+  assert resumed.update('a', at(1901)) == (None, 2)
+  assert resumed.session_count == 0
+
+
+"""
+Sorted and limited output
+"""
+def test_limit_sorted_output(tmp_path):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+
+  fields = 'http_status,remote_host,time,http_request,bytes_out,duration'
+  args   = ['-f', log_file, '-lf', LOG_FORMAT, '-if', fields, '-st']
+
+  for sort_args in [['-sb', 'duration'], ['-sb', 'duration', '-ro'], ['-sb', 'time', '-ro'], ['-sb', 'remote_host']]:
+    expected = run_logparser(*(args + sort_args)).split('\nProcessed files:')
+    limited  = run_logparser(*(args + sort_args + ['--limit', '10'])).split('\nProcessed files:')
+
+    # First rows of the sorted output, and the same statistics
+    assert limited[0].splitlines() == expected[0].splitlines()[:10]
+    assert limited[1] == expected[1]
+    assert 'Matched log entries:   3000\n' in limited[1]
+
+  # Without sorting, processing stops after N rows
+  limited = run_logparser(*(args + ['--limit', '10']))
+  assert 'Matched log entries:   10\n' in limited
+
+
+"""
+Merging files by time
+"""
+def test_merge_by_time_order(tmp_path):
+  log_files = [str(tmp_path / 'access_log.{}'.format(i)) for i in range(3)]
+  start     = logparser.datetime(2022, 6, 1)
+  rng       = random.Random(5)
+
+  # Time-ordered files with overlapping times, and log entries of the same time in several files
+  for i, log_file in enumerate(log_files):
+    seconds = sorted([rng.randint(0, 3000) for j in range(1000)] + [1000, 2000])
+    with open(log_file, 'w') as f:
+      for j, second in enumerate(seconds):
+        line_time = (start + logparser.timedelta(seconds = second)).strftime('%d/%b/%Y:%H:%M:%S')
+        f.write('8.8.8.8 - - [{} +0000] "GET /{}/{} HTTP/1.1" 200 5 "-" "curl/7.1" 10 20 30\n'.format(line_time, i, j))
+
+  with open(log_files[1], 'rb') as f_in, gzip.open(log_files[1] + '.gz', 'wb') as f_out:
+    f_out.write(f_in.read())
+  log_files[1] += '.gz'
+
+  args     = ['-f', ','.join(log_files), '-lf', LOG_FORMAT, '-if', 'time,http_request', '-st']
+  expected = run_logparser(*args).split('\nProcessed files:')
+
+  for merge_args in [['--merge-by-time'], ['--merge-by-time', '--build-cache', '--cache-dir', str(tmp_path / 'cache')]]:
+    output = run_logparser(*(args + merge_args)).split('\nProcessed files:')
+    rows   = [i.split('\t') for i in output[0].splitlines() if i]
+
+    # Log entries are in time order, and log entries of the same time in input file order
+    keys = [(i[0], int(i[1].split('/')[1]), int(i[1].split('/')[2].split(' ')[0])) for i in rows]
+    assert keys == sorted(keys)
+    assert sorted(output[0].splitlines()) == sorted(expected[0].splitlines())
+
+    # Sessions differ: log entries of a host are in time order only when they are merged
+    assert output[1].split('Sessions:')[0] == expected[1].split('Sessions:')[0]
+    assert 'count: 1,' in output[1].split('Sessions:')[1]
+
+
+"""
+Geo location
+"""
+class mmdb_records(object):
+  def __init__(self, records):
+    self.records = records
+
+  def get(self, remote_host):
+    if remote_host not in self.records:
+      raise ValueError(remote_host)
+    return self.records[remote_host]
+
+def test_mmdb_reader_missing_fields():
+  reader        = object.__new__(logparser.geo_mmdb_reader)
+  reader.reader = mmdb_records({
+    '1.1.1.1': {'country': {'names': {'en': 'Finland'}}, 'city': {'names': {'en': 'Oulu'}}},
+    '1.1.1.2': {'country': {'names': {'en': 'Finland'}}, 'location': {'latitude': 65.0, 'longitude': 25.5}},
+    '1.1.1.3': {'registered_country': {'names': {'en': 'Finland'}}, 'location': {'accuracy_radius': 1000}},
+    '1.1.1.4': {'country': {'iso_code': 'FI'}, 'city': {'geoname_id': 1}, 'location': {'latitude': 65.0}},
+    '1.1.1.5': {'continent': {'code': 'EU'}},
+    '1.1.1.6': None
+  })
+
+  assert [reader.lookup('1.1.1.{}'.format(i)) for i in range(1, 8)] == [
+    {'host_country': 'Finland', 'host_city': 'Oulu'},
+    {'host_country': 'Finland', 'host_city': 'Unknown: 65.000000, 25.500000'},
+    {'host_country': 'Finland', 'host_city': 'Unknown'},
+    {'host_country': 'Unknown', 'host_city': 'Unknown'},
+    {'host_country': 'Unknown', 'host_city': None},
+    {'host_country': 'Unknown', 'host_city': None},
+    {'host_country': 'Unknown', 'host_city': None}
+  ]
+
+
+"""
+Following files
+"""
+def test_follow_incompatible_options(tmp_path, monkeypatch):
+  log_file = str(tmp_path / 'access_log')
+  write_log(log_file)
+
+  for args, message in [(['--jobs', '2'], "parallel jobs"), (['--merge-by-time'], "merged by time")]:
+    with pytest.raises(Exception, match = message):
+      get_program(monkeypatch, '-f', log_file, '--follow', *args)